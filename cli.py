@@ -0,0 +1,108 @@
+"""
+ElabLite command line: packages the raw files of experiments with their metadata, without the web interface.
+
+Examples:
+    python cli.py presets/*.elablite --files /data/dumps --output /data/exports --columns IdentifierAnalysis Object/Sample
+    python cli.py --template xrf.json --table metadata.csv --title "XRF campaign" --code XRF --files /data/xrf
+"""
+import argparse
+import logging
+import os
+import sys
+from datetime import date
+
+from __version__ import __identifier__
+from models.technical import TECHNIQUES, TechniqueOption
+from utils.archive import COMPRESSIONS
+from utils.pipeline import Job, run_jobs
+
+logger = logging.getLogger("elablite")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="elablite", description="Package raw files and metadata for elabFTW.")
+    parser.add_argument("presets", nargs="*", help=".elablite presets, one archive by preset")
+    parser.add_argument("--files", required=True,
+                        help="Directory of the raw files. With several presets, the files of a preset are read in "
+                             "the subdirectory named as the preset, if any")
+    parser.add_argument("--output", default=".", help="Directory of the archives (default: current directory)")
+    parser.add_argument("--template", help="Template (json, eln) of an experiment without preset, with --table")
+    parser.add_argument("--table", help="Metadata table (CSV, one row by analysis) of the template")
+    parser.add_argument("--title", help="Title of the experiment (template only)")
+    parser.add_argument("--code", help="Technique code of the experiment (template only)")
+    parser.add_argument("--date", type=date.fromisoformat, default=date.today(),
+                        help="Date of the experiment, YYYY-MM-DD (template only, default: today)")
+    parser.add_argument("--shortname", help="Project shortname (template only)")
+    parser.add_argument("--tags", nargs="*", default=[], help="Tags of the experiment (template only)")
+    parser.add_argument("--pattern", help="Filename pattern with named groups "
+                                          "(default: identifier and sample, e.g. XRF0001_MsLat59_f01v_pt3.spc)")
+    parser.add_argument("--columns", nargs="*", default=[],
+                        help="Columns included in the new filenames, in order (files keep their names if empty)")
+    parser.add_argument("--grouped", action="store_true", help="All the analyses in one experience")
+    parser.add_argument("--no-suffix", dest="auto_suffix", action="store_false",
+                        help="Fail on duplicated names instead of suffixing them")
+    parser.add_argument("--skip-unmatched", action="store_true", help="Drop the rows without file instead of failing")
+    parser.add_argument("--force", action="store_true", help="Export tables with invalid cells")
+    parser.add_argument("--compression", choices=list(COMPRESSIONS), default="deflate")
+    parser.add_argument("--level", type=int, choices=range(1, 10), metavar="1-9", help="Compression level")
+    parser.add_argument("--processes", type=int, help="Presets processed in parallel (default: number of cores)")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--version", action="version", version=__identifier__)
+    args = parser.parse_args(argv)
+    if not args.presets and not (args.template and args.table and args.title and args.code):
+        parser.error("give .elablite presets, or --template, --table, --title and --code")
+    return args
+
+
+def files_directory(root: str, preset: str, several: bool) -> str:
+    """Directory of the raw files of a preset"""
+    subdirectory = os.path.join(root, os.path.splitext(os.path.basename(preset))[0])
+    return subdirectory if several and os.path.isdir(subdirectory) else root
+
+
+def build_jobs(args: argparse.Namespace) -> list:
+    """Jobs of the command line: one by preset, and the template if any"""
+    processes = args.processes or os.cpu_count() or 1
+    n_jobs = len(args.presets) + bool(args.template)
+    options = dict(pattern=args.pattern, columns=args.columns, grouped=args.grouped, auto_suffix=args.auto_suffix,
+                   skip_unmatched=args.skip_unmatched, force=args.force, compression=args.compression,
+                   compresslevel=args.level,
+                   # compression threads shared between the jobs run at the same time
+                   workers=max(1, (os.cpu_count() or 1) // min(processes, n_jobs)))
+
+    jobs = []
+    for preset in args.presets:
+        name = os.path.splitext(os.path.basename(preset))[0]
+        jobs.append(Job(files=files_directory(args.files, preset, len(args.presets) > 1),
+                        output=os.path.join(args.output, f"{name}.zip"), preset=preset, **options))
+    if args.template:
+        technical = TECHNIQUES.get(args.code) or TechniqueOption(args.code, args.code, args.code)
+        metadata_base = {'date': args.date, 'title': args.title, 'technical': technical,
+                         'project_shortname': args.shortname, 'commentary': '', 'rating': 0, 'tags': args.tags}
+        name = os.path.splitext(os.path.basename(args.table))[0]
+        jobs.append(Job(files=args.files, output=os.path.join(args.output, f"{name}.zip"), template=args.template,
+                        table=args.table, metadata_base=metadata_base, **options))
+    return jobs
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(levelname)s %(message)s")
+    jobs = build_jobs(args)
+
+    failed = 0
+    for result in run_jobs(jobs, args.processes):
+        for warning in result.warnings:
+            logger.warning("%s: %s", result.name, warning)
+        if result.ok:
+            logger.info("%s: %d analyses, %d files -> %s (%.1fs)", result.name, result.rows, result.files,
+                        result.output, result.seconds)
+        else:
+            failed += 1
+            logger.error("%s: %s", result.name, result.error)
+    logger.info("%d/%d archive(s) written", len(jobs) - failed, len(jobs))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,181 @@
+import hashlib
+import json
 from dataclasses import dataclass, field
 from datetime import date
+from functools import lru_cache
 from dateutil.parser import parse, ParserError
 import streamlit as st
-from typing import List, Union
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 from models.validator import validate_email, validate_url
+from utils.tracing import trace
+from utils.units import UNIT_SEPARATOR
+
+# st.fragment (streamlit >= 1.37), st.experimental_fragment before
+fragment = getattr(st, 'fragment', None) or st.experimental_fragment
+# Above this number of fields, the groups of the form are rendered one at a time by default
+LAZY_FIELDS = 50
+
+
+@dataclass(frozen=True, slots=True)
+class FieldPlan:
+    """
+    Compiled field of a form: parameters parsed once and renderer resolved, in a compact immutable record.
+
+    Attributes:
+        name (str): The name of the metadata field.
+        field_type (str): The type of the metadata field (e.g., 'text', 'number').
+        label (str): The label of the widget ('*' appended to the required fields).
+        value (Any): The default value of the field (without unit).
+        unit (str): The default unit of a number field.
+        units (Tuple[str]): The possible units of a number field.
+        options (Tuple[str]): The options of a select field.
+        description (str): The help of the widget.
+        required (bool): Whether the field is required.
+        readonly (bool): Whether the field is not editable.
+        allow_multi_values (bool): Whether multiple values are allowed.
+        group_id (int): The group ID to which the field belongs.
+        renderer (Callable): MetadataForms renderer of the type, called with (field, value, unit, disabled).
+    """
+    name: str
+    field_type: str
+    label: str
+    value: Any
+    unit: str
+    units: Tuple[str, ...]
+    options: Tuple[str, ...]
+    description: str
+    required: bool
+    readonly: bool
+    allow_multi_values: bool
+    group_id: int
+    renderer: Callable[..., Tuple[Any, str]]
+
+    def render(self, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
+        """
+        Renders the widget of the field.
+        :param value: current value (without unit)
+        :param unit: current unit of a number field
+        :param disabled: Whether the widget should be disabled
+        :return: tuple(value, unit) entered
+        """
+        return self.renderer(self, value, unit, disabled or self.readonly)
+
+
+@dataclass(frozen=True, slots=True)
+class FormPlan:
+    """
+    Compiled form of a template: fields ordered by position and split in groups (consecutive fields of the same
+    group_id), walked on each rerun instead of parsing the template again.
+
+    Attributes:
+        fields (Tuple[FieldPlan]): The fields, in position order.
+        groups (Tuple[Tuple[int, Tuple[FieldPlan]]]): The groups, as (group_id, fields), in position order.
+    """
+    fields: Tuple[FieldPlan, ...]
+    groups: Tuple[Tuple[int, Tuple[FieldPlan, ...]], ...]
+
+    @classmethod
+    def from_fields(cls, fields: Tuple[FieldPlan, ...]) -> "FormPlan":
+        """
+        Splits the fields in groups.
+        :param fields: tuple of FieldPlan, in position order
+        :return: FormPlan
+        """
+        groups = []
+        group_id = MetadataForms.group_id
+        for field_ in fields:
+            if not groups or field_.group_id != group_id:
+                group_id = field_.group_id
+                groups.append((group_id, []))
+            groups[-1][1].append(field_)
+        return cls(fields=fields, groups=tuple((group_id, tuple(group)) for group_id, group in groups))
+
+
+@dataclass(frozen=True)
+class TemplateKey:
+    """
+    Cache key of a compiled form: the hash of the template, the extra_fields being carried along without being
+    compared or hashed.
+
+    Attributes:
+        digest (str): The hash of the extra_fields (see template_hash).
+        extra_fields (Dict): The extra_fields of the template.
+    """
+    digest: str
+    extra_fields: Dict = field(compare=False, repr=False)
+
+
+def split_unit(value: Any, unit: str = None) -> Tuple[Any, str]:
+    """Value and unit of a number field ('value||unit' strings)"""
+    if isinstance(value, str) and UNIT_SEPARATOR in value:
+        value, unit = value.split(UNIT_SEPARATOR, 1)
+    return value, unit
+
+
+def compile_field(name: str, field_data: Dict) -> FieldPlan:
+    """
+    Compiles a field of the template.
+    :param name: str, name of the field
+    :param field_data: dict, field of the template extra_fields (not modified)
+    :return: FieldPlan
+    """
+    field_type = field_data.get('type', 'text')
+    value, unit = field_data.get('value'), None
+    if field_type == 'number':
+        value, unit = split_unit(value, field_data.get('unit', None))
+    required = bool(field_data.get('required', False))
+    label = name.replace('_', ' ')
+    return FieldPlan(name=name, field_type=field_type, label=label + " *" if required else label, value=value,
+                     unit=unit, units=tuple(field_data.get('units') or ()),
+                     options=tuple(field_data.get('options') or ()),
+                     description=field_data.get('description', ''), required=required,
+                     readonly=bool(field_data.get('readonly', False)),
+                     allow_multi_values=bool(field_data.get('allow_multi_values', False)),
+                     group_id=field_data.get('group_id', 0),
+                     # e.g. 'datetime-local' -> _render_datetime_local_field
+                     renderer=getattr(MetadataForms, f"_render_{field_type.replace('-', '_')}_field"))
+
+
+@lru_cache(maxsize=32)
+def _compile_form(key: TemplateKey) -> FormPlan:
+    """Form plan of the extra_fields of a template, cached by the hash of the template"""
+    sorted_fields = sorted(key.extra_fields.items(), key=lambda x: x[1]['position'] if 'position' in x[1] else -1)
+    return FormPlan.from_fields(tuple(compile_field(name, field_data) for name, field_data in sorted_fields))
+
+
+def template_hash(extra_fields: Dict) -> str:
+    """
+    Hash of the extra_fields of a template, computed once when the template is loaded (st.session_state
+    ['template_hash']) and used as the key of its compiled form.
+    :param extra_fields: dict, extra_fields of the template
+    :return: str, hex digest
+    """
+    serialized = json.dumps(extra_fields, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def group_labels(metadata: Dict, plan: FormPlan) -> List[str]:
+    """
+    Labels of the groups of a form, from the elabFTW groups of the template (metadata['elabftw']
+    ['extra_fields_groups']) or their id.
+    :param metadata: dict, metadata of the template
+    :param plan: FormPlan
+    :return: list of str, by group of the plan
+    """
+    groups = (metadata.get('elabftw') or {}).get('extra_fields_groups') or []
+    names = {str(group.get('id')): group.get('name') for group in groups if isinstance(group, dict)}
+    return [f"{names.get(str(group_id)) or f'Group {group_id}'} ({len(fields)})" for group_id, fields in plan.groups]
+
+
+def compile_form(extra_fields: Dict, key: str = None) -> FormPlan:
+    """
+    Compiled form of a template, cached per template content.
+    :param extra_fields: dict, extra_fields of the template
+    :param key: str, hash of the extra_fields (see template_hash), computed if not given
+    :return: FormPlan
+    """
+    return _compile_form(TemplateKey(key or template_hash(extra_fields), extra_fields))
 
 
 @dataclass
@@ -47,23 +218,30 @@ class MetadataForms:
         Rendering streamlit widgets according to type detected
         :param disabled: Whether the widget should be disabled
         """
-
-        field_label = self.name.replace('_', ' ')
-        getattr(self, f"_render_{self.field_type}_field")(field_label, disabled)
+        field_data = {'type': self.field_type, 'value': self.value, 'unit': self.unit, 'units': self.units,
+                      'options': self.options, 'description': self.description, 'required': self.required,
+                      'group_id': self.group_id, 'allow_multi_values': self.allow_multi_values,
+                      'readonly': self.readonly}
+        self.value, self.unit = compile_field(self.name, field_data).render(self.value, self.unit, disabled)
 
     @classmethod
-    def generate_form(cls, metadata, disabled: bool = False):
+    def generate_form(cls, metadata, disabled: bool = False, lazy: bool = None):
         """
         Iteratively generates forms based on metadata.
 
         This method uses the provided metadata to generate form fields within a Streamlit session.
         It ensures that session state variables for form data, required fields, and extra fields are initialized.
-        It sorts the extra fields based on their position and iteratively creates and renders each form field.
+        It sorts the extra fields based on their position and renders each group of fields (group_id) in its own
+        fragment: editing a field only reruns its group, which updates form data in place. The metadata is not
+        modified.
 
         Args:
             metadata (dict): A dictionary containing metadata for the form fields. It should include an 'extra_fields' key,
                              which contains the details of each form field such as type, position, group_id, and other attributes.
             disabled (bool): False as default value. To disable widget editing
+            lazy (bool): Render one group at a time, selected in a tab bar. The fields of the other groups keep their
+                         value in form data (or the template default) without widgets. Defaults to True above
+                         LAZY_FIELDS fields.
 
         Example:
             metadata = {
@@ -75,222 +253,205 @@ class MetadataForms:
             MyClass.generate_form(metadata)
         """
         # Initialize session state variables
-        if 'form_data' not in st.session_state:
+        if 'form_data' not in st.session_state or st.session_state.form_data is None:
             st.session_state.form_data = {}
-        if 'required_form' not in st.session_state:
-            st.session_state.required_form = []
+        if not isinstance(st.session_state.get('required_form'), dict):
+            st.session_state.required_form = {}
         if 'extra_fields' not in st.session_state:
             st.session_state.extra_fields = {}
 
         st.session_state['extra_fields'] = metadata.get('extra_fields', {})
-        sorted_fields = sorted(st.session_state['extra_fields'].items(),
-                               key=lambda x: x[1]['position'] if 'position' in x[1] else -1)
-
-        group_id = cls.group_id
-        for field_name, field_data in sorted_fields:
-            field_type = field_data.get('type', 'text')
-            field_group_id = field_data.get('group_id', 0)
-            if group_id != field_group_id:
-                group_id = field_group_id
-                st.divider()
-            # cleaning parameters
-            if bool(st.session_state.form_data):
-                # get value in memory
-                value = st.session_state.form_data.get(field_name, field_data['value'])
-            else:
-                value = field_data['value']
+        plan = compile_form(st.session_state['extra_fields'], st.session_state.get('template_hash'))
 
-            unit = None
-            if field_type == 'number':
-                if isinstance(value, str) and '||' in value:
-                    value, unit = value.split('||', 1)
-                else:
-                    # Initialize unit as None if it doesn't exist in the JSON
-                    unit = field_data.get('unit', None)
+        if lazy is None:
+            lazy = len(plan.fields) > LAZY_FIELDS
 
-            readonly = field_data.get('readonly', False)
-            if not disabled:
-                disabled_ = readonly
-            else:
-                disabled_ = disabled
-
-            # cleaning
-            field_data.pop('value', None)
-            field_data.pop('type', None)
-            field_data.pop('unit', None)
+        # full run of the form (fragments are rerun alone afterwards)
+        st.session_state['form_rendering'] = True
+        try:
+            with trace('form rendering', fields=len(plan.fields), groups=len(plan.groups), lazy=lazy):
+                if lazy and len(plan.groups) > 1:
+                    labels = group_labels(metadata, plan)
+                    active = st.radio("Group", range(len(plan.groups)), format_func=labels.__getitem__,
+                                      horizontal=True, label_visibility='collapsed', key='form_active_group')
+                    cls._fill_defaults(plan)
+                    cls._render_group(plan.groups[active or 0][1], disabled)
+                else:
+                    for n, (group_id, fields) in enumerate(plan.groups):
+                        if n or group_id != cls.group_id:
+                            st.divider()
+                        cls._render_group(fields, disabled)
+        finally:
+            st.session_state['form_rendering'] = False
+
+    @staticmethod
+    def _fill_defaults(plan: FormPlan):
+        """
+        Values of the fields without widget (groups not opened): value in form data, else the template default.
+        :param plan: FormPlan
+        """
+        form_data = st.session_state.form_data
+        required_form = st.session_state.required_form
+        for field_ in plan.fields:
+            if field_.name not in form_data:
+                if field_.field_type == 'number' and field_.unit:
+                    form_data[field_.name] = f"{field_.value}{UNIT_SEPARATOR}{field_.unit}"
+                else:
+                    form_data[field_.name] = field_.value
+            if field_.required:
+                value = form_data[field_.name]
+                required_form[field_.name] = split_unit(value)[0] if field_.field_type == 'number' else value
 
-            # execute
-            field_ = cls(field_name, field_type, value=value, unit=unit, **field_data)
-            field_.render(disabled=disabled_)
+    @classmethod
+    @fragment
+    def _render_group(cls, fields: Tuple[FieldPlan, ...], disabled: bool):
+        """
+        Renders a group of fields and saves their values in form data. Rerun alone when one of its fields is edited
+        (the whole page is rerun only if the required fields become complete or incomplete).
+        :param fields: tuple of FieldPlan, in position order
+        :param disabled: Whether the widgets should be disabled
+        """
+        form_data = st.session_state.form_data
+        required_form = st.session_state.required_form
+        for field_ in fields:
+            # get value in memory
+            value, unit = form_data.get(field_.name, field_.value), field_.unit
+            if field_.field_type == 'number':
+                value, unit = split_unit(value, unit)
+
+            value, unit = field_.render(value, unit, disabled)
             if field_.required:
-                st.session_state.required_form.append(field_.value)
+                required_form[field_.name] = value
 
-            if field_type == 'number' and field_.unit:
-                st.session_state.form_data[field_name] = f"{field_.value}||{field_.unit}"
+            if field_.field_type == 'number' and unit:
+                form_data[field_.name] = f"{value}{UNIT_SEPARATOR}{unit}"
             else:
-                st.session_state.form_data[field_name] = field_.value
+                form_data[field_.name] = value
 
-    def _render_text_field(self, label: str, disabled: bool):
+        if not st.session_state.get('form_rendering', False):
+            # fragment rerun: the navigation depends on the required fields
+            if all(required_form.values()) != st.session_state.get('submit_enabled'):
+                st.rerun()
+
+    @staticmethod
+    def _render_text_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Text field rendering"""
-        self.value = st.text_input(label + " *" if self.required else label,
-                                   value=self.value,
-                                   help=self.description,
-                                   disabled=disabled)
+        return st.text_input(field_.label, value=value, help=field_.description, disabled=disabled), unit
 
-    def _render_select_field(self, label: str, disabled: bool):
+    @staticmethod
+    def _render_select_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Select field rendering"""
-        if self.allow_multi_values:
-            self.value = st.multiselect(label + " *" if self.required else label, self.options,
-                                        default=self.value,
-                                        help=self.description,
-                                        disabled=disabled)
-        else:
-            self.value = st.selectbox(label + " *" if self.required else label, self.options,
-                                      index=self.options.index(self.value) if self.value in self.options else 0,
-                                      help=self.description,
-                                      disabled=disabled)
-
-    def _render_date_field(self, label: str, disabled: bool):
+        if field_.allow_multi_values:
+            return st.multiselect(field_.label, field_.options,
+                                  default=value,
+                                  help=field_.description,
+                                  disabled=disabled), unit
+        return st.selectbox(field_.label, field_.options,
+                            index=field_.options.index(value) if value in field_.options else 0,
+                            help=field_.description,
+                            disabled=disabled), unit
+
+    @staticmethod
+    def _render_date_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Date field rendering"""
         try:
-            date_exp = parse(str(self.value))
-            self.value = st.date_input(label + " *" if self.required else label,
-                                       value=date_exp,
-                                       help=self.description,
-                                       disabled=disabled)
+            date_exp = parse(str(value))
         except ParserError:
-            self.value = st.date_input(label + " *" if self.required else label,
-                                       value=date.today(),
-                                       help=self.description,
-                                       disabled=disabled)
+            date_exp = date.today()
+        return st.date_input(field_.label, value=date_exp, help=field_.description, disabled=disabled), unit
 
-    def _render_datetime_local_field(self, label: str, disabled: bool):
+    @staticmethod
+    def _render_datetime_local_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """DateTime field rendering"""
-        self.value = st.date_input(label + " *" if self.required else label,
-                                   value=date.today(),
-                                   help=self.description,
-                                   disabled=disabled)
+        return st.date_input(field_.label, value=date.today(), help=field_.description, disabled=disabled), unit
 
-    def _render_checkbox_field(self, label: str, disabled: bool):
+    @staticmethod
+    def _render_checkbox_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Checkbox field rendering"""
-        self.value = st.checkbox(label + " *" if self.required else label,
-                                 value=self.value,
-                                 help=self.description,
-                                 disabled=disabled)
+        return st.checkbox(field_.label, value=value, help=field_.description, disabled=disabled), unit
 
-    def _render_email_field(self, label: str, disabled: bool):
+    @staticmethod
+    def _render_email_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Email field rendering"""
-        self.value = st.text_input(label + " *" if self.required else label,
-                                   value=self.value,
-                                   help=self.description,
-                                   on_change=validate_email,
-                                   args=(self.value,),
-                                   disabled=disabled)
-
-    def _render_time_field(self, label: str, disabled: bool):
+        return st.text_input(field_.label,
+                             value=value,
+                             help=field_.description,
+                             on_change=validate_email,
+                             args=(value,),
+                             disabled=disabled), unit
+
+    @staticmethod
+    def _render_time_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Time field rendering"""
-        self.value = st.time_input(label + " *" if self.required else label,
-                                   value=self.value,
-                                   help=self.description,
-                                   disabled=disabled)
+        return st.time_input(field_.label, value=value, help=field_.description, disabled=disabled), unit
 
-    def _render_number_field(self, label: str, disabled: bool):
+    @staticmethod
+    def _render_number_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Number field rendering. In container"""
         col1, col2 = st.columns([8, 2])
         with col1:
             try:
-                value = float(self.value)
+                value = float(value)
             except (ValueError, TypeError):
                 value = 0.0
-            self.value = st.number_input(label + " *" if self.required else label,
-                                         value=value,
-                                         help=self.description,
-                                         step=None,
-                                         format="%e",
-                                         disabled=disabled)
-
-        key_found = False
-        n_key = 1
-        unique_key_prefix = "form_1"
+            value = st.number_input(field_.label,
+                                    value=value,
+                                    help=field_.description,
+                                    step=None,
+                                    format="%e",
+                                    disabled=disabled)
 
         with col2:
-            if self.units:
-                try:
-                    self.unit = st.selectbox(
-                        "Unit",
-                        self.units,
-                        index=self.units.index(self.unit),
-                        disabled=disabled
-                    )
-                    key_found = True
-                except Exception:
-                    while not key_found and n_key < 100:  # Prevent infinite loop
-                        try:
-                            # Continue assigning unique keys in the retry block
-                            self.unit = st.selectbox(
-                                "Unit",
-                                self.units,
-                                index=self.units.index(self.unit),
-                                disabled=disabled,
-                                key=f"{unique_key_prefix}_unit_select_{n_key}"  # Unique key with n_key
-                            )
-                            key_found = True
-                        except Exception:
-                            n_key += 1
-                if not key_found:
-                    st.warning("Failed to generate unit box (key error)")
-
-    def _render_url_field(self, label: str, disabled: bool):
+            if field_.units:
+                # key by field: the same unit box in several groups must keep its identity when a group is rerun alone
+                unit = st.selectbox(
+                    "Unit",
+                    field_.units,
+                    index=field_.units.index(unit) if unit in field_.units else 0,
+                    disabled=disabled,
+                    key=f"form_unit_select_{field_.name}"
+                )
+        return value, unit
+
+    @staticmethod
+    def _render_url_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """URL field rendering"""
-        self.value = st.text_input(label + " *" if self.required else label,
-                                   value=self.value,
-                                   help=self.description,
-                                   disabled=disabled,
-                                   on_change=validate_url,
-                                   args=(self.value,))
-
-    def _render_radio_field(self, label: str, disabled: bool):
+        return st.text_input(field_.label,
+                             value=value,
+                             help=field_.description,
+                             disabled=disabled,
+                             on_change=validate_url,
+                             args=(value,)), unit
+
+    @staticmethod
+    def _render_radio_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Radio render field"""
-        self.value = st.radio(label + " *" if self.required else label,
-                              value=self.value,
-                              help=self.description,
-                              disabled=disabled)
-
-    def _render_items_field(self, label: str, disabled: bool):
-        """Items render field"""
+        return st.radio(field_.label, field_.options,
+                        index=field_.options.index(value) if value in field_.options else 0,
+                        help=field_.description,
+                        disabled=disabled), unit
+
+    @staticmethod
+    def _render_integer(field_: FieldPlan, value: Any, disabled: bool) -> int:
+        """Integer input (items, users, experiments)"""
         try:
-            value = int(self.value)
+            value = int(value)
         except (ValueError, TypeError):
             value = 0
-        self.value = st.number_input(label + " *" if self.required else label,
-                                     value=value,
-                                     help=self.description,
-                                     step=1,
-                                     format=None,
-                                     disabled=disabled)
-
-    def _render_users_field(self, label: str, disabled: bool):
+        return st.number_input(field_.label, value=value, help=field_.description, step=1, format=None,
+                               disabled=disabled)
+
+    @staticmethod
+    def _render_items_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
+        """Items render field"""
+        return MetadataForms._render_integer(field_, value, disabled), unit
+
+    @staticmethod
+    def _render_users_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Users render field"""
-        try:
-            value = int(self.value)
-        except (ValueError, TypeError):
-            value = 0
-        self.value = st.number_input(label + " *" if self.required else label,
-                                     value=value,
-                                     help=self.description,
-                                     step=1,
-                                     format=None,
-                                     disabled=disabled)
-
-    def _render_experiments_field(self, label: str, disabled: bool):
+        return MetadataForms._render_integer(field_, value, disabled), unit
+
+    @staticmethod
+    def _render_experiments_field(field_: FieldPlan, value: Any, unit: str, disabled: bool) -> Tuple[Any, str]:
         """Experiments render field"""
-        try:
-            value = int(self.value)
-        except (ValueError, TypeError):
-            value = 0
-        self.value = st.number_input(label + " *" if self.required else label,
-                                     value=value,
-                                     help=self.description,
-                                     step=1,
-                                     format=None,
-                                     disabled=disabled)
\ No newline at end of file
+        return MetadataForms._render_integer(field_, value, disabled), unit
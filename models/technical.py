@@ -101,3 +101,9 @@ TECHNIQUES = OrderedDict([
     ("XRD", TechniqueOption("XRD", "Diffraction des rayons X", "X-ray Diffraction")),
     ("XRF", TechniqueOption("XRF", "Spectroscopie de fluorescence des rayons X", "X-ray Fluorescence Spectroscopy")),
 ])
+
+# Filename pattern (regular expression with named groups) used to map the files of an analysis to the metadata
+# table. Group names are columns of the table, '_' standing for '/' (Object_Sample -> Object/Sample).
+# e.g. XRF0001_MsLat59_f01v_pt3.spc. The identifier starts with the technique code, so the pattern fits every
+# technique; it can be edited by technique for a session (Page 4 - Step 3).
+DEFAULT_FILENAME_PATTERN = r"^(?P<IdentifierAnalysis>[A-Za-z][A-Za-z0-9-]*?\d+)_(?P<Object_Sample>[^_.]+)"
@@ -1,5 +1,9 @@
+import pandas as pd
 import streamlit as st
 import validators
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from utils.units import UNIT_SEPARATOR, split_value_unit, unit_column
 
 def validate_url(url: str) -> bool:
     """
@@ -45,4 +49,161 @@ def validate_email(email: str) -> bool:
     st.session_state["validation_error"] = False
     if not is_valid:
         st.toast('Invalid email', icon='🚨')
-        st.session_state["validation_error"] = True
\ No newline at end of file
+        st.session_state["validation_error"] = True
+
+# Vectorized checks of the metadata table (batch validation before export)
+REPORT_COLUMNS = ['row', 'column', 'reason']
+
+# check: (reason, function of a column without missing values -> boolean mask of the invalid cells)
+ColumnCheck = Tuple[str, Callable[[pd.Series], pd.Series]]
+
+
+def _rejected_by(validator: Callable[[str], bool]) -> Callable[[pd.Series], pd.Series]:
+    """Values rejected by a validator of the forms (validate_url, validate_email), called once by distinct value"""
+    def invalid(values: pd.Series) -> pd.Series:
+        values = values.astype(str)
+        rejected = {value: not validator(value) for value in values.unique()}
+        return values.map(rejected)
+
+    return invalid
+
+
+def _invalid_number(values: pd.Series) -> pd.Series:
+    """Values which are not numbers"""
+    return pd.to_numeric(values, errors='coerce').isna()
+
+
+def _invalid_integer(values: pd.Series) -> pd.Series:
+    """Values which are not integers"""
+    numbers = pd.to_numeric(values, errors='coerce')
+    return numbers.isna() | (numbers != numbers.round())
+
+
+def _invalid_date(values: pd.Series) -> pd.Series:
+    """Values which are not dates"""
+    return pd.to_datetime(values.astype(str), errors='coerce', format='mixed').isna()
+
+
+def _unit_checks(field_data: Dict) -> List[ColumnCheck]:
+    """Checks of the unit column of a typed number field: units of the field"""
+    units = field_data.get('units') or []
+    if not units:
+        return []
+    return [(f"unit not in {', '.join(map(str, units))}", lambda column: ~column.astype(object).isin(units))]
+
+
+def _number_checks(field_data: Dict, typed: bool = False) -> List[ColumnCheck]:
+    """Checks of a number field: 'value||unit' with a number and a unit of the field, or a number if typed"""
+    units = field_data.get('units') or []
+    if typed or (not units and not field_data.get('unit')):
+        return [("not a number", _invalid_number)]
+
+    def invalid_format(column: pd.Series) -> pd.Series:
+        return split_value_unit(column)[2]
+
+    def invalid_value(column: pd.Series) -> pd.Series:
+        values, _, invalid = split_value_unit(column)
+        return ~invalid & _invalid_number(values)
+
+    checks = [(f"not a 'value{UNIT_SEPARATOR}unit' pair", invalid_format), ("not a number", invalid_value)]
+    if units:
+        def invalid_unit(column: pd.Series) -> pd.Series:
+            _, column_units, invalid = split_value_unit(column)
+            return ~invalid & ~column_units.isin(units)
+
+        checks.append((f"unit not in {', '.join(map(str, units))}", invalid_unit))
+    return checks
+
+
+def _select_checks(field_data: Dict) -> List[ColumnCheck]:
+    """Checks of a select field: values among the options"""
+    options = field_data.get('options') or []
+    if not options:
+        return []
+
+    def invalid_option(column: pd.Series) -> pd.Series:
+        if field_data.get('allow_multi_values'):
+            # one row by selected value, invalid if any value is invalid
+            values = column.map(lambda x: x if isinstance(x, (list, tuple)) else [x]).explode()
+            return (~values.isin(options) & values.notna()).groupby(level=0).any().reindex(column.index,
+                                                                                           fill_value=False)
+        return ~column.isin(options)
+
+    return [("not an option of the field", invalid_option)]
+
+
+def compile_checks(template_metadata: Dict, columns: Iterable[str] = ()) -> Dict[str, List[ColumnCheck]]:
+    """
+        Compiles the fields of a template into column checks.
+
+        Args:
+            template_metadata (Dict): The metadata template, with its 'extra_fields'.
+            columns (Iterable[str]): The columns of the table, to check the typed number fields (float64 values
+            and a unit column) apart from the 'value||unit' strings.
+
+        Returns:
+            Dict[str, List[ColumnCheck]]: The checks (reason, function returning the mask of the invalid cells)
+            of each column.
+    """
+    columns = set(columns)
+    checks = {}
+    for name, field_data in (template_metadata or {}).get('extra_fields', {}).items():
+        field_type = field_data.get('type', 'text')
+        if field_type == 'email':
+            checks[name] = [("invalid email", _rejected_by(validators.email))]
+        elif field_type == 'url':
+            checks[name] = [("invalid URL", _rejected_by(validators.url))]
+        elif field_type == 'number':
+            typed = unit_column(name) in columns
+            checks[name] = _number_checks(field_data, typed)
+            if typed:
+                checks[unit_column(name)] = _unit_checks(field_data)
+        elif field_type in ('date', 'datetime-local'):
+            checks[name] = [("invalid date", _invalid_date)]
+        elif field_type in ('select', 'radio'):
+            checks[name] = _select_checks(field_data)
+        elif field_type in ('items', 'users', 'experiments'):
+            checks[name] = [("not an integer", _invalid_integer)]
+    return checks
+
+
+def validate_dataframe(df: pd.DataFrame, template_metadata: Dict) -> pd.DataFrame:
+    """
+        Validates the whole metadata table against the template, column by column.
+
+        Args:
+            df (pd.DataFrame): The metadata table (one row by analysis).
+            template_metadata (Dict): The metadata template, with its 'extra_fields'.
+
+        Returns:
+            pd.DataFrame: The report of the invalid cells, with the columns 'row' (index of the row), 'column' and
+            'reason'. Empty if the table is valid.
+
+        Rapid Doc:
+        Missing values are only reported for required fields, the other checks are applied to the filled cells.
+
+        Example:
+            report = validate_dataframe(st.session_state['dataframe_metadata'], st.session_state['template_metadata'])
+    """
+    reports = []
+    checks = compile_checks(template_metadata, df.columns)
+    extra_fields = (template_metadata or {}).get('extra_fields', {})
+    required = {name for name, field_data in extra_fields.items() if field_data.get('required')}
+    # fields, then the unit columns of the typed number fields
+    for name in dict.fromkeys([*extra_fields, *checks]):
+        if name not in df.columns:
+            continue
+        column = df[name]
+        missing = column.isna() | (column.astype(str).str.strip() == '')
+        if name in required:
+            reports.append(pd.DataFrame({'row': df.index[missing.to_numpy()], 'column': name,
+                                         'reason': "required value missing"}))
+        filled = column[~missing]
+        if filled.empty:
+            continue
+        for reason, check in checks.get(name, []):
+            invalid = check(filled).fillna(True).astype(bool)
+            reports.append(pd.DataFrame({'row': filled.index[invalid.to_numpy()], 'column': name, 'reason': reason}))
+    if not reports:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+    return pd.concat(reports, ignore_index=True)[REPORT_COLUMNS]
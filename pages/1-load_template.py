@@ -1,9 +1,9 @@
 import os
-from time import sleep
 import streamlit as st
 
 from utils.menu import menu
-from utils.manager import manage_temp_dir
+from utils.manager import manage_temp_dir, save_upload
+from utils.parser import prefetch
 
 st.title("Load an experiment")
 menu()
@@ -18,9 +18,9 @@ if option == "Import save":
                                      accept_multiple_files=False)
     if uploaded_file is not None:
         st.session_state["selected_template"] = os.path.join(templates_dir, uploaded_file.name)
-        # Save the uploaded file to the temporary directory
-        with open(st.session_state["selected_template"], "wb") as f:
-            f.write(uploaded_file.getvalue())
+        # Save the uploaded file to the temporary directory, written aside then renamed: the table of the previous
+        # version of the preset can still be memory-mapped
+        save_upload(uploaded_file, st.session_state["selected_template"])
         st.success("File uploaded successfully!")
         # re init
         st.session_state['metadata_base'] = None
@@ -30,8 +30,8 @@ if option == "Import save":
         # var
         st.session_state["step_metadata"] = "step_metadata_base"
         st.session_state.form_data = {}
-        # redirect
-        sleep(1.5)
+        # redirect, the preset being parsed meanwhile
+        prefetch(st.session_state["selected_template"])
         st.switch_page("pages/2-metadata_forms.py")
 elif option == "Load existing save":
     templates = os.listdir(templates_dir)
@@ -48,7 +48,8 @@ elif option == "Load existing save":
             st.session_state["selected_template"] = os.path.join(templates_dir, selected_template)
             st.session_state["step_metadata"] = "step_metadata_base"
             st.session_state.form_data = {}
-            # redirect
+            # redirect, the preset being parsed meanwhile
+            prefetch(st.session_state["selected_template"])
             st.switch_page("pages/2-metadata_forms.py")
         except TypeError:
             st.warning("You need to select a preset")
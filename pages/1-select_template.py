@@ -1,15 +1,35 @@
 import os
-from time import sleep
 import streamlit as st
 
 from utils.menu import menu
-from utils.manager import manage_temp_dir
+from utils.manager import manage_temp_dir, save_upload
+from utils.parser import TemplatesReader, prefetch
 
 st.title("Upload or Select Template")
 menu()
 option = st.sidebar.radio("Options", ["Upload Template", "Select existing template"])
 st.sidebar.divider()
 templates_dir = manage_temp_dir()
+
+
+def select_eln_entry(template_path: str) -> bool:
+    """
+    Select the experiment used as template in an ELN file (RO-Crate) which can contain many experiments.
+    :param template_path: str, path of the template
+    :return: bool, True if the template is ready to use
+    """
+    if not template_path.endswith('.eln'):
+        st.session_state["selected_entry"] = None
+        return True
+    entries = TemplatesReader(template_path).read_entries()
+    if not entries:
+        st.warning("No experiment found in the ELN file")
+        return False
+    st.session_state["selected_entry"] = st.selectbox("Select the experiment to use as template", entries.keys(),
+                                                      format_func=lambda x: entries[x])
+    return st.button('Use this experiment')
+
+
 st.markdown("""
 This page allows you to use an authority form template from an electronic laboratory notebook to acquire metadata about 
 one or more experiences. Format: JSON, CSV, ELN
@@ -22,10 +42,12 @@ if option == "Upload Template":
     uploaded_file = st.file_uploader("Upload a file", type=["json", "csv", "eln"], accept_multiple_files=False)
     if uploaded_file is not None:
         st.session_state["selected_template"] = os.path.join(templates_dir, uploaded_file.name)
-        # Save the uploaded file to the temporary directory
-        with open(st.session_state["selected_template"], "wb") as f:
-            f.write(uploaded_file.getvalue())
+        # Save the uploaded file to the temporary directory (only if its content changed, to keep the parsed template
+        # cached)
+        save_upload(uploaded_file, st.session_state["selected_template"])
         st.success("File uploaded successfully!")
+        if not select_eln_entry(st.session_state["selected_template"]):
+            st.stop()
         # var
         st.session_state["step_metadata"] = "step_metadata_base"
         st.session_state['metadata_base'] = {}
@@ -33,24 +55,30 @@ if option == "Upload Template":
         st.session_state["dataframe_metadata"] = None
         st.session_state['form_data'] = {}
         st.session_state['basic_executed'] = False
-        # redirect
-        sleep(1.5)
+        # redirect, the template being parsed meanwhile
+        prefetch(st.session_state["selected_template"], st.session_state["selected_entry"])
         st.switch_page("pages/2-metadata_forms.py")
 elif option == "Select existing template":
-    templates = os.listdir(templates_dir)
-    templates.remove('presets')
+    templates = [x for x in os.listdir(templates_dir) if os.path.isfile(os.path.join(templates_dir, x))]
     selected_template = st.selectbox("Select a recent template", templates, index=None, placeholder="Choosing ...")
-    if st.button('Validate'):
+    if selected_template is not None and selected_template.endswith('.eln'):
+        validated = select_eln_entry(os.path.join(templates_dir, selected_template))
+    else:
+        validated = st.button('Validate')
+    if validated:
         try:
             # var
             st.session_state["selected_template"] = os.path.join(templates_dir, selected_template)
+            if not selected_template.endswith('.eln'):
+                st.session_state["selected_entry"] = None
             st.session_state["step_metadata"] = "step_metadata_base"
             st.session_state['metadata_base'] = {}
             st.session_state['template_metadata'] = None
             st.session_state["dataframe_metadata"] = None
             st.session_state['basic_executed'] = False
             st.session_state['form_data'] = {}
-            # redirect
+            # redirect, the template being parsed meanwhile
+            prefetch(st.session_state["selected_template"], st.session_state["selected_entry"])
             st.switch_page("pages/2-metadata_forms.py")
         except TypeError:
             st.warning("You need to select a template")
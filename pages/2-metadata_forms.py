@@ -1,22 +1,23 @@
-import copy
 import os
 import pandas as pd
 import streamlit as st
-import time
 from datetime import datetime
 from streamlit_star_rating import st_star_rating
 from streamlit_tags import st_tags
 
-from models.forms import MetadataForms
+from models.forms import LAZY_FIELDS, MetadataForms, template_hash
 from models.technical import TechniqueOption, TECHNIQUES
+from utils.editor import Delta, EditorState, apply_to_rows, expand_identifiers, fill_down, generate_rows, parse_samples
 from utils.manager import create_elablite
 from utils.menu import menu
 from utils.parser import TemplatesReader
+from utils.tracing import show_traces
+from utils.units import form_columns, number_fields, select_fields, typed_table
 
 ### BASIC ###
 
 try:
-    reader = TemplatesReader(st.session_state["selected_template"])
+    reader = TemplatesReader(st.session_state["selected_template"], entry_id=st.session_state.get("selected_entry"))
 except KeyError:
     # Go to home if reload page or anything which delete selected_template session
     st.switch_page("app.py")
@@ -30,7 +31,8 @@ if not st.session_state['basic_executed']:
 
     dataframe_metadata = reader.read_dataframe()
     if dataframe_metadata is not None:
-        st.session_state['dataframe_metadata'] = dataframe_metadata
+        # number fields of older presets are 'value||unit' strings, select fields are stored as categories
+        st.session_state['dataframe_metadata'] = typed_table(dataframe_metadata, reader.read_metadata())
     del form_data, metadata_base, dataframe_metadata
 
     # Set the flag to True after execution
@@ -94,36 +96,147 @@ def step_metadata_forms():
     if "template_metadata" not in st.session_state:
         st.session_state["template_metadata"] = None
     st.header("Experience Metadata")
+    # the template is not modified by MetadataForms.generate_form(), no copy needed to save it in .elablite
     original_metadata = reader.read_metadata()
-    working_metadata = copy.deepcopy(original_metadata)
+    lazy = st.toggle("Show one group at a time", key="form_lazy",
+                     value=len(original_metadata.get('extra_fields', {})) > LAZY_FIELDS,
+                     help="Only the fields of the selected group are displayed, the others keep their values")
     try:
+        if st.session_state['template_metadata'] is not original_metadata:
+            # template loaded (the reader serves the same dictionary while the file is unchanged)
+            st.session_state['template_hash'] = template_hash(original_metadata.get('extra_fields', {}))
         st.session_state['template_metadata'] = original_metadata
         with st.container():
-            st.session_state.required_form = []
-            MetadataForms.generate_form(working_metadata)
-            st.session_state["submit_enabled"] = all(st.session_state.required_form)
+            st.session_state.required_form = {}
+            MetadataForms.generate_form(original_metadata, lazy=lazy)
+            st.session_state["submit_enabled"] = all(st.session_state.required_form.values())
     except Exception as e:
         st.error(f"Error: {e}")
-    # Re init without modification MetadataForms.generate_form()
-    # To save the good template in .elablite
-    st.session_state['template_metadata'] = original_metadata
 
 
 ### EDITING DATAFRAME FILE ###
 
-def add_row(edited_df: pd.DataFrame):
+def editor_state() -> EditorState:
+    """
+    State of the files metadata editor (base table and log of the changes), restarted when the table of the session
+    is replaced (e.g. new template)
+    :return: EditorState
+    """
+    state = st.session_state.get('editor_state')
+    if state is None or state.base is not st.session_state['dataframe_metadata']:
+        state = EditorState(st.session_state['dataframe_metadata'])
+        st.session_state['editor_state'] = state
+        st.session_state['dataframe_metadata'] = state.base
+    return state
+
+
+def commit_changes(delta: Delta = None):
+    """
+    Saves the unsaved changes of the editor, then a delta, in session state 'dataframe_metadata'
+    :param delta: Delta, optional change applied after the changes of the editor
+    """
+    state = editor_state()
+    state.commit(state.pending(st.session_state.get(state.key)))
+    if delta is not None:
+        state.commit(delta)
+    st.session_state['dataframe_metadata'] = state.base
+
+
+def undo_changes():
+    """Reverts the last change saved in the editor"""
+    state = editor_state()
+    state.undo()
+    st.session_state['dataframe_metadata'] = state.base
+
+
+def redo_changes():
+    """Saves again the last change reverted in the editor"""
+    state = editor_state()
+    state.redo()
+    st.session_state['dataframe_metadata'] = state.base
+
+
+def typed_fields() -> dict:
+    """
+    Typed columns of the table from the template: units of the number fields (value and unit columns) and options
+    of the select fields (categorical columns)
+    :return: dict, keyword arguments 'numbers' and 'selects' of generate_rows
+    """
+    template_metadata = st.session_state.get('template_metadata')
+    return {'numbers': number_fields(template_metadata), 'selects': select_fields(template_metadata)}
+
+
+def add_row():
     """
     Adds a new row to the DataFrame stored in the Streamlit. Return edited df to session state 'dataframe_metadata'
-    :param edited_df: DataFrame storing the data
     """
-    df = edited_df
-    form_data = st.session_state.form_data
+    commit_changes(Delta(added=generate_rows(st.session_state.form_data, **typed_fields())))
 
-    new_row = pd.DataFrame([form_data], columns=[*form_data.keys()])
-    new_row['IdentifierAnalysis'] = None
-    new_row['Object/Sample'] = None
-    new_row['LocalisationAnalysis'] = None
-    st.session_state.dataframe_metadata = pd.concat([df, new_row], ignore_index=True)
+
+def add_bulk_rows():
+    """
+    Adds all the rows of an identifier pattern (crossed with the Object/Sample list) at once, pre-filled with the
+    experimental metadata. Return edited df to session state 'dataframe_metadata'
+    """
+    try:
+        identifiers = expand_identifiers(st.session_state.bulk_pattern, count=st.session_state.bulk_count)
+        samples = parse_samples(st.session_state.bulk_samples)
+        new_rows = generate_rows(st.session_state.form_data, identifiers or [None], samples, **typed_fields())
+    except ValueError as e:
+        st.error(f"Impossible to generate the rows: {e}")
+        return
+    commit_changes()
+    deleted = list(range(len(st.session_state.dataframe_metadata))) if st.session_state.bulk_replace else []
+    commit_changes(Delta(deleted=deleted, added=new_rows))
+    st.toast(f"{len(new_rows)} rows added", icon="✅")
+
+
+def apply_form_values(fill: bool = False):
+    """
+    Applies the experimental metadata values (or the values of the first row with fill down) to the selected columns
+    of a range of rows. Return edited df to session state 'dataframe_metadata'
+    :param fill: bool, fill down the values of the first row of the range instead of the form values
+    """
+    commit_changes()
+    df = st.session_state.dataframe_metadata
+    start, stop = st.session_state.apply_start - 1, st.session_state.apply_stop - 1
+    columns = st.session_state.apply_columns
+    if fill:
+        delta = fill_down(df, columns, start, stop)
+    else:
+        values = form_columns(st.session_state.form_data, typed_fields()['numbers'])
+        delta = apply_to_rows(df, start, stop, {col: values[col] for col in columns if col in values})
+    commit_changes(delta)
+
+
+def bulk_editing(df: pd.DataFrame):
+    """
+    Bulk operations of the files metadata editor: rows generation and values applied to a range of rows.
+    :param df: DataFrame storing the data
+    """
+    col1, col2 = st.columns(2)
+    with col1:
+        with st.popover("➕ Generate rows", use_container_width=True):
+            st.text_input("Identifier pattern", key="bulk_pattern", placeholder="XRF{0001..0500}",
+                          help="`{0001..0500}` is replaced by each number of the range and `{a,b}` by each value. "
+                               "Without braces, the identifier is numbered up to the count.")
+            st.number_input("Count", min_value=0, value=0, step=1, key="bulk_count",
+                            help="Number of identifiers of a pattern without braces")
+            st.text_area("Object/Sample", key="bulk_samples",
+                         help="Optional, one value by line: every identifier is crossed with every sample")
+            st.toggle("Replace the existing rows", key="bulk_replace")
+            st.button("Generate", on_click=add_bulk_rows, type="primary",
+                      help="Add the rows pre-filled with the experimental parameters")
+    with col2:
+        with st.popover("✏️ Apply to rows", use_container_width=True, disabled=df.empty):
+            n_rows = max(len(df), 1)
+            st.number_input("From row", min_value=1, max_value=n_rows, value=1, key="apply_start")
+            st.number_input("To row", min_value=1, max_value=n_rows, value=n_rows, key="apply_stop")
+            st.multiselect("Columns", df.columns.tolist(), key="apply_columns")
+            st.button("Apply experimental parameters", on_click=apply_form_values,
+                      help="Set the current values of the form in the selected columns")
+            st.button("Fill down", on_click=apply_form_values, args=(True,),
+                      help="Copy the values of the first row of the range in the following rows")
 
 
 def step_metadata_files():
@@ -140,46 +253,44 @@ def step_metadata_files():
 hyphen (-) to show continuity. The underscore is used to separate parameters in the file name.
 - `LocalisationAnalysis` : description area to help locate and differentiate the analysis. If you later wish to keep 
 this parameter within the file name, it must not contain spaces or be too descriptive (e.g. *RedTopEnlighment*).
+- Number fields are split in a value column and a `(unit)` column, whose unit is chosen among the units of the field.
+Select fields are chosen among their options.
         
 In this spreadsheet you can add cells (with the `+` button), delete cells or enlarge cells. If you wish to add a new
 cell and apply metadata. Ideally, select the first row and drag. Alternatively, you can copy/paste the line.
 
 Use the `Add row` button to add a new row pre-filled with the experimental metadata defined in the previous step. 
+To build a whole campaign, `Generate rows` adds all the rows of an identifier pattern (e.g. `XRF{0001..0500}`), 
+optionally crossed with a list of `Object/Sample`, and `Apply to rows` sets the experimental parameters (or fills down 
+the first row) on a range of rows.
 If you wish, you can return to the previous page to edit your template and add rows with updated metadata.
     """)
 
     if "dataframe_metadata" not in st.session_state:
         st.session_state["dataframe_metadata"] = None
 
-    form_data = st.session_state.form_data
+    if st.session_state['dataframe_metadata'] is None:
+        st.session_state.dataframe_metadata = generate_rows(st.session_state.form_data, **typed_fields())
 
-    if st.session_state['dataframe_metadata'] is not None:
-        df = st.session_state['dataframe_metadata'].copy()
-    else:
-        df = pd.DataFrame([form_data], columns=[*form_data.keys()])
-        # New column
-        df['IdentifierAnalysis'] = None
-        df['Object/Sample'] = None
-        df['LocalisationAnalysis'] = None
-        # ordering
-        columns_order = ['IdentifierAnalysis', 'Object/Sample', 'LocalisationAnalysis', *form_data.keys()]
-        df = df[columns_order]
-        st.session_state.dataframe_metadata = df
-
-    edited_df = st.data_editor(df, num_rows="dynamic", hide_index=True)
-
-    # State saving
-    st.session_state['has_changes'] = st.session_state["dataframe_metadata"].equals(edited_df)
-
-    col4, col1, col2, col3 = st.columns([3, 1, 1, 9])
+    # the table is edited from the base table, the changes are read from the widget state
+    state = editor_state()
+    st.data_editor(state.base, num_rows="dynamic", hide_index=True, key=state.key)
+
+    # State saving (number of edits, not a comparison of the tables)
+    st.session_state['has_changes'] = state.is_dirty(st.session_state.get(state.key))
+
+    col4, col1, col2, col5, col6, col3 = st.columns([3, 1, 1, 1, 1, 7])
     with col2:
-        if st.button("Add row", on_click=add_row, args=(edited_df,), help="Add a row with experimental parameters"):
-            st.session_state["dataframe_metadata"] = edited_df
+        st.button("Add row", on_click=add_row, help="Add a row with experimental parameters")
     with col1:
-        if st.button("Save", type="primary", disabled=st.session_state['has_changes']):
-            st.session_state["dataframe_metadata"] = edited_df
+        if st.button("Save", type="primary", on_click=commit_changes, disabled=not st.session_state['has_changes']):
             st.toast("Changes saved successfully!", icon="✅")
-            st.rerun()
+    with col5:
+        st.button("↩️", on_click=undo_changes, disabled=not state.done, help="Undo")
+    with col6:
+        st.button("↪️", on_click=redo_changes, disabled=not state.undone, help="Redo")
+
+    bulk_editing(state.base)
 
 
 ### METADATA SAVING ###
@@ -273,9 +384,11 @@ if "selected_template" in st.session_state and os.path.exists(st.session_state["
                          disabled=not (st.session_state["submit_enabled"] and st.session_state["validation_error"])):
                 pass
 
+    # timings of the session (debug mode)
+    show_traces()
+
 # redirection empty templates
 else:
-    st.warning("Please select/upload a template on the first page.")
-    with st.spinner('Redirection'):
-        time.sleep(3)
+    # the warning is shown by the menu of the next page
+    st.session_state['redirect_message'] = "Please select/upload a template on the first page."
     st.switch_page("pages/1-select_template.py")
@@ -1,9 +1,9 @@
 import os
-from time import sleep
 import streamlit as st
 
 from utils.menu import menu
-from utils.manager import manage_temp_dir
+from utils.manager import manage_temp_dir, save_upload
+from utils.parser import prefetch
 
 st.title("Upload or Select preset/template")
 menu()
@@ -24,9 +24,9 @@ if option == "Upload experiment":
                                      accept_multiple_files=False)
     if uploaded_file is not None:
         st.session_state["selected_preset"] = os.path.join(templates_dir, uploaded_file.name)
-        # Save the uploaded file to the temporary directory
-        with open(st.session_state["selected_preset"], "wb") as f:
-            f.write(uploaded_file.getvalue())
+        # Save the uploaded file to the temporary directory, written aside then renamed: the table of the previous
+        # version of the preset can still be memory-mapped
+        save_upload(uploaded_file, st.session_state["selected_preset"])
         st.success("File uploaded successfully!")
         # re init
         st.session_state['metadata_base'] = None
@@ -36,9 +36,10 @@ if option == "Upload experiment":
         st.session_state["dataframe_metadata_edited"] = None
         # var
         st.session_state["preset_metadata"] = "preset_metadata_base"
+        st.session_state['preset_executed'] = False
         st.session_state.form_data = {}
-        # redirect
-        sleep(1.5)
+        # redirect, the preset being parsed meanwhile
+        prefetch(st.session_state["selected_preset"])
         st.switch_page("pages/4-metadata_management.py")
 elif option == "Select existing experiment":
     templates = os.listdir(templates_dir)
@@ -55,8 +56,10 @@ elif option == "Select existing experiment":
             # var
             st.session_state["selected_preset"] = os.path.join(templates_dir, selected_template)
             st.session_state["preset_metadata"] = "preset_metadata_base"
+            st.session_state['preset_executed'] = False
             st.session_state.form_data = {}
-            # redirect
+            # redirect, the preset being parsed meanwhile
+            prefetch(st.session_state["selected_preset"])
             st.switch_page("pages/4-metadata_management.py")
         except TypeError:
             st.warning("You need to select an experience")
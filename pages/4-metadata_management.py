@@ -1,18 +1,26 @@
-import copy
 import os
 import pandas as pd
-from pandas import Series as SeriesType
+import re
 import streamlit as st
-import time
 from datetime import datetime
 from streamlit_star_rating import st_star_rating
 from streamlit_tags import st_tags
 
-from models.forms import MetadataForms
-from models.technical import TechniqueOption, TECHNIQUES
-from utils.manager import generate_csv, zip_experience, files_management, convert_df
+from models.forms import MetadataForms, fragment, template_hash
+from models.technical import TechniqueOption, TECHNIQUES, DEFAULT_FILENAME_PATTERN
+from models.validator import validate_dataframe
+from utils.archive import COMPRESSIONS
+from utils.elablite import dump_elablite
+from utils.export import deduplicate, find_collisions, generate_filenames, generate_titles
+from utils.manager import create_export_file, remove_export
+from utils.mapping import compile_pattern, match_files
 from utils.menu import menu
 from utils.parser import TemplatesReader
+from utils.pipeline import BackgroundExport
+from utils.service import SERVICE_URL, download_archive, job_status, submit_job
+from utils.tracing import show_traces
+from utils.units import number_fields, typed_table, unit_column
+from utils.uploads import UploadStore
 
 ### BASIC ###
 
@@ -23,16 +31,23 @@ except KeyError:
     # Go to home if reload page or anything which delete selected_preset session
     st.switch_page("app.py")
 
-# Get preset
-metadata_base, form_data = reader.read_preset()
-if metadata_base is not None and form_data is not None:
-    st.session_state['metadata_base'] = metadata_base
-    st.session_state['form_data'] = form_data
+if not st.session_state.get('preset_executed', False):
+    # Get preset
+    metadata_base, form_data = reader.read_preset()
+    if metadata_base is not None and form_data is not None:
+        st.session_state['metadata_base'] = metadata_base
+        st.session_state['form_data'] = form_data
 
-dataframe_metadata = reader.read_dataframe()
-if dataframe_metadata is not None:
-    st.session_state['dataframe_metadata'] = dataframe_metadata
-del form_data, metadata_base, dataframe_metadata
+    dataframe_metadata = reader.read_dataframe()
+    if dataframe_metadata is not None:
+        # number fields of older presets are 'value||unit' strings, select fields are stored as categories
+        st.session_state['dataframe_metadata'] = typed_table(dataframe_metadata, reader.read_metadata())
+    del form_data, metadata_base, dataframe_metadata
+
+    # Set the flag to True after execution (files of a previous preset are dropped)
+    st.session_state['preset_executed'] = True
+    st.session_state['uploaded_files'] = UploadStore()
+    st.session_state['mapping_issues'] = None
 
 
 def step_metadata_base():
@@ -93,45 +108,80 @@ def step_metadata_forms():
     if "template_metadata" not in st.session_state:
         st.session_state["template_metadata"] = None
     st.header("Experiment Metadata Preset")
+    # the template is not modified by MetadataForms.generate_form(), no copy needed to save it in .elablite
     original_metadata = reader.read_metadata()
-    working_metadata = copy.deepcopy(original_metadata)
     try:
-        st.session_state['template_metadata'] = working_metadata
+        if st.session_state['template_metadata'] is not original_metadata:
+            # template loaded (the reader serves the same dictionary while the file is unchanged)
+            st.session_state['template_hash'] = template_hash(original_metadata.get('extra_fields', {}))
+        st.session_state['template_metadata'] = original_metadata
         with st.expander("General metadata preset", expanded=True):
-            st.session_state.required_form = []
+            st.session_state.required_form = {}
             MetadataForms.generate_form(st.session_state['template_metadata'], disabled=True)
             st.session_state["submit_enabled"] = True
     except Exception as e:
         st.error(f"Error: {e}")
-    # Re init without modification MetadataForms.generate_form()
-    # To save the good template in .elablite
-    st.session_state['template_metadata'] = original_metadata
 
 
 ### EDITING DATAFRAME FILE ###
 
-def display_file_metadata(filenames: list):
+def filename_pattern_input() -> str:
+    """
+        Input of the filename pattern of the technique (saved by technique code for the session).
+
+        Returns:
+        str: The pattern, or None if it is empty or invalid (the files are then mapped by containment only).
+    """
+    technical = st.session_state['metadata_base'].get('technical')
+    code = technical.code if technical is not None else None
+    # patterns edited by technique code, kept in the session only
+    patterns = st.session_state.setdefault('filename_patterns', {})
+    pattern = st.text_input("Filename pattern", value=patterns.get(code, DEFAULT_FILENAME_PATTERN),
+                            help="Regular expression with named groups matching the columns of the table, '_' "
+                                 "standing for '/' (e.g. `(?P<Object_Sample>...)` for 'Object/Sample'). Files not "
+                                 "following the pattern are mapped when they contain the identifier and the sample.")
+    if not pattern:
+        return None
+    try:
+        compile_pattern(pattern)
+    except re.error as e:
+        st.error(f"Invalid filename pattern: {e}")
+        return None
+    if code is not None:
+        patterns[code] = pattern
+    return pattern
+
+
+def display_file_metadata(new_filenames: list, remap: bool = False, pattern: str = None):
     """
-        Displays metadata for a list of filenames in a Streamlit data editor.
+        Displays metadata for the uploaded files in a Streamlit data editor. The mapping is updated incrementally:
+        only the rows without file are matched, against the newly uploaded files.
 
         Parameters:
-        filenames (list): A list of filenames for which metadata is to be displayed.
+        new_filenames (list): A list of newly uploaded filenames to map.
+        remap (bool): Map again all the rows against all the uploaded files (e.g. after files were removed).
+        pattern (str): Filename pattern with named groups, joined with the columns of the table.
 
         Returns:
         None
     """
 
     df = st.session_state['dataframe_metadata']
-
-    def find_filename(row):
-        """check and get filename corresponding to row"""
-        for filename in filenames:
-            if row['IdentifierAnalysis'] is not None and row['Object/Sample'] is not None:
-                if row['IdentifierAnalysis'] in filename and row['Object/Sample'] in filename:
-                    return filename
-        return None
-
-    df['Filename'] = df.apply(find_filename, axis=1)
+    if remap or 'Filename' not in df.columns:
+        df['Filename'] = None
+        new_filenames = list(st.session_state['uploaded_files'])
+
+    unmapped = df['Filename'].isna()
+    if new_filenames and unmapped.any():
+        report = match_files(df.loc[unmapped], new_filenames, pattern)
+        df.loc[list(report.matches), 'Filename'] = list(report.matches.values())
+        st.session_state['mapping_issues'] = report.issues()
+
+    # Issues reported in bulk
+    issues = st.session_state.get('mapping_issues')
+    if issues is not None and not issues.empty:
+        with st.expander(f"⚠️ {len(issues)} mapping issue(s)", expanded=False):
+            st.dataframe(issues, hide_index=True, use_container_width=True)
     # Filename first
     df = df[['Filename'] + [col for col in df.columns if col != 'Filename']]
 
@@ -141,7 +191,8 @@ def display_file_metadata(filenames: list):
 def step_metadata_files():
     """Step 3 page - Manage metadata with datafiles files"""
     if "uploaded_files" not in st.session_state:
-        st.session_state["uploaded_files"] = {}
+        # files above a threshold are spilled on disk, only handles are kept in session
+        st.session_state["uploaded_files"] = UploadStore()
 
     st.session_state["submit_enabled"] = True
 
@@ -158,62 +209,195 @@ Please note: If you change pages and wish to come back and modify the mapping or
 longer stored in memory. You'll have to redo this work
         """)
 
+    pattern = filename_pattern_input()
     uploaded_files = st.file_uploader("Upload Files", accept_multiple_files=True, key='upload_files')
 
+    # only the files added since the last rerun are read and mapped, an emptied uploader removes all the files
+    new_files, removed_files = st.session_state['uploaded_files'].sync(uploaded_files or [])
+    if not uploaded_files and removed_files and st.session_state.get('dataframe_metadata') is not None:
+        # no file left to map
+        st.session_state['dataframe_metadata']['Filename'] = None
+        st.session_state['mapping_issues'] = None
     if uploaded_files:
-        for uploaded_file in uploaded_files:
-            bytes_data = uploaded_file.read()
-            st.session_state['uploaded_files'][uploaded_file.name] = bytes_data
-        file_names = [file.name for file in uploaded_files]
+        # a new pattern maps again all the files
+        pattern_changed = st.session_state.get('mapping_pattern') != pattern
+        st.session_state['mapping_pattern'] = pattern
         st.subheader("Uploaded File Names")
-        display_file_metadata(file_names)
+        display_file_metadata([handle.name for handle in new_files], remap=bool(removed_files) or pattern_changed,
+                              pattern=pattern)
 
 
 ### DOWNLOAD PAGE ###
 
-def generate_filename(row: SeriesType, selected_columns: list) -> str:
+def generate_filename(df: pd.DataFrame, selected_columns: list) -> pd.Series:
     """
-        Generates a filename based on selected columns from a DataFrame row and adds a date prefix.
+        Generates the filenames based on selected columns of the DataFrame, with a date, technique and project prefix.
 
         Parameters:
-        row (pandas.Series): A row of data from a DataFrame.
+        df (pandas.DataFrame): The metadata DataFrame, with the column 'Filename'.
         selected_columns (list): A list of column names to be included in the filename.
 
         Returns:
-        str: The generated filename.
+        pandas.Series: The generated filenames.
     """
-    filename_parts = []
-    for col in selected_columns:
-        filename_parts.append(str(row[col]))
+    metadata_base = st.session_state['metadata_base']
+    return generate_filenames(df, selected_columns, date=metadata_base['date'].strftime('%Y%m%d'),
+                              code=metadata_base['technical'].code, shortname=metadata_base['project_shortname'])
 
-    _, extension = os.path.splitext(row['Filename'])
 
-    code = st.session_state['metadata_base']['technical'].code
-    date = st.session_state['metadata_base']['date'].strftime('%Y%m%d')
-    shortname = st.session_state['metadata_base']['project_shortname']
-    if shortname is not None:
-        new_filename = str(date) + "_" + code + "_" + shortname + "_" + "_".join(filename_parts) + extension
-    else:
-        new_filename = str(date) + "_" + code + "_" + "_".join(filename_parts) + extension
-    new_filename = new_filename.replace("||", "")
-    return new_filename.replace("__", "_")
+def check_collisions(df: pd.DataFrame, column: str, auto_suffix: bool) -> bool:
+    """
+    Checks that a column of names (filenames, titles) has no duplicate, which would overwrite files in the archive.
 
+    Parameters:
+    df (pandas.DataFrame): The metadata DataFrame, modified in place if the names are suffixed.
+    column (str): The column of names.
+    auto_suffix (bool): Suffix the duplicates (name_2, name_3, ...) instead of reporting them.
 
-def generate_newtitle(row: SeriesType, title: str) -> str:
+    Returns:
+    bool: True if the names are unique.
+    """
+    collisions = find_collisions(df[column])
+    if not collisions.any():
+        return True
+    if auto_suffix:
+        df[column] = deduplicate(df[column], extension=column == 'new_Filename')
+        st.toast(f"Duplicated '{column}' suffixed", icon='ℹ️')
+        return True
+    st.warning(f"{int(collisions.sum())} rows share the same '{column}'. Edit the table, select other columns or "
+               f"suffix the duplicates.")
+    st.dataframe(df.loc[collisions, [column]], use_container_width=True)
+    return False
+
+
+def remove_downloaded_export():
+    """Removes the archive of the session once downloaded (callback of the download button) or replaced"""
+    export_path = st.session_state.pop('export_path', None)
+    if export_path is not None:
+        remove_export(export_path)
+
+
+def download_export(export_path: str):
     """
-    Generates a new title based on conditions.
+    Download button of an export archive. Streamlit serves the download from memory, so the archive is read from the
+    file while the button is displayed, and the file is removed once the download is served (the exports left behind
+    are removed after MAX_EXPORT_AGE).
 
     Parameters:
-    row (pandas.Series): A row of data from the DataFrame.
-    title (str): The base title used for generating new titles.
+    export_path (str): Path of the archive.
+    """
+    if not os.path.exists(export_path):
+        st.session_state.pop('export_path', None)
+        return
+    with open(export_path, 'rb') as zip_file:
+        st.download_button(
+            label="Download Zip",
+            data=zip_file,
+            file_name=f"{datetime.today().strftime('%Y%m%d')}_experiences.zip",
+            mime="application/zip",
+            disabled=st.session_state["submit_enabled"],
+            on_click=remove_downloaded_export
+        )
+    st.caption(f"The archive ({os.path.getsize(export_path) / 1024 ** 2:.1f} MB) is held in the server memory to be "
+               f"downloaded: check the free memory of the server before exporting very large datasets.")
+
+
+def submit_export(df: pd.DataFrame, compression: str, compresslevel: int):
+    """
+    Submits the export to the export service (ELABLITE_SERVICE_URL): the table, already mapped and named, is saved
+    as a preset in its own export directory, removed when the job ends, and the uploaded files are handed over by path.
 
-    Returns:
-    str: A new title generated based on conditions.
+    Parameters:
+    df (pandas.DataFrame): The metadata DataFrame, with the columns 'Filename', 'new_title' and 'new_Filename'.
+    compression (str): Compression algorithm of the archive.
+    compresslevel (int): Compression level.
+    """
+    preset_path = create_export_file('preset.elablite')
+    st.session_state['export_preset'] = preset_path
+    with open(preset_path, 'wb') as preset_file:
+        preset_file.write(dump_elablite(metadata_base=st.session_state['metadata_base'],
+                                        form_data=st.session_state.get('form_data', {}),
+                                        template_metadata=st.session_state['template_metadata'],
+                                        dataframe_metadata=df))
+    try:
+        job = submit_job(SERVICE_URL, preset=preset_path, files=st.session_state["uploaded_files"].spill(),
+                         prepared=True, force=True, grouped=st.session_state["grouped_exp"],
+                         compression=compression, compresslevel=compresslevel)
+    except OSError as e:
+        remove_export_preset()
+        st.error(f"The export service is unavailable: {e}")
+        return
+    st.session_state['export_job'] = job['id']
+
+
+def remove_export_preset():
+    """Removes the preset read by the job of the export service, once the job has ended"""
+    preset_path = st.session_state.pop('export_preset', None)
+    if preset_path is not None:
+        remove_export(preset_path)
+
+
+def start_export(df: pd.DataFrame, compression: str, compresslevel: int):
+    """
+    Starts the export in a background thread, the page polling its progress (see export_progress).
+
+    Parameters:
+    df (pandas.DataFrame): The metadata DataFrame, with the columns 'Filename', 'new_title' and 'new_Filename'.
+    compression (str): Compression algorithm of the archive.
+    compresslevel (int): Compression level.
     """
-    if pd.notnull(row['IdentifierAnalysis']) or pd.notnull(row['Object/Sample']):
-        return f"{title} -- {row['IdentifierAnalysis']}_{row['Object/Sample']}"
-    else:
-        return f"{title} -- {row.name}"
+    export = BackgroundExport(df=df.copy(), metadata_base=st.session_state['metadata_base'],
+                              template_metadata=st.session_state['template_metadata'],
+                              files=st.session_state["uploaded_files"], grouped=st.session_state["grouped_exp"],
+                              output=create_export_file(), compression=compression, compresslevel=compresslevel)
+    export.start()
+    st.session_state['export_job'] = export
+
+
+def unit_errors_message(errors: list) -> str:
+    """Message of the cells whose value and unit can't be parsed"""
+    columns = sorted({col for _, col in errors})
+    return (f"Impossible to parse the value and its unit in {len(errors)} cell(s) of the column(s) "
+            f"{', '.join(repr(col) for col in columns)}. Please check your column content and don't use '||' "
+            f"in the unit appellation but like separator.")
+
+
+@fragment(run_every=1)
+def export_progress():
+    """
+    Progress of the export running in the background (thread of the session, or job of the export service), polled
+    every second without freezing the page. The page is rerun when the export ends, to serve the archive.
+    """
+    export = st.session_state['export_job']
+    local = isinstance(export, BackgroundExport)
+    try:
+        status = export.status() if local else job_status(SERVICE_URL, export)
+        if status['status'] in ('queued', 'running'):
+            label = f"{(status['stage'] or status['status']).capitalize()}..."
+            if status['total']:
+                label += f" {status['done']}/{status['total']}"
+            if status.get('bytes'):
+                label += f" ({status['bytes'] / 1024 ** 2:.1f} MB compressed)"
+            st.progress(status['done'] / status['total'] if status['total'] else 0., text=label)
+            return
+        if status['status'] == 'failed':
+            st.session_state['export_error'] = status['error']
+            if local:
+                remove_export(export.output)
+        else:
+            if local:
+                st.session_state['export_path'] = export.output
+                st.session_state['export_warnings'] = [unit_errors_message(export.errors)] if export.errors else []
+            else:
+                st.session_state['export_path'] = download_archive(SERVICE_URL, export, create_export_file())
+                st.session_state['export_warnings'] = status.get('warnings', [])
+            st.session_state["submit_enabled"] = False
+    except OSError as e:
+        st.session_state['export_error'] = f"The export service is unavailable: {e}"
+    if not local:
+        remove_export_preset()
+    st.session_state['export_job'] = None
+    st.rerun()
 
 
 def step_metadata_download():
@@ -227,17 +411,22 @@ def step_metadata_download():
     st.subheader("Preparing ...")
     df = st.session_state["dataframe_metadata_edited"]
     # Generate alternative titles non-bundled
-    df['new_title'] = df.apply(lambda x: generate_newtitle(x, st.session_state['metadata_base']['title']), axis=1)
+    df['new_title'] = generate_titles(df, st.session_state['metadata_base']['title'])
 
-    exclude_columns = ['Filename', 'new_title', 'new_Filename']
+    # the unit of a number field is appended to its value
+    exclude_columns = ['Filename', 'new_title', 'new_Filename',
+                       *(unit_column(name) for name in number_fields(st.session_state.get('template_metadata')))]
     selected_columns = st.multiselect("Select columns to include in filename (in order)",
                                       [col for col in df.columns.tolist() if col not in exclude_columns])
 
+    auto_suffix = st.toggle("Suffix duplicated names", value=True,
+                            help="Append _2, _3, ... to the files or experiments which would have the same name")
+
     col1, col2, col3 = st.columns([1, 7, 17])
     with col2:
         if st.button("Validation filename"):
             try:
-                df['new_Filename'] = df.apply(lambda x: generate_filename(x, selected_columns), axis=1)
+                df['new_Filename'] = generate_filename(df, selected_columns)
                 st.toast("Success!", icon='🎉')
                 st.session_state["filename_validated"] = True
                 with col3:
@@ -260,36 +449,46 @@ def step_metadata_download():
         """)
         st.session_state["grouped_exp"] = st.toggle('Grouping analysis ?',
                                                     help='Activate to group all analyses in one experience')
-
-        if st.button("Generate files", type='primary'):
-            with st.status("Generating data...") as status:
-                st.write("Generating CSV...")
-                csv_ = generate_csv(base_mtda=st.session_state['metadata_base'],
-                                    df_mtda=df,
-                                    grouped=st.session_state["grouped_exp"])
-                time.sleep(2)
-                st.write("Renaming files...")
-                uploaded_files_ = files_management(uploaded_files=st.session_state["uploaded_files"],
-                                                   df_mtda=df,
-                                                   grouped=st.session_state["grouped_exp"])
-                time.sleep(1)
-                st.write("Zipping...")
-                zip_buffer = zip_experience(csv_filename=csv_,
-                                            uploaded_files=uploaded_files_,
-                                            logs_process=convert_df(df),
-                                            grouped=st.session_state["grouped_exp"])
-                del uploaded_files_, csv_
-                time.sleep(2)
-                status.update(label="Process complete!", state="complete", expanded=False)
-                st.session_state["submit_enabled"] = False
-
-            st.download_button(
-                label="Download Zip",
-                data=zip_buffer.getvalue(),
-                file_name=f"{datetime.today().strftime('%Y%m%d')}_experiences.zip",
-                mime="application/zip",
-                disabled=st.session_state["submit_enabled"]
-            )
+        with st.popover("⚙️  Compression"):
+            compression = st.selectbox("Algorithm", COMPRESSIONS.keys(),
+                                       help="Already compressed files (JPEG, PNG, TIFF-LZW, zip, ...) are stored as is")
+            compresslevel = st.slider("Level", min_value=1, max_value=9, value=6,
+                                      disabled=compression in ('lzma', 'stored'))
+
+        # names checked in one pass before zipping (the same name would overwrite a file)
+        names_unique = True
+        if 'new_Filename' in df.columns:
+            names_unique = check_collisions(df, 'new_Filename', auto_suffix)
+        if not st.session_state["grouped_exp"]:
+            names_unique = check_collisions(df, 'new_title', auto_suffix) and names_unique
+
+        # the whole table is validated against the template before any CSV or zip work
+        report = validate_dataframe(df, st.session_state.get('template_metadata'))
+        table_valid = report.empty
+        if not table_valid:
+            st.warning(f"{len(report)} invalid cell(s) in the metadata table, in the column(s) "
+                       f"{', '.join(repr(col) for col in report['column'].unique())}.")
+            with st.expander("Validation report", expanded=False):
+                st.dataframe(report, hide_index=True, use_container_width=True)
+            table_valid = st.checkbox("Generate anyway", help="Export the table with its invalid cells")
+
+        exporting = bool(st.session_state.get('export_job'))
+        if st.button("Generate files", type='primary', disabled=not (names_unique and table_valid) or exporting):
+            # the archive is written in the background (export service if any, else a thread), polled below
+            remove_downloaded_export()
+            if SERVICE_URL:
+                submit_export(df, compression, compresslevel)
+            else:
+                start_export(df, compression, compresslevel)
+
+        if st.session_state.get('export_job'):
+            export_progress()
+        if st.session_state.get('export_error'):
+            st.error(f"Export failed: {st.session_state.pop('export_error')}")
+        for warning in st.session_state.pop('export_warnings', []):
+            st.warning(warning)
+        if st.session_state.get('export_path'):
+            download_export(st.session_state['export_path'])
 
 
 ### INTERN PAGE MANAGEMENT ###
@@ -361,9 +560,11 @@ if "selected_preset" in st.session_state and os.path.exists(st.session_state["se
                          disabled=not (st.session_state["submit_enabled"] and st.session_state["validation_error"])):
                 pass
 
+    # timings of the session (debug mode)
+    show_traces()
+
 # redirection empty templates
 else:
-    st.warning("Please select or upload a preset/template metadata")
-    with st.spinner('Redirection'):
-        time.sleep(3)
+    # the warning is shown by the menu of the next page
+    st.session_state['redirect_message'] = "Please select or upload a preset/template metadata"
     st.switch_page("pages/3-metadata_preset.py")
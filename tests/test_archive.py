@@ -0,0 +1,68 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from utils.archive import COMPRESSIONS, PrecompressedZipFile, compress_member, is_compressed, iter_compressed
+from utils.manager import zip_experience
+
+TEXT = b'Energy;Counts\n' + b''.join(b'%d;%d\n' % (n, n * n % 97) for n in range(20000))
+NOISE = os.urandom(200 * 1024)
+JPEG = b'\xff\xd8\xff\xe0' + os.urandom(1024)
+
+
+def test_is_compressed():
+    assert is_compressed('photo.JPG', b'')
+    assert is_compressed('photo.bin', JPEG[:64])
+    assert is_compressed('noise.bin', NOISE[:64 * 1024])
+    assert not is_compressed('spectrum.txt', TEXT[:64 * 1024])
+    assert not is_compressed('short.txt', b'\x00\x01')
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESSIONS))
+def test_precompressed_members(compression):
+    contents = {'spectra/a.txt': TEXT, 'spectra/noise.bin': NOISE, 'photos/b.jpg': JPEG, 'empty.txt': b''}
+    # file objects are read by chunks and closed once compressed
+    members = [(name, io.BytesIO(data) if name.endswith('.bin') else data) for name, data in contents.items()]
+    buffer = io.BytesIO()
+    with PrecompressedZipFile(buffer, 'w') as zip_file:
+        for zinfo, compressed in iter_compressed(members, COMPRESSIONS[compression], workers=2):
+            with compressed:
+                zip_file.write_precompressed(zinfo, compressed)
+
+    with zipfile.ZipFile(buffer) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == list(contents)
+        for name, data in contents.items():
+            assert zip_file.read(name) == data
+        assert zip_file.getinfo('spectra/a.txt').compress_type == COMPRESSIONS[compression]
+        assert zip_file.getinfo('spectra/noise.bin').compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo('photos/b.jpg').compress_type == zipfile.ZIP_STORED
+
+
+def test_compressed_sizes():
+    zinfo, compressed = compress_member('a.txt', TEXT, zipfile.ZIP_DEFLATED)
+    with compressed:
+        assert zinfo.file_size == len(TEXT)
+        assert zinfo.compress_size == len(compressed.read()) < len(TEXT)
+
+
+def test_zip_experience(tmp_path):
+    progress = []
+    uploaded_files = {'XRF1': {'a.txt': TEXT, 'b.jpg': JPEG}, 'XRF2': {'c.bin': io.BytesIO(NOISE)}}
+    output = str(tmp_path / 'experiences.zip')
+    archive = zip_experience(iter(['Title;Date\n', 'XRF;2024-01-01\n']), uploaded_files, iter(['a;b\n']), True,
+                             output=output, workers=2, progress=lambda *args: progress.append(args))
+    archive.close()
+
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('experiences.csv') == b'Title;Date\nXRF;2024-01-01\n'
+        assert zip_file.read('logs_process.csv') == b'a;b\n'
+        assert zip_file.read(os.path.join('XRF1', 'a.txt')) == TEXT
+        assert zip_file.read(os.path.join('XRF2', 'c.bin')) == NOISE
+        assert zip_file.read(os.path.join('XRF1', 'DATAFILE.txt')) == b'a.txt\nb.jpg'
+        assert zip_file.getinfo(os.path.join('XRF1', 'b.jpg')).compress_type == zipfile.ZIP_STORED
+    assert [done for done, total, _ in progress] == [1, 2, 3]
+    assert progress[-1][1] == 3
@@ -0,0 +1,121 @@
+import json
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from utils import parser
+from utils.cache import PARSED_SIZE_FACTOR, TemplatesCache, json_cost
+from utils.elablite import dump_elablite
+
+
+def write_template(path, content: dict):
+    path.write_text(json.dumps(content))
+    return str(path)
+
+
+@pytest.fixture
+def small_cache(monkeypatch):
+    cache = TemplatesCache(max_bytes=1024 ** 2, max_entries=8)
+    monkeypatch.setattr(parser, 'TEMPLATES_CACHE', cache)
+    return cache
+
+
+def test_parsed_once(tmp_path):
+    cache = TemplatesCache()
+    file_path = write_template(tmp_path / 'a.json', {'metadata': {}})
+    loads = []
+    loader = lambda path: loads.append(path) or {'parsed': len(loads)}
+    assert cache.get(file_path, loader) is cache.get(file_path, loader)
+    assert len(loads) == 1
+    # another kind of parsing of the same file
+    cache.get(file_path, loader, kind='other')
+    assert len(loads) == 2
+
+
+def test_modified_file_is_parsed_again(tmp_path):
+    cache = TemplatesCache()
+    file_path = write_template(tmp_path / 'a.json', {'metadata': {}})
+    assert cache.get(file_path, lambda path: 1) == 1
+    write_template(tmp_path / 'a.json', {'metadata': {'extra_fields': {}}})
+    assert cache.get(file_path, lambda path: 2) == 2
+    # the outdated version is dropped
+    assert len(cache._entries) == 1
+
+
+def test_budget_evicts_least_recently_used(tmp_path):
+    cache = TemplatesCache(max_bytes=300, max_entries=8)
+    paths = [write_template(tmp_path / f'{n}.json', {}) for n in range(3)]
+    for file_path in paths[:2]:
+        cache.get(file_path, lambda path: path, cost=lambda value: 100)
+    cache.get(paths[0], lambda path: None)
+    cache.get(paths[2], lambda path: path, cost=lambda value: 150)
+    assert [key[0] for key in cache._entries] == [os.path.realpath(paths[0]), os.path.realpath(paths[2])]
+    assert cache._size == 250
+
+
+def test_max_entries(tmp_path):
+    cache = TemplatesCache(max_entries=2)
+    for n in range(3):
+        cache.get(write_template(tmp_path / f'{n}.json', {}), lambda path: path)
+    assert len(cache._entries) == 2
+
+
+def test_cost(tmp_path):
+    cache = TemplatesCache(max_bytes=100)
+    file_path = write_template(tmp_path / 'a.json', {'padding': 'x' * 50})
+    # whole file by default
+    assert cache.get(file_path, lambda path: 'value') == 'value'
+    assert not cache._entries
+    cache.get(file_path, lambda path: 'value', kind='member', cost=lambda value: len(value))
+    assert cache._size == 5
+    assert json_cost({'a': 1}) == len('{"a": 1}') * PARSED_SIZE_FACTOR
+
+
+def write_eln(path, data_size: int):
+    """ELN archive of an experiment with an elabFTW export and a large data file"""
+    crate = {'@graph': [
+        {'@id': 'ro-crate-metadata.json', 'about': {'@id': './'}},
+        {'@id': './', '@type': 'Dataset', 'hasPart': [{'@id': './xrf/'}]},
+        {'@id': './xrf/', '@type': 'Dataset', 'name': 'XRF campaign',
+         'hasPart': [{'@id': './xrf/export-elabftw.json'}, {'@id': './xrf/data.bin'}]},
+    ]}
+    export = [{'metadata': json.dumps({'extra_fields': {'voltage': {'type': 'number', 'value': '40'}}})}]
+    with zipfile.ZipFile(path, 'w') as eln_file:
+        eln_file.writestr('export/ro-crate-metadata.json', json.dumps(crate))
+        eln_file.writestr('export/xrf/export-elabftw.json', json.dumps(export), zipfile.ZIP_DEFLATED)
+        eln_file.writestr('export/xrf/data.bin', os.urandom(data_size))
+    return str(path)
+
+
+def test_eln_reader(tmp_path, small_cache):
+    file_path = write_eln(tmp_path / 'export.eln', 1024)
+    reader = parser.ELNTemplatesReader(file_path)
+    assert reader.read_entries() == {'./xrf/': 'XRF campaign'}
+    assert reader.read_metadata() == {'extra_fields': {'voltage': {'type': 'number', 'value': '40'}}}
+
+
+def test_large_eln_is_cached(tmp_path, small_cache):
+    # the archive exceeds the budget, its metadata doesn't
+    file_path = write_eln(tmp_path / 'export.eln', 2 * small_cache.max_bytes)
+    metadata = parser.ELNTemplatesReader(file_path).read_metadata()
+    assert len(small_cache._entries) == 2
+    assert small_cache._size < 64 * 1024
+    reader = parser.ELNTemplatesReader(file_path)
+    assert reader.template is small_cache.get(file_path, None, kind='eln')
+    assert reader.read_metadata() is metadata
+
+
+def test_elablite_entries_charged_separately(tmp_path, small_cache):
+    table = pd.DataFrame({'IdentifierAnalysis': [f'XRF{n}' for n in range(1000)], 'Voltage': [40.0] * 1000})
+    file_path = tmp_path / 'preset.elablite'
+    # large uncompressible padding section: the file exceeds the budget, its header and table don't
+    file_path.write_bytes(dump_elablite({'title': 'T'}, {'padding': os.urandom(small_cache.max_bytes).hex() * 2}, {},
+                                        table))
+    reader = parser.ElabLiteTemplatesReader(str(file_path))
+    assert reader.read_metadata() == {}
+    pd.testing.assert_frame_equal(reader.read_dataframe(), table)
+    assert set(key[3] for key in small_cache._entries) == {'elablite', 'elablite:template_metadata',
+                                                           'elablite:table'}
+    assert small_cache._size < 256 * 1024
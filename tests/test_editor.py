@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.editor import Delta, EditorState, apply_to_rows, expand_identifiers, fill_down, generate_rows
+
+
+@pytest.fixture
+def table():
+    df = generate_rows({'voltage': 40.0, 'mode': 'air', 'tags': ['a', 'b'], 'operator': 'A. Martin'},
+                       identifiers=['XRF1', 'XRF2', 'XRF3', 'XRF4', 'XRF5'], selects={'mode': ['air', 'vacuum']})
+    df['voltage'] = df['voltage'].astype('float64')
+    df.loc[2, 'voltage'] = np.nan
+    return df
+
+
+def check_undo_redo(df: pd.DataFrame, *deltas: Delta):
+    """Applies the deltas, then checks that undo restores every state, dtypes included, and redo replays them"""
+    state = EditorState(df)
+    states = [state.base.copy()]
+    for delta in deltas:
+        state.commit(delta)
+        states.append(state.base.copy())
+    for expected in reversed(states[:-1]):
+        state.undo()
+        pd.testing.assert_frame_equal(state.base, expected)
+    for expected in states[1:]:
+        state.redo()
+        pd.testing.assert_frame_equal(state.base, expected)
+    return state
+
+
+def test_apply_to_rows(table):
+    delta = apply_to_rows(table, 1, 3, {'mode': 'helium', 'voltage': 35.0, 'tags': ['c'], 'missing': 1})
+    assert delta.ranges == [(1, 3, {'mode': 'helium', 'voltage': 35.0, 'tags': ['c']})]
+    assert len(delta) == 9
+    state = check_undo_redo(table, delta)
+    assert state.base['mode'].tolist() == ['air', 'helium', 'helium', 'helium', 'air']
+    assert isinstance(state.base['mode'].dtype, pd.CategoricalDtype)
+    assert state.base['voltage'].tolist() == [40.0, 35.0, 35.0, 35.0, 40.0]
+    assert state.base['tags'].tolist() == [['a', 'b'], ['c'], ['c'], ['c'], ['a', 'b']]
+
+
+def test_apply_to_rows_out_of_range(table):
+    assert apply_to_rows(table, 4, 10, {'voltage': 1.0}).ranges == [(4, 4, {'voltage': 1.0})]
+    assert not len(apply_to_rows(table, 6, 10, {'voltage': 1.0}))
+    assert not len(apply_to_rows(table, 0, 4, {'missing': 1.0}))
+
+
+def test_value_not_fitting_the_dtype(table):
+    state = check_undo_redo(table, apply_to_rows(table, 0, 1, {'voltage': 'high'}))
+    assert state.base['voltage'].tolist()[:2] == ['high', 'high']
+
+
+def test_fill_down(table):
+    state = check_undo_redo(table, fill_down(table, ['voltage', 'mode'], 2, 4))
+    assert state.base['voltage'].isna().tolist() == [False, False, True, True, True]
+
+
+def test_editor_changes(table):
+    added = pd.DataFrame([{'IdentifierAnalysis': 'XRF6', 'mode': 'argon', 'voltage': 20.0}], columns=table.columns)
+    state = check_undo_redo(
+        table,
+        Delta(patches={0: {'mode': 'vacuum', 'operator': 'B. Durand'}, 4: {'voltage': 50.0}}, deleted=[1, 3]),
+        Delta(added=added),
+        apply_to_rows(table, 0, 2, {'mode': 'neon'}),
+    )
+    assert state.base['IdentifierAnalysis'].tolist() == ['XRF1', 'XRF3', 'XRF5', 'XRF6']
+    assert state.base['mode'].tolist() == ['neon', 'neon', 'neon', 'argon']
+
+
+def test_expand_identifiers():
+    assert expand_identifiers('XRF{0001..0003}') == ['XRF0001', 'XRF0002', 'XRF0003']
+    assert expand_identifiers('XRF{1..2}-{a,b}') == ['XRF1-a', 'XRF1-b', 'XRF2-a', 'XRF2-b']
+    assert expand_identifiers('XRF', 2) == ['XRF0001', 'XRF0002']
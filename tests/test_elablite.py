@@ -0,0 +1,90 @@
+from datetime import date, datetime
+
+import dill
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import elablite
+
+METADATA_BASE = {'title': 'XRF campaign', 'date': date(2024, 1, 1)}
+FORM_DATA = {'operator': 'A. Martin', 'start': datetime(2024, 1, 1, 9, 30), 'tags': ['xrf', 'paint']}
+TEMPLATE = {'extra_fields': {'operator': {'type': 'text'}}}
+
+
+@pytest.fixture
+def table():
+    return pd.DataFrame({
+        'IdentifierAnalysis': ['XRF1', 'XRF2', 'XRF3', 'XRF4'],
+        'Technique': pd.Categorical(['XRF', 'XRF', None, 'XRF'], categories=['XRF', 'RAMAN']),
+        'Voltage': [40.0, 40.0, np.nan, 35.0],
+        'Spots': [1, 2, 3, 4],
+        'Operator': ['A. Martin', 'A. Martin', 'A. Martin', 'B. Durand'],
+        'Comment': [None, None, 'cracked', None],
+        'Date': pd.to_datetime(['2024-01-01', '2024-01-02', None, '2024-01-04']),
+        'Day': [date(2024, 1, 1)] * 3 + [date(2024, 1, 2)],
+    })
+
+
+def write(path, table):
+    path.write_bytes(elablite.dump_elablite(METADATA_BASE, FORM_DATA, TEMPLATE, table))
+    return str(path)
+
+
+def test_encodings(tmp_path, table):
+    header = elablite.read_header(write(tmp_path / 'preset.elablite', table))
+    encodings = {column['name']: column['encoding'] for column in header['table']['columns']}
+    assert encodings == {'IdentifierAnalysis': 'json', 'Technique': 'category', 'Voltage': 'npy', 'Spots': 'npy',
+                         'Operator': 'sparse', 'Comment': 'sparse', 'Date': 'json', 'Day': 'sparse'}
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip(tmp_path, table, mmap):
+    file_path = write(tmp_path / 'preset.elablite', table)
+    header = elablite.read_header(file_path)
+    assert elablite.read_section(file_path, 'metadata_base') == METADATA_BASE
+    assert elablite.read_section(file_path, 'form_data') == FORM_DATA
+    assert elablite.read_section(file_path, 'template_metadata') == TEMPLATE
+    # the memory-mapped columns are read-only views of the file
+    pd.testing.assert_frame_equal(elablite.read_table(file_path, header, mmap=mmap).copy(), table)
+
+
+def test_nullable_columns(tmp_path):
+    table = pd.DataFrame({'Spots': pd.array([1, None, 3, 4], dtype='Int64'),
+                          'Checked': pd.array([True, None, False, True], dtype='boolean'),
+                          'Voltage': pd.array([40.0, 40.0, 40.0, None], dtype='Float64')})
+    file_path = write(tmp_path / 'preset.elablite', table)
+    pd.testing.assert_frame_equal(elablite.read_table(file_path, elablite.read_header(file_path)), table)
+
+
+def test_index_is_kept(tmp_path, table):
+    table.index = [10, 11, 12, 13]
+    file_path = write(tmp_path / 'preset.elablite', table)
+    pd.testing.assert_frame_equal(elablite.read_table(file_path, elablite.read_header(file_path)).copy(), table)
+
+
+def test_without_table(tmp_path):
+    file_path = write(tmp_path / 'preset.elablite', None)
+    assert elablite.read_table(file_path, elablite.read_header(file_path)) is None
+
+
+def test_v1_upgrade(tmp_path, table):
+    v1_path = tmp_path / 'v1.elablite'
+    # v1 saves were written with dill, their tables reference dill types
+    v1_path.write_bytes(dill.dumps({'@context': elablite.CONTEXT_V1, 'metadata_base': METADATA_BASE,
+                                    'form_data': FORM_DATA, 'template_metadata': TEMPLATE,
+                                    'dataframe_metadata': table}))
+    assert elablite.is_v1(str(v1_path))
+    data = elablite.load_v1(str(v1_path))
+    pd.testing.assert_frame_equal(data['dataframe_metadata'], table)
+
+    file_path = write(tmp_path / 'v2.elablite', data['dataframe_metadata'])
+    assert not elablite.is_v1(file_path)
+    pd.testing.assert_frame_equal(elablite.read_table(file_path, elablite.read_header(file_path)).copy(), table)
+
+
+def test_v1_invalid_context(tmp_path):
+    v1_path = tmp_path / 'v1.elablite'
+    v1_path.write_bytes(dill.dumps({'@context': 'http://example.org/other'}))
+    with pytest.raises(IOError):
+        elablite.load_v1(str(v1_path))
@@ -0,0 +1,117 @@
+import copy
+import csv
+import io
+import json
+
+import pandas as pd
+import pytest
+
+from utils.export import generate_filenames, generate_titles, iter_csv
+from utils.units import number_text, typed_table
+
+TEMPLATE = {'extra_fields': {'Voltage': {'type': 'number', 'unit': 'kV', 'units': ['kV', 'V']}}}
+BASE = {'date': '2024-01-01', 'title': 'XRF campaign', 'commentary': '', 'rating': 0, 'tags': ['xrf']}
+
+
+@pytest.fixture
+def legacy():
+    return pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF2'], 'Voltage': ['40||kV', '40.5||V'],
+                         'Filename': ['a.txt', 'b.txt'], 'new_title': ['T -- XRF1', 'T -- XRF2']})
+
+
+def baseline_csv(base_mtda: dict, df_mtda: pd.DataFrame, template_metadata: dict, grouped: bool) -> str:
+    """CSV of the row by row serialization of the previous versions (generate_csv)"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['date', 'title', 'body', 'rating', 'metadata', 'tags'])
+    writer.writeheader()
+    metadata = copy.deepcopy(template_metadata)
+    # rows of object cells, as in pandas 2
+    rows = df_mtda.astype(object).to_dict('records')
+    for row in rows[:1] if grouped else rows:
+        for col in df_mtda.columns:
+            if col in metadata['extra_fields']:
+                if metadata['extra_fields'][col]['type'] == 'number':
+                    value, unit = row[col].split('||')
+                    metadata['extra_fields'][col]['value'] = value
+                    metadata['extra_fields'][col]['unit'] = unit
+                else:
+                    metadata['extra_fields'][col]['value'] = row[col]
+        if not grouped:
+            metadata['extra_fields']["Filename"] = {"type": "text", "value": row.get('new_Filename', row['Filename']),
+                                                    "position": 1000}
+        writer.writerow({'date': base_mtda['date'], 'title': base_mtda['title'] if grouped else row['new_title'],
+                         'body': base_mtda['commentary'], 'rating': base_mtda['rating'],
+                         'metadata': json.dumps(metadata), 'tags': "|".join(base_mtda['tags'])})
+    return buffer.getvalue()
+
+
+def read_fields(chunks) -> list:
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    return [json.loads(row['metadata'])['extra_fields']['Voltage'] for row in rows]
+
+
+@pytest.mark.parametrize('grouped', [False, True])
+def test_csv_as_baseline(grouped):
+    template = {'extra_fields': {'Voltage': {'type': 'number', 'unit': 'kV', 'units': ['kV', 'V']},
+                                 'Operator': {'type': 'text', 'value': ''},
+                                 'Mode': {'type': 'select', 'options': ['air', 'vacuum'], 'value': 'air'}},
+                'elabftw': {'extra_fields_groups': [{'id': 1, 'name': 'XRF'}]}}
+    df = pd.DataFrame({'IdentifierAnalysis': [f'XRF{n}' for n in range(7)],
+                       'Voltage': [f'{40 + n / 2}||kV' for n in range(7)],
+                       # object column as read by pandas 2 (missing cell None, not NaN)
+                       'Operator': pd.Series(['A. "Martin", Jr', 'B. Durand\nLab', None, 'é', '', 'x', 'y'],
+                                             dtype=object),
+                       'Mode': ['air', 'vacuum'] * 3 + ['air'],
+                       'Filename': [f'{n}.txt' for n in range(7)],
+                       'new_Filename': [f'new_{n}.txt' for n in range(7)],
+                       'new_title': [f'T -- XRF{n}' for n in range(7)]})
+    errors = []
+    # chunks smaller than the table
+    chunks = list(iter_csv(BASE, df, template, grouped, errors=errors, chunk_rows=3))
+    assert ''.join(chunks) == baseline_csv(BASE, df, template, grouped)
+    assert not errors
+    # the template is not modified
+    assert 'value' not in template['extra_fields']['Voltage']
+
+
+def test_csv_unit_errors(legacy):
+    legacy.loc[1, 'Voltage'] = '40 kV'
+    errors = []
+    fields = read_fields(iter_csv(BASE, legacy, TEMPLATE, grouped=False, errors=errors))
+    assert errors == [(1, 'Voltage')]
+    # the cell is exported as is with the default unit
+    assert (fields[1]['value'], fields[1]['unit']) == ('40 kV', 'kV')
+
+
+def test_empty_table(legacy):
+    assert ''.join(iter_csv(BASE, legacy.iloc[:0], TEMPLATE, grouped=False)) == baseline_csv(BASE, legacy.iloc[:0],
+                                                                                              TEMPLATE, False)
+
+
+def test_number_text():
+    numbers = pd.Series([40.0, 40.5, None, -3.0, 1e20, 0.1])
+    assert number_text(numbers).tolist() == ['40', '40.5', None, '-3', '1e+20', '0.1']
+
+
+def test_typed_numbers_exported_as_typed(legacy):
+    typed = typed_table(legacy, TEMPLATE)
+    assert typed['Voltage'].dtype == 'float64'
+    fields = read_fields(iter_csv(BASE, typed, TEMPLATE, grouped=False))
+    assert [(field['value'], field['unit']) for field in fields] == [('40', 'kV'), ('40.5', 'V')]
+    # same cells as the legacy 'value||unit' strings
+    assert fields == read_fields(iter_csv(BASE, legacy, TEMPLATE, grouped=False))
+
+
+def test_typed_numbers_in_filenames(legacy):
+    columns = ['IdentifierAnalysis', 'Voltage']
+    names = generate_filenames(typed_table(legacy, TEMPLATE), columns, date='20240101', code='XRF')
+    assert names.tolist() == ['20240101_XRF_XRF1_40kV.txt', '20240101_XRF_XRF2_40.5V.txt']
+    assert names.equals(generate_filenames(legacy, columns, date='20240101', code='XRF'))
+
+
+def test_missing_cells_in_titles_and_filenames():
+    df = pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF2', None], 'Object/Sample': [None, 'S2', None],
+                       'Voltage': [40.0, None, 35.0], 'Filename': ['a.txt', 'b.txt', 'c.txt']})
+    assert generate_titles(df, 'T').tolist() == ['T -- XRF1_None', 'T -- XRF2_S2', 'T -- 2']
+    names = generate_filenames(df, ['IdentifierAnalysis', 'Voltage'], date='20240101', code='XRF')
+    assert names.tolist() == ['20240101_XRF_XRF1_40.txt', '20240101_XRF_XRF2_None.txt', '20240101_XRF_None_35.txt']
@@ -0,0 +1,60 @@
+import pandas as pd
+import pytest
+
+from utils.mapping import AhoCorasick, FilenameMatcher, PatternMatcher, match_files
+
+PATTERN = r'^(?P<IdentifierAnalysis>XRF\d+)_(?P<Object_Sample>[^_.]+)'
+
+
+@pytest.fixture
+def table():
+    return pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF10', 'XRF2', 'XRF3'],
+                         'Object/Sample': ['S1', 'S1', 'S2', 'S3']})
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick(['XRF1', 'XRF10', 'RF1', 'S1'])
+    assert automaton.find('XRF10_S1.txt') == ['XRF1', 'RF1', 'XRF10', 'S1']
+    assert automaton.find('nothing.txt') == []
+
+
+def test_longest_identifier_is_preferred(table):
+    report = FilenameMatcher(table).match(['XRF10_S1.txt', 'XRF1_S1.txt'])
+    assert report.matches == {1: 'XRF10_S1.txt', 0: 'XRF1_S1.txt'}
+    assert not report.ambiguous_files and not report.ambiguous_rows
+
+
+def test_unmatched_files_and_rows(table):
+    report = FilenameMatcher(table).match(['XRF2_S2.txt', 'XRF2_S9.txt', 'notes.txt'])
+    assert report.matches == {2: 'XRF2_S2.txt'}
+    assert report.unmatched_files == ['XRF2_S9.txt', 'notes.txt']
+    assert report.unmatched_rows == [0, 1, 3]
+
+
+def test_ambiguous_rows_map_the_first_file(table):
+    report = FilenameMatcher(table).match(['XRF3_S3_a.txt', 'XRF3_S3_b.txt'])
+    assert report.matches[3] == 'XRF3_S3_a.txt'
+    assert report.ambiguous_rows == {3: ['XRF3_S3_a.txt', 'XRF3_S3_b.txt']}
+    issues = report.issues()
+    assert issues['issue'].tolist() == ['Several files for one row']
+
+
+def test_ambiguous_files():
+    df = pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF1'], 'Object/Sample': ['S1', 'S1']})
+    report = FilenameMatcher(df).match(['XRF1_S1.txt'])
+    assert report.ambiguous_files == {'XRF1_S1.txt': [0, 1]}
+    assert report.matches == {0: 'XRF1_S1.txt', 1: 'XRF1_S1.txt'}
+
+
+def test_pattern_joins_the_named_groups(table):
+    report = PatternMatcher(PATTERN).match(table, ['XRF1_S1.txt', 'XRF10_S1.txt', 'XRF2_S1.txt'])
+    assert report.matches == {0: 'XRF1_S1.txt', 1: 'XRF10_S1.txt'}
+    assert report.unmatched_files == ['XRF2_S1.txt']
+    assert report.unmatched_rows == [2, 3]
+
+
+def test_match_files_falls_back_on_containment(table):
+    report = match_files(table, ['XRF1_S1.txt', 'scan-XRF2-S2.txt'], PATTERN)
+    assert report.matches == {0: 'XRF1_S1.txt', 2: 'scan-XRF2-S2.txt'}
+    assert report.unmatched_files == []
+    assert report.unmatched_rows == [1, 3]
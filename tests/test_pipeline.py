@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+import os
+import zipfile
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import cli
+from models.technical import TECHNIQUES
+from utils.elablite import dump_elablite
+from utils.pipeline import Job, run_job
+
+TEMPLATE = {'extra_fields': {'Voltage': {'type': 'number', 'unit': 'kV', 'units': ['kV', 'V']},
+                             'mode': {'type': 'select', 'options': ['air', 'vacuum']}}}
+TABLE = pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF2', 'XRF3'], 'Object/Sample': ['S1', 'S1', 'S2'],
+                      'Voltage': ['40||kV', '12||V', '40||kV'], 'mode': ['air', 'vacuum', 'air']})
+METADATA_BASE = {'date': date(2024, 1, 1), 'title': 'XRF campaign', 'technical': TECHNIQUES['XRF'],
+                 'project_shortname': None, 'commentary': 'notes', 'rating': 3, 'tags': ['xrf']}
+
+
+@pytest.fixture
+def files(tmp_path):
+    directory = tmp_path / 'files'
+    directory.mkdir()
+    for name in ['XRF1_S1.txt', 'XRF2_S1.txt', 'XRF3_S2.txt', 'notes.txt', '.hidden']:
+        (directory / name).write_text(f'spectrum of {name}')
+    return str(directory)
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / 'xrf.json'
+    path.write_text(json.dumps({'metadata': json.dumps(TEMPLATE)}))
+    return str(path)
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = tmp_path / 'metadata.csv'
+    TABLE.to_csv(path, index=False)
+    return str(path)
+
+
+def write_preset(path, df: pd.DataFrame = TABLE) -> str:
+    path.write_bytes(dump_elablite(METADATA_BASE, {}, TEMPLATE, df))
+    return str(path)
+
+
+def read_experiences(output: str) -> list:
+    with zipfile.ZipFile(output) as zip_file:
+        return list(csv.DictReader(io.StringIO(zip_file.read('experiences.csv').decode('utf-8'))))
+
+
+def test_template_job(tmp_path, files, template, table):
+    output = str(tmp_path / 'out' / 'metadata.zip')
+    result = run_job(Job(files=files, output=output, template=template, table=table, metadata_base=METADATA_BASE,
+                         columns=['IdentifierAnalysis', 'Voltage']))
+    assert result.ok, result.error
+    assert (result.output, result.rows, result.files) == (output, 3, 3)
+    assert result.warnings == ['1 file(s) mapped to no row']
+
+    rows = read_experiences(output)
+    assert [row['title'] for row in rows] == ['XRF campaign -- XRF1_S1', 'XRF campaign -- XRF2_S1',
+                                              'XRF campaign -- XRF3_S2']
+    fields = [json.loads(row['metadata'])['extra_fields'] for row in rows]
+    assert [(field['Voltage']['value'], field['Voltage']['unit']) for field in fields] == [('40', 'kV'), ('12', 'V'),
+                                                                                          ('40', 'kV')]
+    # named as the files renamed by page 4: date_code_columns.extension
+    new_names = ['20240101_XRF_XRF1_40kV.txt', '20240101_XRF_XRF2_12V.txt', '20240101_XRF_XRF3_40kV.txt']
+    assert [field['Filename']['value'] for field in fields] == new_names
+    with zipfile.ZipFile(output) as zip_file:
+        originals = ['XRF1_S1.txt', 'XRF2_S1.txt', 'XRF3_S2.txt']
+        for title, name, original in zip([row['title'] for row in rows], new_names, originals):
+            assert zip_file.read(os.path.join(title, name)) == f'spectrum of {original}'.encode()
+
+
+def test_preset_job(tmp_path, files):
+    output = str(tmp_path / 'preset.zip')
+    result = run_job(Job(files=files, output=output, preset=write_preset(tmp_path / 'preset.elablite'), grouped=True))
+    assert result.ok, result.error
+    rows = read_experiences(output)
+    assert len(rows) == 1 and rows[0]['title'] == 'XRF campaign'
+    with zipfile.ZipFile(output) as zip_file:
+        # without columns, all the files are bundled with their names
+        assert zip_file.read(os.path.join('data', 'DATAFILE.txt')).split(b'\n') == [b'XRF1_S1.txt', b'XRF2_S1.txt',
+                                                                                     b'XRF3_S2.txt', b'notes.txt']
+
+
+def test_unmatched_rows(tmp_path, files):
+    df = pd.concat([TABLE, TABLE.iloc[:1].assign(IdentifierAnalysis='XRF9')], ignore_index=True)
+    job = Job(files=files, output=str(tmp_path / 'a.zip'), preset=write_preset(tmp_path / 'preset.elablite', df))
+    result = run_job(job)
+    assert not result.ok and result.error == 'ValueError: 1 row(s) without file, e.g. row 3'
+    assert not os.path.exists(job.output)
+    job.skip_unmatched = True
+    assert run_job(job).rows == 3
+
+
+def test_invalid_cells(tmp_path, files):
+    df = TABLE.assign(mode=['air', 'helium', 'air'])
+    job = Job(files=files, output=str(tmp_path / 'a.zip'), preset=write_preset(tmp_path / 'preset.elablite', df))
+    assert run_job(job).error == "ValueError: 1 invalid cell(s) in the column(s) 'mode'"
+    job.force = True
+    result = run_job(job)
+    assert result.ok and result.warnings[-1] == "1 invalid cell(s) in the column(s) 'mode'"
+
+
+def test_duplicated_names(tmp_path, files):
+    job = Job(files=files, output=str(tmp_path / 'a.zip'), preset=write_preset(tmp_path / 'preset.elablite'),
+              columns=['Voltage'])
+    result = run_job(job)
+    assert result.ok
+    names = [json.loads(row['metadata'])['extra_fields']['Filename']['value'] for row in read_experiences(job.output)]
+    assert names == ['20240101_XRF_40kV.txt', '20240101_XRF_12V.txt', '20240101_XRF_40kV_2.txt']
+    job.auto_suffix = False
+    assert run_job(job).error == "ValueError: 2 rows share the same 'new_Filename'"
+
+
+def test_build_jobs(tmp_path, files, template, table):
+    os.makedirs(os.path.join(files, 'runA'))
+    presets = [write_preset(tmp_path / 'runA.elablite'), write_preset(tmp_path / 'runB.elablite')]
+    args = cli.parse_args([*presets, '--files', files, '--output', str(tmp_path / 'out'), '--template', template,
+                           '--table', table, '--title', 'T', '--code', 'XRF', '--date', '2024-01-01', '--grouped',
+                           '--columns', 'Voltage', '--processes', '2'])
+    jobs = cli.build_jobs(args)
+    assert [job.name for job in jobs] == ['runA.elablite', 'runB.elablite', 'metadata.csv']
+    # files of a preset in its subdirectory, if any
+    assert [job.files for job in jobs] == [os.path.join(files, 'runA'), files, files]
+    assert [job.output for job in jobs] == [str(tmp_path / 'out' / f'{name}.zip')
+                                            for name in ['runA', 'runB', 'metadata']]
+    assert all(job.grouped and job.columns == ['Voltage'] for job in jobs)
+    assert jobs[2].metadata_base['technical'] is TECHNIQUES['XRF']
+    assert jobs[2].metadata_base['date'] == date(2024, 1, 1)
+
+
+def test_parse_args_needs_presets_or_template():
+    with pytest.raises(SystemExit):
+        cli.parse_args(['--files', '.', '--template', 'xrf.json'])
+
+
+def test_main(tmp_path, files, template, table, caplog):
+    argv = ['--files', files, '--output', str(tmp_path / 'out'), '--template', template, '--table', table,
+            '--title', 'T', '--code', 'XRF', '--processes', '1']
+    assert cli.main(argv) == 0
+    assert os.path.exists(tmp_path / 'out' / 'metadata.zip')
+    assert cli.main([*argv, '--no-suffix', '--columns', 'Object/Sample']) == 1
+    assert "rows share the same 'new_Filename'" in caplog.text
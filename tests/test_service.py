@@ -0,0 +1,112 @@
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date
+from http.server import ThreadingHTTPServer
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+
+import pandas as pd
+import pytest
+
+from models.technical import TECHNIQUES
+from utils import service
+from utils.elablite import dump_elablite
+
+TEMPLATE = {'extra_fields': {'Voltage': {'type': 'number', 'unit': 'kV', 'units': ['kV', 'V']}}}
+METADATA_BASE = {'date': date(2024, 1, 1), 'title': 'XRF campaign', 'technical': TECHNIQUES['XRF'],
+                 'project_shortname': None, 'commentary': '', 'rating': 0, 'tags': []}
+
+
+@pytest.fixture
+def service_url(monkeypatch, tmp_path):
+    """Export service on a free port, its token file in a tmp dir of the test"""
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(service, 'SERVICE_TOKEN', None)
+    server = ThreadingHTTPServer((service.HOST, 0), service.ServiceHandler)
+    server.token = service.write_token(server.server_port)
+    server.service = service.ExportService(directory=str(tmp_path / 'archives'), processes=1, max_pending=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://{service.HOST}:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+    server.service.shutdown()
+
+
+@pytest.fixture
+def job_fields(tmp_path):
+    files = tmp_path / 'files'
+    files.mkdir()
+    for name in ['XRF1_S1.txt', 'XRF2_S1.txt']:
+        (files / name).write_text(name)
+    table = pd.DataFrame({'IdentifierAnalysis': ['XRF1', 'XRF2'], 'Object/Sample': ['S1', 'S1'],
+                          'Voltage': ['40||kV', '12||V']})
+    preset = tmp_path / 'preset.elablite'
+    preset.write_bytes(dump_elablite(METADATA_BASE, {}, TEMPLATE, table))
+    return {'preset': str(preset), 'files': str(files), 'columns': ['Voltage']}
+
+
+def http_status(url: str, method: str = 'GET', headers: dict = None, data: bytes = None) -> int:
+    try:
+        with urlrequest.urlopen(urlrequest.Request(url, data=data, method=method, headers=headers or {})) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+def wait(service_url: str, job_id: str) -> dict:
+    for _ in range(200):
+        status = service.job_status(service_url, job_id)
+        if status['status'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_token(service_url):
+    token_file = service.token_path(int(service_url.rsplit(':', 1)[1]))
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+    assert service.read_token(service_url)
+    headers = {'Authorization': 'Bearer wrong'}
+    assert http_status(f"{service_url}/health", headers=headers) == 401
+    assert http_status(f"{service_url}/health") == 401
+    assert http_status(f"{service_url}/jobs", 'POST', headers, b'{}') == 401
+    assert http_status(f"{service_url}/health", headers=service._headers(service_url)) == 200
+
+
+def test_invalid_requests(service_url):
+    headers = service._headers(service_url)
+    assert http_status(f"{service_url}/jobs", 'POST', {**headers, 'Content-Type': 'text/plain'}, b'{}') == 415
+    assert http_status(f"{service_url}/jobs", 'POST', headers, json.dumps([1]).encode()) == 400
+    assert http_status(f"{service_url}/jobs", 'POST', headers, json.dumps({'unknown': 1}).encode()) == 400
+    assert http_status(f"{service_url}/jobs/{'0' * 32}", headers=headers) == 404
+    assert http_status(f"{service_url}/other", headers=headers) == 404
+
+
+def test_job(service_url, job_fields, tmp_path):
+    job = service.submit_job(service_url, **job_fields)
+    assert job['status'] == 'queued' and job['name'] == 'preset.elablite'
+    status = wait(service_url, job['id'])
+    assert status['status'] == 'done', status.get('error')
+    assert (status['rows'], status['files'], status['warnings']) == (2, 2, [])
+
+    path = service.download_archive(service_url, job['id'], str(tmp_path / 'experiences.zip'))
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.read(os.path.join('XRF campaign -- XRF1_S1', '20240101_XRF_40kV.txt')) == b'XRF1_S1.txt'
+    # the job is forgotten with its archive once downloaded
+    assert http_status(f"{service_url}/jobs/{job['id']}", headers=service._headers(service_url)) == 404
+    assert not os.listdir(tmp_path / 'archives')
+
+
+def test_failed_job(service_url, job_fields):
+    job = service.submit_job(service_url, **{**job_fields, 'files': {}})
+    status = wait(service_url, job['id'])
+    assert status['status'] == 'failed'
+    assert status['error'].startswith('ValueError: 2 row(s) without file')
+    # no archive to download
+    assert http_status(f"{service_url}/jobs/{job['id']}/archive", headers=service._headers(service_url)) == 409
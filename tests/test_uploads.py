@@ -0,0 +1,99 @@
+import gc
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+
+import pytest
+
+from utils.manager import zip_experience
+from utils.uploads import UploadStore
+
+SMALL = b'Energy;Counts\n1;2\n'
+LARGE = os.urandom(300 * 1024)
+
+
+class UploadedFile(io.BytesIO):
+    """Uploaded file of a streamlit uploader, counting its reads"""
+
+    def __init__(self, name: str, data: bytes, file_id: str = None):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+        self.file_id = file_id or name
+        self.reads = 0
+
+    def read(self, *args):
+        self.reads += 1
+        return super().read(*args)
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return UploadStore(threshold=64 * 1024)
+
+
+def test_spill(store):
+    small = store.add('a.txt', UploadedFile('a.txt', SMALL))
+    large = store.add('b.bin', UploadedFile('b.bin', LARGE))
+    assert small.path is None and small.data == SMALL
+    assert large.data is None and os.path.dirname(large.path) == store.directory
+    assert large.read() == LARGE
+    assert (large.size, large.digest) == (len(LARGE), hashlib.sha256(LARGE).hexdigest())
+    # same content as read from the uploader
+    assert {name: store[name].read() for name in store} == {'a.txt': SMALL, 'b.bin': LARGE}
+
+
+def test_sync_reads_each_file_once(store):
+    files = [UploadedFile('a.txt', SMALL), UploadedFile('b.bin', LARGE)]
+    new, removed = store.sync(files)
+    assert [handle.name for handle in new] == ['a.txt', 'b.bin'] and not removed
+    reads = [file.reads for file in files]
+    # rerun with the same files
+    assert store.sync(files) == ([], [])
+    assert [file.reads for file in files] == reads
+
+    large_path = store['b.bin'].path
+    new, removed = store.sync(files[:1])
+    assert not new and removed == ['b.bin']
+    assert list(store) == ['a.txt'] and not os.path.exists(large_path)
+
+
+def test_sync_same_name_replaces_the_file(store):
+    store.sync([UploadedFile('a.txt', LARGE, file_id='1')])
+    large_path = store['a.txt'].path
+    new, removed = store.sync([UploadedFile('a.txt', SMALL, file_id='2')])
+    assert [handle.name for handle in new] == ['a.txt'] and not removed
+    assert store['a.txt'].read() == SMALL and not os.path.exists(large_path)
+
+
+def test_spill_all(store):
+    store.sync([UploadedFile('a.txt', SMALL), UploadedFile('b.bin', LARGE)])
+    paths = store.spill()
+    assert set(paths) == {'a.txt', 'b.bin'}
+    with open(paths['a.txt'], 'rb') as file:
+        assert file.read() == SMALL
+    assert store['a.txt'].data is None
+
+
+def test_archive_of_the_store(store, tmp_path):
+    store.sync([UploadedFile('a.txt', SMALL), UploadedFile('b.bin', LARGE)])
+    output = str(tmp_path / 'experiences.zip')
+    zip_experience(iter(['Title\n']), {'XRF1': store}, iter(['a\n']), False, output=output, workers=2).close()
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.read(os.path.join('XRF1', 'a.txt')) == SMALL
+        assert zip_file.read(os.path.join('XRF1', 'b.bin')) == LARGE
+
+
+def test_directory_removed_with_the_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    # not the fixture, which keeps a reference on its store
+    store = UploadStore(threshold=64 * 1024)
+    store.add('b.bin', UploadedFile('b.bin', LARGE))
+    directory = store.directory
+    assert os.path.isdir(directory)
+    del store
+    gc.collect()
+    assert not os.path.exists(directory)
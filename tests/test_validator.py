@@ -0,0 +1,89 @@
+import pandas as pd
+import pytest
+import validators
+
+from models.validator import compile_checks, validate_dataframe
+from utils.units import typed_table
+
+EMAILS = ['a.martin@lab.fr', 'a@b.c', 'first.last+tag@sub.domain.org', 'no-at.example.com', 'a b@c.fr', 'x@localhost',
+          'a@lab.fr.', 'é@lab.fr']
+URLS = ['https://example.com', 'ftp://files.lab.fr/a.txt', 'example.com', 'http://localhost:8501', 'https://example',
+        'http://exa_mple.com', 'https://10.0.0.1/x', 'mailto:a@b.fr']
+TEMPLATE = {'extra_fields': {
+    'Voltage': {'type': 'number', 'unit': 'kV', 'units': ['kV', 'V']},
+    'Spots': {'type': 'number'},
+    'Mode': {'type': 'select', 'options': ['air', 'vacuum']},
+    'Filters': {'type': 'select', 'options': ['Al', 'Cu'], 'allow_multi_values': True},
+    'Operator': {'type': 'text', 'required': True},
+    'Day': {'type': 'date'},
+    'Experiment': {'type': 'experiments'},
+}}
+
+
+def invalid_rows(report: pd.DataFrame, column: str) -> list:
+    return sorted(report.loc[report['column'] == column, 'row'])
+
+
+@pytest.mark.parametrize('field_type, values, validator', [('email', EMAILS, validators.email),
+                                                            ('url', URLS, validators.url)])
+def test_same_verdicts_as_the_form_validators(field_type, values, validator):
+    df = pd.DataFrame({'Contact': values})
+    report = validate_dataframe(df, {'extra_fields': {'Contact': {'type': field_type}}})
+    assert invalid_rows(report, 'Contact') == [n for n, value in enumerate(values) if not validator(value)]
+
+
+def test_number_pairs_as_the_csv_parsing():
+    values = ['40||kV', '40', '40||kV||x', '40 kV', 'high||kV', '35||mV', '']
+    df = pd.DataFrame({'Voltage': values})
+    report = validate_dataframe(df, TEMPLATE)
+
+    def unparsable(value):
+        try:
+            _, _ = value.split('||')
+        except ValueError:
+            return True
+        return False
+
+    # the pairs the previous CSV generation couldn't split (empty cells aren't required)
+    pairs = report.loc[report['reason'].str.startswith('not a'), ['row', 'reason']]
+    assert sorted(pairs.loc[pairs['reason'] != 'not a number', 'row']) == [n for n, value in enumerate(values)
+                                                                         if value and unparsable(value)]
+    assert sorted(pairs.loc[pairs['reason'] == 'not a number', 'row']) == [4]
+    assert invalid_rows(report.loc[report['reason'].str.startswith('unit')], 'Voltage') == [5]
+
+
+def test_table():
+    df = pd.DataFrame({
+        'Voltage': ['40||kV', '35||V', None, '20||mV'],
+        'Spots': ['1', '2.5', 'x', None],
+        'Mode': ['air', 'vacuum', 'helium', None],
+        'Filters': [['Al'], ['Al', 'Cu'], ['Ag'], []],
+        'Operator': ['A. Martin', '', None, 'B. Durand'],
+        'Day': ['2024-01-01', '01/02/2024', 'yesterday', None],
+        'Experiment': ['12', '1.5', None, 'x'],
+    })
+    report = validate_dataframe(df, TEMPLATE)
+    assert report.columns.tolist() == ['row', 'column', 'reason']
+    assert {column: invalid_rows(report, column) for column in df.columns} == {
+        'Voltage': [3], 'Spots': [2], 'Mode': [2], 'Filters': [2], 'Operator': [1, 2], 'Day': [2],
+        'Experiment': [1, 3]}
+    # the typed table has the same invalid cells, the unit being checked in its own column
+    typed = validate_dataframe(typed_table(df, TEMPLATE), TEMPLATE)
+    assert invalid_rows(typed, 'Voltage (unit)') == [3]
+    assert typed.loc[typed['column'] != 'Voltage (unit)'].drop(columns='reason').equals(
+        report.loc[report['column'] != 'Voltage'].drop(columns='reason').reset_index(drop=True))
+
+
+def test_compile_checks():
+    checks = compile_checks(TEMPLATE, ['Voltage', 'Voltage (unit)'])
+    assert [reason for reason, _ in checks['Voltage']] == ['not a number']
+    assert [reason for reason, _ in checks['Voltage (unit)']] == ['unit not in kV, V']
+    assert [reason for reason, _ in compile_checks(TEMPLATE)['Voltage']] == ["not a 'value||unit' pair",
+                                                                            'not a number', 'unit not in kV, V']
+    assert compile_checks(None) == {}
+
+
+def test_valid_table():
+    df = pd.DataFrame({'Voltage': ['40||kV'], 'Operator': ['A. Martin']})
+    report = validate_dataframe(df, TEMPLATE)
+    assert report.empty and report.columns.tolist() == ['row', 'column', 'reason']
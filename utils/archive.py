@@ -0,0 +1,182 @@
+import bz2
+import os
+import shutil
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Iterable, Iterator, Tuple, Union
+
+# Compression algorithms available for the exports
+COMPRESSIONS = {
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+    'stored': zipfile.ZIP_STORED,
+}
+# Formats already compressed, stored as is
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.jp2', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.eln', '.elablite',
+    '.mp3', '.mp4', '.m4a', '.mov', '.mkv', '.webm', '.ogg', '.flac',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp',
+}
+COMPRESSED_MAGICS = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG',  # PNG
+    b'GIF8',  # GIF
+    b'PK\x03\x04',  # ZIP (and formats based on it)
+    b'\x1f\x8b',  # GZIP
+    b'BZh',  # BZIP2
+    b'\xfd7zXZ',  # XZ
+    b'7z\xbc\xaf',  # 7Z
+    b'\x28\xb5\x2f\xfd',  # ZSTD
+)
+SAMPLE_SIZE = 64 * 1024
+# Below this gain on a sample, the member is stored without compression
+MIN_COMPRESSION_GAIN = 0.05
+CHUNK_SIZE = 1024 * 1024
+# Compressed members are kept in memory up to this size, then on disk
+SPOOL_SIZE = 8 * 1024 * 1024
+
+# content of a member: bytes, binary file object or handle with an open() method (see utils.uploads.UploadHandle)
+Source = Union[bytes, BinaryIO, Any]
+
+
+def open_source(data: Source) -> BinaryIO:
+    """Binary file object reading the content of a member"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return BytesIO(data)
+    if hasattr(data, 'open'):
+        return data.open()
+    return data
+
+
+def is_compressed(arcname: str, sample: bytes) -> bool:
+    """
+    Detects members gaining nothing from compression (JPEG, TIFF-LZW, nested zip, ...).
+    :param arcname: str, name of the member
+    :param sample: bytes, first bytes of the member
+    :return: bool
+    """
+    if os.path.splitext(arcname)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if sample.startswith(COMPRESSED_MAGICS):
+        return True
+    if len(sample) < 1024:
+        return False
+    # fast compression of a sample to estimate the gain
+    return len(zlib.compress(sample, 1)) > len(sample) * (1 - MIN_COMPRESSION_GAIN)
+
+
+def _get_compressor(compress_type: int, compresslevel: int = None):
+    """Raw compressor of a zip member, as written by zipfile"""
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel,
+                                zlib.DEFLATED, -15)
+    if compress_type == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+    if compress_type == zipfile.ZIP_LZMA:
+        return zipfile.LZMACompressor()
+    return None
+
+
+def compress_member(arcname: str, data: Source, compress_type: int,
+                    compresslevel: int = None) -> Tuple[zipfile.ZipInfo, BinaryIO]:
+    """
+    Compresses a member outside the archive (zlib, bz2 and lzma release the GIL, so members can be compressed in
+    threads). Already compressed contents are stored.
+    :param arcname: str, name of the member in the archive
+    :param data: bytes or binary file object, content of the member
+    :param compress_type: int, zipfile compression constant
+    :param compresslevel: int, optional compression level
+    :return: tuple(ZipInfo with CRC and sizes, file object of the compressed data)
+    """
+    with open_source(data) as source:
+        return _compress_source(arcname, source, compress_type, compresslevel)
+
+
+def _compress_source(arcname: str, source: BinaryIO, compress_type: int,
+                     compresslevel: int = None) -> Tuple[zipfile.ZipInfo, BinaryIO]:
+    """Compresses the content read from a binary file object, see compress_member"""
+    sample = source.read(SAMPLE_SIZE)
+    if compress_type != zipfile.ZIP_STORED and is_compressed(arcname, sample):
+        compress_type = zipfile.ZIP_STORED
+
+    zinfo = zipfile.ZipInfo(arcname, date_time=datetime.now().timetuple()[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    if compress_type == zipfile.ZIP_LZMA:
+        # Compressed data includes an end-of-stream (EOS) marker
+        zinfo.flag_bits |= 0x02
+
+    compressor = _get_compressor(compress_type, compresslevel)
+    spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc, file_size = 0, 0
+    chunk = sample
+    while chunk:
+        crc = zlib.crc32(chunk, crc)
+        file_size += len(chunk)
+        spool.write(compressor.compress(chunk) if compressor else chunk)
+        chunk = source.read(CHUNK_SIZE)
+    if compressor:
+        spool.write(compressor.flush())
+
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = spool.tell()
+    spool.seek(0)
+    return zinfo, spool
+
+
+def iter_compressed(members: Iterable[Tuple[str, Source]], compress_type: int, compresslevel: int = None,
+                    workers: int = None) -> Iterator[Tuple[zipfile.ZipInfo, BinaryIO]]:
+    """
+    Compresses members in a thread pool, yielding them in their original order. The number of members compressed
+    ahead of the writing is bounded.
+    :param members: iterable of (arcname, data)
+    :param compress_type: int, zipfile compression constant
+    :param compresslevel: int, optional compression level
+    :param workers: int, number of threads. Defaults to the number of cores
+    :return: generator of (ZipInfo, compressed data)
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='elablite-compress') as pool:
+        pending = deque()
+        for arcname, data in members:
+            pending.append(pool.submit(compress_member, arcname, data, compress_type, compresslevel))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class PrecompressedZipFile(zipfile.ZipFile):
+    """ZipFile able to assemble members compressed beforehand (see compress_member)"""
+
+    def write_precompressed(self, zinfo: zipfile.ZipInfo, compressed: BinaryIO):
+        """
+        Writes a precompressed member in the archive.
+        :param zinfo: ZipInfo, with CRC, file_size and compress_size set
+        :param compressed: binary file object of the compressed data
+        """
+        with self._lock:
+            if self._writing:
+                raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+            zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+            if zip64 and not self._allowZip64:
+                raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()
+            self._writecheck(zinfo)
+            self._didModify = True
+
+            self.fp.write(zinfo.FileHeader(zip64))
+            shutil.copyfileobj(compressed, self.fp, CHUNK_SIZE)
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            self.start_dir = self.fp.tell()
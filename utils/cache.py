@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+
+from utils.tracing import trace
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the parsed templates cache (in MB), can be overridden by the environment
+DEFAULT_BUDGET_MB = int(os.environ.get("ELABLITE_TEMPLATES_CACHE_MB", 256))
+DEFAULT_MAX_ENTRIES = int(os.environ.get("ELABLITE_TEMPLATES_CACHE_ENTRIES", 64))
+# A parsed JSON document takes several times its size on disk once loaded as python objects
+PARSED_SIZE_FACTOR = 4
+
+
+def json_cost(value: Any) -> int:
+    """
+    Memory cost of a parsed JSON document (e.g. a member of an archive), estimated from its serialized size.
+    :param value: parsed content
+    :return: int, bytes
+    """
+    return len(json.dumps(value, default=str)) * PARSED_SIZE_FACTOR
+
+
+class TemplatesCache:
+    """
+    Process-wide LRU cache of parsed templates.
+
+    Entries are keyed by the identity of the file on disk (real path, size and modification time), so an unchanged
+    file is parsed only once for every session of the server, and a modified file is parsed again automatically.
+    The cache is bounded both by a number of entries and by a memory budget, each entry being charged for its own
+    parsed content (the whole file by default, a member or a section of an archive otherwise).
+
+    The cached objects are shared between sessions: they must be considered read-only by the callers. A file being
+    parsed (e.g. prefetched in the background after an upload) is not parsed again by the other callers, which wait
+    for the result.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_BUDGET_MB * 1024 ** 2, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        :param max_bytes: int, memory budget of the cache
+        :param max_entries: int, maximum number of parsed templates kept in memory
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # keys being parsed -> event set once parsed
+        self._loading = {}
+
+    @staticmethod
+    def file_key(file_path: str, kind: str) -> Tuple[Hashable, int]:
+        """
+        Build the key identifying the current version of a file.
+        :param file_path: str, path of the file
+        :param kind: str, kind of parsing done on the file (two readers may parse the same file differently)
+        :return: tuple(key, size of the file)
+        """
+        stat = os.stat(file_path)
+        return (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns, kind), stat.st_size
+
+    def get(self, file_path: str, loader: Callable[[str], Any], kind: str = 'default',
+            cost: Callable[[Any], int] = None) -> Any:
+        """
+        Get the parsed content of a file, parsing it with `loader` only if this version of the file is not cached.
+        :param file_path: str, path of the file
+        :param loader: callable, function parsing the file path given as argument
+        :param kind: str, kind of parsing done on the file
+        :param cost: callable, memory cost in bytes of the parsed content given as argument. Defaults to the size of
+                     the file times PARSED_SIZE_FACTOR (whole file parsed)
+        :return: parsed content (shared, read-only)
+        """
+        key, size = self.file_key(file_path, kind)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            loading = self._loading.get(key)
+            if loading is None:
+                self._loading[key] = threading.Event()
+
+        if loading is not None:
+            # parsed by another caller: its result, or a new parsing if it failed or wasn't cached
+            loading.wait()
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+            return loader(file_path)
+
+        try:
+            with trace('parsing', file=os.path.basename(file_path), kind=kind) as span:
+                value = loader(file_path)
+                span.bytes = size
+        except BaseException:
+            with self._lock:
+                self._loading.pop(key).set()
+            raise
+        charged = size * PARSED_SIZE_FACTOR if cost is None else cost(value)
+
+        with self._lock:
+            self._loading.pop(key).set()
+            if key not in self._entries:
+                # drop outdated versions of the same file
+                for old_key in [k for k in self._entries if k[0] == key[0] and k[3] == kind]:
+                    self._size -= self._entries.pop(old_key)[1]
+                if charged <= self.max_bytes:
+                    self._entries[key] = (value, charged)
+                    self._size += charged
+                    self._evict()
+                else:
+                    logger.info("Template %s exceeds the cache budget, not cached", file_path)
+            else:
+                value = self._entries[key][0]
+        return value
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits its budget"""
+        while self._entries and (self._size > self.max_bytes or len(self._entries) > self.max_entries):
+            _, (_, cost) = self._entries.popitem(last=False)
+            self._size -= cost
+
+    def clear(self):
+        """Empty the cache"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+TEMPLATES_CACHE = TemplatesCache()
@@ -0,0 +1,369 @@
+import itertools
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from utils.units import category_dtype, form_columns, unit_column
+
+# Columns of the files metadata editor, before the fields of the form
+BASE_COLUMNS = ['IdentifierAnalysis', 'Object/Sample', 'LocalisationAnalysis']
+# Above this number of rows, a bulk generation is considered a typo in the pattern
+MAX_BULK_ROWS = 100000
+# Digits of the identifiers numbered without range in the pattern (e.g. XRF0001)
+DEFAULT_DIGITS = 4
+# {0001..0500} range or {a,b,c} list
+BRACES_PATTERN = re.compile(r'\{([^{}]*)\}')
+RANGE_PATTERN = re.compile(r'^(-?\d+)\.\.(-?\d+)$')
+
+
+def constant_column(value, n_rows: int) -> pd.Series:
+    """
+    Column of a repeated value (lists, e.g. multiple selection, are kept as cell values). The rows share the same
+    object, kept as object dtype so pandas doesn't copy the value in every row of a string column.
+    """
+    column = np.empty(n_rows, dtype=object)
+    column.fill(value)
+    return pd.Series(column, dtype=object, copy=False)
+
+
+def _expand_braces(content: str) -> List[str]:
+    """Values of a brace group: range of numbers (zero padded as the bounds) or comma separated list"""
+    bounds = RANGE_PATTERN.match(content)
+    if bounds is None:
+        return content.split(',')
+    start, stop = bounds.groups()
+    # XRF{0001..0500}: numbers padded to the width of the bounds
+    width = len(start) if start.lstrip('-').startswith('0') or len(start) == len(stop) else 0
+    step = 1 if int(stop) >= int(start) else -1
+    if abs(int(stop) - int(start)) >= MAX_BULK_ROWS:
+        raise ValueError(f"The range {{{content}}} generates more than {MAX_BULK_ROWS} rows")
+    return [str(n).zfill(width) for n in range(int(start), int(stop) + step, step)]
+
+
+def expand_identifiers(pattern: str, count: int = None) -> List[str]:
+    """
+    Expands an identifier pattern, as a shell brace expansion: XRF{0001..0500} gives XRF0001 ... XRF0500 and
+    XRF{1..2}-{a,b} gives XRF1-a, XRF1-b, XRF2-a, XRF2-b. A pattern without braces is numbered from 1 to count.
+    :param pattern: str, identifier pattern
+    :param count: int, optional number of identifiers of a pattern without braces
+    :return: list of identifiers
+    """
+    parts = BRACES_PATTERN.split(pattern)
+    if len(parts) == 1:
+        if not count:
+            return [pattern] if pattern else []
+        return [f"{pattern}{n:0{max(DEFAULT_DIGITS, len(str(count)))}d}" for n in range(1, count + 1)]
+    # fixed text and brace groups alternate
+    choices = [[part] if n % 2 == 0 else _expand_braces(part) for n, part in enumerate(parts)]
+    total = int(np.prod([len(values) for values in choices]))
+    if total > MAX_BULK_ROWS:
+        raise ValueError(f"The pattern {pattern!r} generates {total} rows (max {MAX_BULK_ROWS})")
+    return ["".join(values) for values in itertools.product(*choices)]
+
+
+def parse_samples(text: str) -> List[str]:
+    """
+    List of Object/Sample values typed by line or separated by commas.
+    :param text: str
+    :return: list of str, without blanks
+    """
+    return [sample.strip() for sample in re.split(r'[\n,;]', text or '') if sample.strip()]
+
+
+def generate_rows(form_data: Dict, identifiers: Sequence = (None,), samples: Sequence = None,
+                  columns: Iterable[str] = None, numbers: Dict[str, List[str]] = None,
+                  selects: Dict[str, List] = None) -> DataFrame:
+    """
+    Generates the rows of the files metadata editor at once, pre-filled with the values of the form. The identifiers
+    are crossed with the samples if any (every sample for each identifier).
+    :param form_data: dict, values of the metadata form by field
+    :param identifiers: sequence of IdentifierAnalysis values
+    :param samples: sequence of Object/Sample values, optional
+    :param columns: iterable of str, columns of the table (defaults to base columns then form fields)
+    :param numbers: dict, units of the number fields (see utils.units.number_fields), typed as a float64 column and
+                    a categorical unit column
+    :param selects: dict, options of the select fields (see utils.units.select_fields), typed as categorical columns
+    :return: DataFrame with a RangeIndex
+    """
+    identifiers = list(identifiers)
+    samples = list(samples) if samples else [None]
+    n_rows = len(identifiers) * len(samples)
+    if n_rows > MAX_BULK_ROWS:
+        raise ValueError(f"{n_rows} rows requested (max {MAX_BULK_ROWS})")
+    numbers = numbers or {}
+    # categorical columns: a code by row, the value being stored once in the categories
+    categories = {unit_column(name): field_units for name, field_units in numbers.items()}
+    categories.update(selects or {})
+
+    data = {
+        'IdentifierAnalysis': np.repeat(np.array(identifiers, dtype=object), len(samples)),
+        'Object/Sample': np.tile(np.array(samples, dtype=object), len(identifiers)),
+        'LocalisationAnalysis': np.full(n_rows, None, dtype=object),
+    }
+    values = form_columns(form_data, numbers)
+    for key, value in values.items():
+        if key in data:
+            continue
+        if key in numbers:
+            data[key] = np.full(n_rows, value, dtype='float64')
+        elif key in categories and (value is None or isinstance(value, str)):
+            dtype = category_dtype(categories[key], pd.Series([value], dtype=object))
+            code = -1 if value is None else dtype.categories.get_loc(value)
+            data[key] = pd.Categorical.from_codes(np.full(n_rows, code), dtype=dtype)
+        else:
+            data[key] = constant_column(value, n_rows)
+    if columns is None:
+        columns = [*BASE_COLUMNS, *(key for key in values if key not in BASE_COLUMNS)]
+    return pd.DataFrame(data, columns=list(columns))
+
+
+def append_rows(df: DataFrame, rows: DataFrame) -> DataFrame:
+    """
+    Appends generated rows to the table in a single concatenation.
+    :param df: DataFrame, table of the editor (can be None)
+    :param rows: DataFrame, rows to append
+    :return: DataFrame with a new RangeIndex
+    """
+    if df is None or df.empty:
+        return rows.reset_index(drop=True)
+    result = pd.concat([df, rows.reindex(columns=df.columns.union(rows.columns, sort=False))], ignore_index=True)
+    for column in df.columns:
+        # categorical columns stay categorical when the rows bring other values (or strings, from the editor)
+        if (isinstance(df[column].dtype, pd.CategoricalDtype) and
+                not isinstance(result[column].dtype, pd.CategoricalDtype)):
+            result[column] = result[column].astype(category_dtype(df[column].cat.categories, result[column]))
+    return result
+
+
+@dataclass
+class Delta:
+    """
+    Change of the table of the editor: cell patches (as reported by st.data_editor) and range patches (a value by
+    column on consecutive rows), then deleted rows, then added rows. The previous values and dtypes are kept when the
+    delta is applied, so it can be reverted.
+
+    Attributes:
+        patches (Dict[int, Dict[str, Any]]): New values of the cells, by row position and column.
+        ranges (List[Tuple[int, int, Dict[str, Any]]]): (first row, last row included, value by column) patches.
+        deleted (List[int]): Positions of the deleted rows (before deletion).
+        added (DataFrame): Rows appended to the table.
+        previous (Dict[int, Dict[str, Any]]): Values of the patched cells before the delta.
+        previous_ranges (List[Tuple[int, DataFrame]]): First row and values of the patched ranges before the delta.
+        dtypes (Dict[str, Any]): Dtypes of the columns before the delta (categories added, columns cast to object).
+        removed (DataFrame): Deleted rows, indexed by their position before deletion.
+    """
+    patches: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    ranges: List[Tuple[int, int, Dict[str, Any]]] = field(default_factory=list)
+    deleted: List[int] = field(default_factory=list)
+    added: DataFrame = None
+    previous: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    previous_ranges: List[Tuple[int, DataFrame]] = field(default_factory=list)
+    dtypes: Dict[str, Any] = field(default_factory=dict)
+    removed: DataFrame = None
+
+    @classmethod
+    def from_editor(cls, widget_state: Dict, columns: Iterable[str]) -> "Delta":
+        """
+        Delta of the state of a st.data_editor widget.
+        :param widget_state: dict with the keys 'edited_rows', 'added_rows' and 'deleted_rows'
+        :param columns: iterable of str, columns of the table
+        :return: Delta
+        """
+        widget_state = widget_state or {}
+        added_rows = widget_state.get('added_rows') or []
+        columns = list(columns)
+        return cls(patches={int(pos): dict(cells) for pos, cells in (widget_state.get('edited_rows') or {}).items()},
+                   deleted=sorted(int(pos) for pos in widget_state.get('deleted_rows') or []),
+                   added=pd.DataFrame(added_rows, columns=columns) if added_rows else None)
+
+    def __len__(self) -> int:
+        """Number of changes (cells patched, rows deleted and added)"""
+        return (sum(len(cells) for cells in self.patches.values()) +
+                sum((stop - start + 1) * len(values) for start, stop, values in self.ranges) + len(self.deleted) +
+                (0 if self.added is None else len(self.added)))
+
+
+def _fit_dtype(df: DataFrame, column: str, value):
+    """Adds the value to the categories of a categorical column, so it can be set in the column"""
+    dtype = df[column].dtype
+    if isinstance(dtype, pd.CategoricalDtype) and not pd.isna(value) and value not in dtype.categories:
+        df[column] = df[column].cat.add_categories([value])
+
+
+def _set_cell(df: DataFrame, pos: int, column: str, value):
+    """Sets a cell in place, the column being converted to object if the value doesn't fit its dtype"""
+    loc = df.columns.get_loc(column)
+    _fit_dtype(df, column, value)
+    try:
+        df.iat[pos, loc] = value
+    except (TypeError, ValueError):
+        df[column] = df[column].astype(object)
+        df.iat[pos, loc] = value
+
+
+def _set_range(df: DataFrame, start: int, stop: int, column: str, value):
+    """Sets a value on the rows start..stop (included) of a column with a single slice assignment, see _set_cell"""
+    loc = df.columns.get_loc(column)
+    # lists (e.g. multiple selection) are kept as cell values, positional array so no index alignment
+    values = constant_column(value, stop - start + 1).to_numpy() if isinstance(value, (list, dict, set)) else value
+    _fit_dtype(df, column, value)
+    try:
+        df.iloc[start:stop + 1, loc] = values
+    except (TypeError, ValueError):
+        df[column] = df[column].astype(object)
+        df.iloc[start:stop + 1, loc] = values
+
+
+def apply_delta(df: DataFrame, delta: Delta) -> DataFrame:
+    """
+    Applies a delta to the table: cells and ranges are patched in place, rows are only reallocated if some are deleted
+    or added. The previous values, dtypes and the deleted rows are recorded in the delta.
+    :param df: DataFrame with a RangeIndex
+    :param delta: Delta
+    :return: DataFrame
+    """
+    delta.dtypes = df.dtypes.to_dict()
+    delta.previous = {}
+    for pos, cells in delta.patches.items():
+        if pos >= len(df):
+            continue
+        delta.previous[pos] = {column: df.iat[pos, df.columns.get_loc(column)] for column in cells}
+        for column, value in cells.items():
+            _set_cell(df, pos, column, value)
+    delta.previous_ranges = []
+    for start, stop, values in delta.ranges:
+        delta.previous_ranges.append((start, df.iloc[start:stop + 1][list(values)].copy()))
+        for column, value in values.items():
+            _set_range(df, start, stop, column, value)
+    if delta.deleted:
+        delta.removed = df.iloc[delta.deleted]
+        df = df.drop(index=df.index[delta.deleted]).reset_index(drop=True)
+    if delta.added is not None and len(delta.added):
+        df = append_rows(df, delta.added)
+    return df
+
+
+def revert_delta(df: DataFrame, delta: Delta) -> DataFrame:
+    """
+    Reverts a delta applied to the table (see apply_delta), dtypes included.
+    :param df: DataFrame with a RangeIndex
+    :param delta: Delta applied
+    :return: DataFrame
+    """
+    if delta.added is not None and len(delta.added):
+        df = df.iloc[:len(df) - len(delta.added)]
+    if delta.removed is not None and len(delta.removed):
+        # rows kept are put back between the deleted rows, at their original positions
+        kept = np.setdiff1d(np.arange(len(df) + len(delta.removed)), delta.removed.index.to_numpy())
+        df = pd.concat([df.set_axis(kept), delta.removed]).sort_index().reset_index(drop=True)
+    for start, previous in reversed(delta.previous_ranges):
+        for column in previous.columns:
+            df.iloc[start:start + len(previous), df.columns.get_loc(column)] = previous[column].to_numpy()
+    for pos, cells in delta.previous.items():
+        for column, value in cells.items():
+            df.iat[pos, df.columns.get_loc(column)] = value
+    for column, dtype in delta.dtypes.items():
+        # categories added and columns cast by the delta
+        if column in df.columns and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+class EditorState:
+    """
+    State of the files metadata editor: the base table and the log of the deltas saved. The unsaved changes are read
+    from the st.data_editor widget state, so dirty detection costs the number of edits, and undo/redo apply the deltas
+    instead of keeping copies of the table.
+    """
+
+    def __init__(self, df: DataFrame, name: str = 'files_editor'):
+        """
+        :param df: DataFrame, table of the editor (copied once, the state owns it)
+        :param name: str, prefix of the widget keys
+        """
+        self.base = df.reset_index(drop=True).copy()
+        self.name = name
+        self.version = 0
+        self.done: List[Delta] = []
+        self.undone: List[Delta] = []
+
+    @property
+    def key(self) -> str:
+        """Key of the st.data_editor widget, changed with the base table so the widget restarts from it"""
+        return f"{self.name}_{self.version}"
+
+    def pending(self, widget_state: Dict) -> Delta:
+        """
+        Unsaved changes of the editor.
+        :param widget_state: dict, st.session_state[self.key]
+        :return: Delta
+        """
+        return Delta.from_editor(widget_state, self.base.columns)
+
+    @staticmethod
+    def is_dirty(widget_state: Dict) -> bool:
+        """
+        :param widget_state: dict, st.session_state[self.key]
+        :return: bool, the editor has unsaved changes
+        """
+        widget_state = widget_state or {}
+        return any(widget_state.get(key) for key in ('edited_rows', 'added_rows', 'deleted_rows'))
+
+    def commit(self, delta: Delta):
+        """
+        Applies a delta to the base table and logs it (the redo history is dropped).
+        :param delta: Delta
+        """
+        if not len(delta):
+            return
+        self.base = apply_delta(self.base, delta)
+        self.done.append(delta)
+        self.undone.clear()
+        self.version += 1
+
+    def undo(self):
+        """Reverts the last delta"""
+        if self.done:
+            delta = self.done.pop()
+            self.base = revert_delta(self.base, delta)
+            self.undone.append(delta)
+            self.version += 1
+
+    def redo(self):
+        """Applies again the last reverted delta"""
+        if self.undone:
+            delta = self.undone.pop()
+            self.base = apply_delta(self.base, delta)
+            self.done.append(delta)
+            self.version += 1
+
+
+def apply_to_rows(df: DataFrame, start: int, stop: int, values: Dict) -> Delta:
+    """
+    Range patch of values (e.g. the current form values) applied to a range of rows.
+    :param df: DataFrame, table of the editor
+    :param start: int, first row (position)
+    :param stop: int, last row (position, included)
+    :param values: dict, value by column (columns missing in the table are ignored)
+    :return: Delta
+    """
+    values = {column: value for column, value in values.items() if column in df.columns}
+    start, stop = max(start, 0), min(stop, len(df) - 1)
+    return Delta(ranges=[(start, stop, values)] if values and start <= stop else [])
+
+
+def fill_down(df: DataFrame, columns: Iterable[str], start: int, stop: int) -> Delta:
+    """
+    Range patch copying the values of the first row of a range on the following rows of the range.
+    :param df: DataFrame, table of the editor
+    :param columns: iterable of str, columns filled
+    :param start: int, first row (position), source of the values
+    :param stop: int, last row (position, included)
+    :return: Delta
+    """
+    source = df.iloc[start]
+    return apply_to_rows(df, start + 1, stop, {column: source[column] for column in columns})
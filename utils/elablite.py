@@ -0,0 +1,291 @@
+"""
+ElabLite save format (.elablite).
+
+Version 2 is a zip container made of independent sections, so a reader can load the header and the forms without
+touching the metadata table:
+    - header.json: format version, sections and schema of the table
+    - metadata_base.json, form_data.json, template_metadata.json: JSON sections
+    - table/<n>.npy: numeric columns, and codes of the categorical columns (categories in the header), stored
+      uncompressed to be memory-mapped
+    - table/<n>.json: other columns (nullable Int64, boolean, ... columns included), as JSON arrays, or as the most
+      frequent value and the overrides of the other rows when the column is mostly constant (e.g. values of the form
+      repeated on every row)
+
+Version 1 is a dill blob of the whole dictionary, still readable (its tables reference dill types).
+"""
+import json
+import struct
+import zipfile
+from dataclasses import asdict
+from datetime import date, datetime, time
+from io import BytesIO
+from typing import Dict
+
+import dill
+import numpy as np
+import pandas as pd
+from numpy.lib import format as npy_format
+
+from models.technical import TechniqueOption, TECHNIQUES
+
+CONTEXT_V1 = 'http://example.org/elablite/v1.0/'
+CONTEXT_V2 = 'http://example.org/elablite/v2.0/'
+FORMAT_VERSION = 2
+HEADER = 'header.json'
+SECTIONS = ('metadata_base', 'form_data', 'template_metadata')
+TABLE = 'dataframe_metadata'
+# a column whose most frequent value fills at least this share of the rows is stored as a default and overrides
+SPARSE_RATIO = 0.5
+
+
+### JSON ENCODING ###
+
+def _encode(obj):
+    """JSON encoding of the python objects found in the forms (dates, techniques, numpy scalars)"""
+    if isinstance(obj, TechniqueOption):
+        return {'__technique__': asdict(obj)}
+    if obj is pd.NaT or obj is pd.NA:
+        # missing date of a datetime column, missing value of a nullable column
+        return None
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__date__': obj.isoformat()}
+    if isinstance(obj, time):
+        return {'__time__': obj.isoformat()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable in .elablite")
+
+
+def _decode(obj: Dict):
+    """Restore the python objects encoded by _encode"""
+    if len(obj) == 1:
+        key, value = next(iter(obj.items()))
+        if key == '__technique__':
+            return TECHNIQUES.get(value['code'], TechniqueOption(**value))
+        if key == '__datetime__':
+            return datetime.fromisoformat(value)
+        if key == '__date__':
+            return date.fromisoformat(value)
+        if key == '__time__':
+            return time.fromisoformat(value)
+    return obj
+
+
+def dumps(obj) -> bytes:
+    """Serialize a section"""
+    return json.dumps(obj, default=_encode).encode('utf-8')
+
+
+def loads(data: bytes):
+    """Deserialize a section"""
+    return json.loads(data, object_hook=_decode)
+
+
+### WRITING ###
+
+def dump_elablite(metadata_base: Dict, form_data: Dict, template_metadata: Dict,
+                  dataframe_metadata: pd.DataFrame) -> bytes:
+    """
+    Serialize a save in the .elablite v2 container.
+    :param metadata_base: dict, base metadata (Page 2 - Step 1)
+    :param form_data: dict, form of metadata experience (Page 2 - Step 2)
+    :param template_metadata: dict, metadata template
+    :param dataframe_metadata: DataFrame, metadata edited by analysis, optional
+    :return: bytes, content of the .elablite file
+    """
+    sections = {'metadata_base': metadata_base, 'form_data': form_data, 'template_metadata': template_metadata}
+    header = {'@context': CONTEXT_V2, 'format_version': FORMAT_VERSION, 'sections': list(SECTIONS), 'table': None}
+
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, content in sections.items():
+            zip_file.writestr(f'{name}.json', dumps(content))
+        if dataframe_metadata is not None:
+            header['table'] = _dump_table(zip_file, dataframe_metadata)
+        zip_file.writestr(HEADER, dumps(header))
+    return buffer.getvalue()
+
+
+def _write_npy(zip_file: zipfile.ZipFile, member: str, array: np.ndarray):
+    """Write an array without compression, so it can be memory-mapped"""
+    info = zipfile.ZipInfo(member, date_time=datetime.now().timetuple()[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    with zip_file.open(info, 'w') as file:
+        np.save(file, array, allow_pickle=False)
+
+
+def _most_frequent(series: pd.Series):
+    """
+    Most frequent value of a column.
+    :return: tuple(value, number of rows), (None, 0) if the values are not hashable (e.g. lists)
+    """
+    try:
+        counts = series.value_counts(dropna=False, sort=True)
+    except TypeError:
+        return None, 0
+    if counts.empty or isinstance(counts.index[0], (list, dict, set)):
+        return None, 0
+    value = counts.index[0]
+    return (None if pd.isna(value) else value), int(counts.iloc[0])
+
+
+def _dump_table(zip_file: zipfile.ZipFile, df: pd.DataFrame) -> Dict:
+    """
+    Write the table column by column.
+    :return: dict, schema of the table
+    """
+    columns = []
+    for n, (name, series) in enumerate(df.items()):
+        column = {'name': name, 'dtype': str(series.dtype)}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # a code by row, the values are stored once
+            column['encoding'] = 'category'
+            column['member'] = f'table/{n}.npy'
+            column['categories'] = series.cat.categories.tolist()
+            _write_npy(zip_file, column['member'], series.cat.codes.to_numpy())
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+            # numpy columns only: nullable extension columns (Int64, boolean, ...) hold pd.NA, stored in JSON
+            column['encoding'] = 'npy'
+            column['member'] = f'table/{n}.npy'
+            _write_npy(zip_file, column['member'], series.to_numpy())
+        else:
+            column['member'] = f'table/{n}.json'
+            values = series.astype(object)
+            default, count = _most_frequent(values)
+            if len(values) > 1 and count >= SPARSE_RATIO * len(values):
+                # mostly constant column: the size depends on the rows which differ from the default
+                column['encoding'] = 'sparse'
+                overrides = (values.notna() if default is None else values != default).to_numpy()
+                zip_file.writestr(column['member'], dumps({'default': default,
+                                                           'positions': np.flatnonzero(overrides).tolist(),
+                                                           'values': values[overrides].tolist()}))
+            else:
+                column['encoding'] = 'json'
+                zip_file.writestr(column['member'], dumps(values.tolist()))
+        columns.append(column)
+
+    index = None if df.index.equals(pd.RangeIndex(len(df))) else df.index.tolist()
+    return {'rows': len(df), 'columns': columns, 'index': index}
+
+
+### READING ###
+
+def is_v1(file_path: str) -> bool:
+    """v1 files are pickles, v2 files are zip containers"""
+    return not zipfile.is_zipfile(file_path)
+
+
+def load_v1(file_path: str) -> Dict:
+    """
+    Load a v1 .elablite file (whole dictionary pickled with dill).
+    :param file_path: str, path of the file
+    :return: dict, content of the save
+    """
+    with open(file_path, 'rb') as file:
+        data = dill.load(file)
+    if data.get('@context') != CONTEXT_V1:
+        raise IOError("The file is invalid or corrupted.")
+    return data
+
+
+def read_header(file_path: str) -> Dict:
+    """
+    Read the header of a v2 .elablite file.
+    :param file_path: str, path of the file
+    :return: dict, header
+    """
+    with zipfile.ZipFile(file_path, 'r') as zip_file:
+        header = loads(zip_file.read(HEADER))
+    if header.get('@context') != CONTEXT_V2:
+        raise IOError("The file is invalid or corrupted.")
+    return header
+
+
+def read_section(file_path: str, name: str):
+    """
+    Read a single JSON section of a v2 .elablite file.
+    :param file_path: str, path of the file
+    :param name: str, name of the section
+    :return: content of the section
+    """
+    with zipfile.ZipFile(file_path, 'r') as zip_file:
+        return loads(zip_file.read(f'{name}.json'))
+
+
+def read_table(file_path: str, header: Dict, mmap: bool = True) -> pd.DataFrame:
+    """
+    Read the metadata table of a v2 .elablite file.
+    :param file_path: str, path of the file
+    :param header: dict, header of the file
+    :param mmap: bool, memory-map the numeric columns (read-only) instead of loading them
+    :return: DataFrame or None if the save has no table
+    """
+    schema = header.get('table')
+    if schema is None:
+        return None
+
+    data = {}
+    with zipfile.ZipFile(file_path, 'r') as zip_file:
+        for column in schema['columns']:
+            info = zip_file.getinfo(column['member'])
+            if column['encoding'] in ('npy', 'category'):
+                array = _map_npy(file_path, info) if mmap else None
+                if array is None:
+                    with zip_file.open(info) as member:
+                        array = np.load(BytesIO(member.read()), allow_pickle=False)
+                if column['encoding'] == 'category':
+                    array = pd.Categorical.from_codes(array, categories=column['categories'])
+                data[column['name']] = array
+            else:
+                content = loads(zip_file.read(info))
+                if column['encoding'] == 'sparse':
+                    # default shared by the rows, then the overrides
+                    values = np.empty(schema['rows'], dtype=object)
+                    values.fill(content['default'])
+                    for position, value in zip(content['positions'], content['values']):
+                        values[position] = value
+                    content = values
+                series = pd.Series(content, dtype=object)
+                if column['dtype'] != 'object':
+                    try:
+                        series = series.astype(column['dtype'])
+                    except (TypeError, ValueError):
+                        pass
+                data[column['name']] = series
+
+    df = pd.DataFrame(data, columns=[column['name'] for column in schema['columns']], copy=False)
+    if schema.get('index') is not None:
+        df.index = schema['index']
+    return df
+
+
+def _map_npy(file_path: str, info: zipfile.ZipInfo):
+    """
+    Memory-map an uncompressed .npy member of the archive.
+    :return: numpy.memmap or None if the member can't be mapped
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    try:
+        with open(file_path, 'rb') as file:
+            file.seek(info.header_offset)
+            local_header = struct.unpack(zipfile.structFileHeader, file.read(zipfile.sizeFileHeader))
+            # file name length and extra field length end the local header
+            file.seek(local_header[-2] + local_header[-1], 1)
+            version = npy_format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = npy_format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = npy_format.read_array_header_2_0(file)
+            offset = file.tell()
+        if dtype.hasobject:
+            return None
+        return np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C')
+    except (OSError, ValueError):
+        # mmap not available (e.g. browser build)
+        return None
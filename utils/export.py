@@ -0,0 +1,267 @@
+import copy
+import csv
+import io
+import json
+import math
+import re
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import pandas as pd
+from pandas import DataFrame, Series
+
+from utils.tracing import trace
+from utils.units import UNIT_SEPARATOR, number_text, split_value_unit, unit_column
+
+CSV_HEADERS = ['date', 'title', 'body', 'rating', 'metadata', 'tags']
+# rows serialized at once when streaming a CSV
+CHUNK_ROWS = 2000
+SLOT = '@@ELABLITE_SLOT_{}@@'
+SLOT_PATTERN = re.compile(r'"@@ELABLITE_SLOT_(\d+)@@"')
+
+
+def json_value(value) -> str:
+    """JSON encoding of a single cell (missing values are null)"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'null'
+    return json.dumps(value, default=str)
+
+
+class TemplateSkeleton:
+    """
+    Template metadata serialized once, with slots in place of the values filled by the metadata table.
+
+    The JSON of the template is split around the slots, so the metadata of every row is obtained by concatenating
+    the fragments with the JSON encoded columns of the table, instead of serializing the whole template per row.
+    """
+
+    def __init__(self, template_metadata: Dict, columns: List[str], filename: bool = False):
+        """
+        :param template_metadata: dict, metadata template (not modified)
+        :param columns: list, columns of the metadata table
+        :param filename: bool, add the 'Filename' field to the metadata
+        """
+        metadata = copy.deepcopy(template_metadata)
+        extra_fields = metadata.setdefault('extra_fields', {})
+        # slots: (column, part) with part 'value', 'unit' or 'raw'
+        self.slots = []
+
+        for col in columns:
+            if col not in extra_fields:
+                continue
+            if extra_fields[col].get('type') == 'number':
+                extra_fields[col]['value'] = self._slot(col, 'value')
+                extra_fields[col]['unit'] = self._slot(col, 'unit')
+            else:
+                extra_fields[col]['value'] = self._slot(col, 'raw')
+        if filename:
+            extra_fields["Filename"] = {"type": "text", "value": self._slot("Filename", 'raw'), "position": 1000}
+
+        self.default_units = {col: template_metadata.get('extra_fields', {}).get(col, {}).get('unit')
+                              for col, part in self.slots if part == 'unit'}
+        parts = SLOT_PATTERN.split(json.dumps(metadata, default=str))
+        # fragments and slots indexes alternate
+        self.fragments = parts[0::2]
+        self.order = [int(n) for n in parts[1::2]]
+
+    def _slot(self, column: str, part: str) -> str:
+        self.slots.append((column, part))
+        return SLOT.format(len(self.slots) - 1)
+
+    def render(self, df: DataFrame) -> Tuple[Series, List[Tuple[int, str]]]:
+        """
+        Fills the slots column-wise from the table.
+        :param df: DataFrame, metadata table (the 'Filename' column feeds the Filename slot)
+        :return: tuple(Series of metadata JSON by row, list of (row, column) whose value and unit can't be parsed)
+        """
+        errors = []
+        encoded = {}
+        for col in dict.fromkeys(col for col, _ in self.slots):
+            parts = [part for column, part in self.slots if column == col]
+            if 'unit' in parts and pd.api.types.is_numeric_dtype(df[col].dtype):
+                # typed number field: float64 values (written as typed, 40 not 40.0) and categorical units
+                values = number_text(df[col])
+                units = Series(self.default_units[col], index=df.index, dtype=object)
+                if unit_column(col) in df.columns:
+                    units = df[unit_column(col)].astype(object).where(df[unit_column(col)].notna(), units)
+                encoded[(col, 'value')] = values.map(json_value)
+                encoded[(col, 'unit')] = units.map(json_value)
+            elif 'unit' in parts:
+                # legacy 'value||unit' strings
+                values, units, invalid = split_value_unit(df[col])
+                if invalid.any():
+                    errors.extend((row, col) for row in df.index[invalid.to_numpy()])
+                    values = values.where(~invalid, df[col].astype(str))
+                    units = units.where(~invalid, self.default_units[col])
+                encoded[(col, 'value')] = values.map(json_value)
+                encoded[(col, 'unit')] = units.map(json_value)
+            else:
+                encoded[(col, 'raw')] = df[col].map(json_value)
+
+        result = Series(self.fragments[0], index=df.index, dtype=object)
+        for n, fragment in zip(self.order, self.fragments[1:]):
+            result = result + encoded[self.slots[n]].astype(object) + fragment
+        return result, errors
+
+
+def iter_csv(base_mtda: Dict, df_mtda: DataFrame, template_metadata: Dict, grouped: bool,
+             errors: List[Tuple[int, str]] = None, chunk_rows: int = CHUNK_ROWS,
+             progress: Callable[[int, int], None] = None) -> Iterator[str]:
+    """
+    Generates the experiences CSV incrementally, by chunks of rows, so the whole file is never held in memory.
+    :param base_mtda: dict, base metadata
+    :param df_mtda: DataFrame, metadata by analysis
+    :param template_metadata: dict, metadata template
+    :param grouped: bool, all the analyses in one experience (first row of the table)
+    :param errors: list, optional, filled with the (row, column) whose value and unit can't be parsed
+    :param chunk_rows: int, number of rows serialized by chunk
+    :param progress: callable(rows serialized, total rows), optional, called after each chunk
+    :return: generator of CSV text chunks
+    """
+    if errors is None:
+        errors = []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADERS)
+
+    if grouped:
+        rows = df_mtda.iloc[:1]
+        skeleton = TemplateSkeleton(template_metadata, rows.columns.tolist())
+    else:
+        rows = df_mtda.copy(deep=False)
+        if 'new_Filename' in rows.columns:
+            rows['Filename'] = rows['new_Filename']
+        skeleton = TemplateSkeleton(template_metadata, rows.columns.tolist(), filename=True)
+
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows.iloc[start:start + chunk_rows]
+        metadata, chunk_errors = skeleton.render(chunk)
+        errors.extend(chunk_errors)
+        titles = Series(base_mtda['title'], index=chunk.index) if grouped else chunk['new_title']
+        table = pd.DataFrame({'date': base_mtda['date'], 'title': titles, 'body': base_mtda['commentary'],
+                              'rating': base_mtda['rating'], 'metadata': metadata,
+                              'tags': "|".join(base_mtda['tags'])}, index=chunk.index, columns=CSV_HEADERS)
+        writer.writerows(table.itertuples(index=False, name=None))
+        if progress is not None:
+            progress(start + len(chunk), len(rows))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        # header only, empty table
+        yield buffer.getvalue()
+
+
+def iter_dataframe_csv(df: DataFrame, chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    """
+    Generates the CSV of a DataFrame (with its index) by chunks of rows.
+    :param df: DataFrame
+    :param chunk_rows: int, number of rows serialized by chunk
+    :return: generator of CSV text chunks
+    """
+    yield df.iloc[:0].to_csv()
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(header=False)
+
+
+# root and extension of a filename, as os.path.splitext (a leading dot doesn't start an extension)
+SPLITEXT_PATTERN = re.compile(r'^(.*?[^/\\.][^/\\]*?)(\.[^./\\]*)?$', re.DOTALL)
+
+
+def as_text(series: Series) -> Series:
+    """String column, missing values written 'None' as in the filenames and titles of the previous versions"""
+    return series.astype(object).where(series.notna(), 'None').astype(str)
+
+
+def split_extension(filenames: Series) -> Tuple[Series, Series]:
+    """
+    Vectorized os.path.splitext of a column of filenames.
+    :param filenames: Series of str
+    :return: tuple(roots, extensions)
+    """
+    filenames = filenames.astype(str)
+    parts = filenames.str.extract(SPLITEXT_PATTERN)
+    return parts[0].fillna(filenames), parts[1].fillna('')
+
+
+def generate_filenames(df: DataFrame, columns: List[str], date: str, code: str, shortname: str = None) -> Series:
+    """
+    New filenames of the analyses: prefix (date, technique code and project shortname) built once, then the selected
+    columns joined column-wise, and the extension of the original file. Float columns are written as typed (40kV as
+    the legacy '40||kV' string, not 40.0kV).
+    :param df: DataFrame, metadata table with a 'Filename' column
+    :param columns: list, columns included in the filename (in order)
+    :param date: str, date of the experiment (YYYYMMDD)
+    :param code: str, technique code
+    :param shortname: str, optional project shortname
+    :return: Series of filenames
+    """
+    missing = df['Filename'].isna()
+    if missing.any():
+        raise ValueError(f"{int(missing.sum())} row(s) without file")
+    prefix = "_".join([date, code] if shortname is None else [date, code, shortname]) + "_"
+
+    with trace('naming', rows=len(df), columns=len(columns)):
+        names = Series(prefix, index=df.index, dtype=object)
+        for n, col in enumerate(columns):
+            values = number_text(df[col]) if pd.api.types.is_float_dtype(df[col].dtype) else df[col]
+            names = names + ("_" if n else "") + as_text(values)
+            if unit_column(col) in df.columns:
+                # typed number field, the unit follows the value (e.g. 40kV)
+                units = df[unit_column(col)].astype(object)
+                names = names + units.where(units.notna(), '').astype(str)
+        names = names + split_extension(df['Filename'])[1]
+        return names.str.replace(UNIT_SEPARATOR, "", regex=False).str.replace("__", "_", regex=False)
+
+
+def generate_titles(df: DataFrame, title: str) -> Series:
+    """
+    Titles of the experiences not bundled: title of the experiment with the analysis identifier and the sample, or
+    the row label if both are missing.
+    :param df: DataFrame, metadata table with the columns 'IdentifierAnalysis' and 'Object/Sample'
+    :param title: str, title of the experiment
+    :return: Series of titles
+    """
+    identified = df['IdentifierAnalysis'].notna() | df['Object/Sample'].notna()
+    prefix = f"{title} -- "
+    titles = prefix + as_text(df['IdentifierAnalysis']) + "_" + as_text(df['Object/Sample'])
+    return titles.where(identified, prefix + df.index.astype(str).to_series(index=df.index))
+
+
+def find_collisions(names: Series) -> Series:
+    """
+    Detects the rows sharing their name with another row (hash table, single pass), which would overwrite each other
+    in the archive.
+    :param names: Series of str
+    :return: boolean mask of the colliding rows
+    """
+    return names.duplicated(keep=False)
+
+
+def deduplicate(names: Series, extension: bool = False) -> Series:
+    """
+    Suffixes the repeated names with their occurrence number (name, name_2, name_3, ...), the first occurrence being
+    kept as is.
+    :param names: Series of str
+    :param extension: bool, the names are filenames, suffixed before the extension
+    :return: Series of unique names
+    """
+    names = names.astype(str)
+    occurrence = names.groupby(names, sort=False).cumcount()
+    repeated = occurrence > 0
+    if not repeated.any():
+        return names
+    kept = set(names[~repeated])
+    if extension:
+        roots, extensions = split_extension(names[repeated])
+    else:
+        roots, extensions = names[repeated], ''
+    number = occurrence[repeated] + 1
+    while True:
+        candidates = roots + "_" + number.astype(str) + extensions
+        # a suffixed name can collide with an existing one, e.g. ['a', 'a', 'a_2']
+        clash = candidates.isin(kept) | candidates.duplicated()
+        if not clash.any():
+            break
+        number = number + clash.astype(int)
+    return names.where(~repeated, candidates)
@@ -1,14 +1,22 @@
-import csv
-import dill as pickle
-import json
+import hashlib
 import os
+import shutil
+import time
+import uuid
 import pandas as pd
 import streamlit as st
 import zipfile
 from io import BytesIO
 from pandas import DataFrame
 from tempfile import NamedTemporaryFile, gettempdir
-from typing import Dict
+from typing import BinaryIO, Callable, Dict, Iterable, Mapping, Union
+
+from utils.archive import CHUNK_SIZE, COMPRESSIONS, PrecompressedZipFile, Source, iter_compressed
+from utils.elablite import dump_elablite
+from utils.tracing import trace
+
+# Export directories left behind (archive not downloaded) are removed after this delay
+MAX_EXPORT_AGE = 24 * 3600
 
 
 def manage_temp_dir(child: str = None) -> str:
@@ -24,24 +32,48 @@ def manage_temp_dir(child: str = None) -> str:
         templates_dir = os.path.join(temp_dir, "templates", child)
     if not os.path.exists(templates_dir):
         os.makedirs(templates_dir)
-    # keep only the first 10 templates recent
-    templates = sorted(os.listdir(templates_dir), key=lambda x: os.path.getmtime(os.path.join(templates_dir, x)))
+    # keep only the first 10 templates recent (child directories are not templates)
+    templates = sorted([x for x in os.listdir(templates_dir) if os.path.isfile(os.path.join(templates_dir, x))],
+                       key=lambda x: os.path.getmtime(os.path.join(templates_dir, x)))
     while len(templates) > 10:
         os.remove(os.path.join(templates_dir, templates[0]))
         templates.pop(0)
     return templates_dir
 
 
-@st.cache_data
-def convert_df(df):
-    """cache dataframe"""
-    return df.to_csv().encode("utf-8")
+def file_digest(path: str) -> bytes:
+    """SHA-256 of a file, read by chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def save_upload(uploaded_file, path: str) -> bool:
+    """
+    Saves an uploaded file in tmp dir, unless the file already has this content (its parsed version stays cached).
+    The content is written in a temporary file of the same directory then renamed, so a previous version still read
+    (e.g. table of a preset memory-mapped by the templates cache) is never truncated.
+    :param uploaded_file: streamlit UploadedFile
+    :param path: str, path of the file
+    :return: bool, True if the file was written
+    """
+    data = uploaded_file.getvalue()
+    if os.path.exists(path) and os.path.getsize(path) == len(data) and \
+            file_digest(path) == hashlib.sha256(data).digest():
+        return False
+    with NamedTemporaryFile('wb', dir=os.path.dirname(path), prefix='.upload-', delete=False) as file:
+        file.write(data)
+    os.replace(file.name, path)
+    return True
+
 
 @st.cache_data
 def create_elablite(metadata_base: Dict, form_data: Dict, template_metadata: Dict,
                     dataframe_metadata: pd.DataFrame) -> bytes:
     """
-    Create a serialized binary representation of metadata dictionary. Content .elablite
+    Create a serialized binary representation of metadata dictionary. Content .elablite (v2 container)
 
     Args:
             metadata_base (Dict): A dictionary containing base metadata with keys 'date', 'title', 'commentary',
@@ -54,114 +86,94 @@ def create_elablite(metadata_base: Dict, form_data: Dict, template_metadata: Dic
     Returns:
         bytes: Serialized binary data representing the metadata dictionary.
     """
-    metadata_dict = {
-        '@context': 'http://example.org/elablite/v1.0/',
-        'metadata_base': metadata_base,
-        'form_data': form_data,
-        'template_metadata': template_metadata,
-        'dataframe_metadata': dataframe_metadata
-    }
+    return dump_elablite(metadata_base=metadata_base, form_data=form_data, template_metadata=template_metadata,
+                         dataframe_metadata=dataframe_metadata)
+
 
-    return pickle.dumps(metadata_dict)
+def last_modified(path: str) -> float:
+    """Most recent modification time of a directory and of its files (e.g. archive being written)"""
+    mtimes = [os.path.getmtime(path)]
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            mtimes.extend(entry.stat().st_mtime for entry in entries)
+    return max(mtimes)
 
 
-def generate_csv(base_mtda: Dict, df_mtda: DataFrame, grouped: bool) -> str:
+def exports_dir() -> str:
     """
-        Generates a CSV file from base metadata and a DataFrame of additional metadata.
-
-        Args:
-            base_mtda (Dict): A dictionary containing base metadata with keys 'date', 'title', 'commentary', 'rating',
-                            and 'tags'. Related to Page 2 - Step 1 base metadata.
-            df_mtda (pd.DataFrame): A DataFrame containing experience metadata. Related to Page 2 - Step 2 and 3 forms
-                                    metadata and dataframe editor.
-            grouped (bool): A boolean indicating whether the experiences and files should be bundled. Related to
-                            Page 4 - button grouped.
-
-        Returns:
-            str: The file path to the generated CSV file.
-
-        Example:
-            base_mtda = {
-                'date': '2024-06-06',
-                'title': 'Sample Title',
-                'commentary': 'Sample commentary',
-                'rating': 5,
-                'tags': 'sample,example'
-            }
-            df_mtda = pd.DataFrame({
-                'extra_field1': ['value1', 'value2'],
-                'extra_field2': ['value3', 'value4']
-            })
-            csv_filename = generate_csv(base_mtda, df_mtda, grouped=False)
-        """
-    headers = ['date', 'title', 'body', 'rating', 'metadata', 'tags']
-    with NamedTemporaryFile(mode='w', newline='', delete=False, suffix='.csv', encoding='utf-8') as csv_file:
-        metadata = st.session_state['template_metadata']
-        writer = csv.DictWriter(csv_file, fieldnames=headers)
-        writer.writeheader()
-        if grouped:
-            for col in df_mtda.columns:
-                if col in metadata['extra_fields']:
-                    if metadata['extra_fields'][col]['type'] == 'number':
-                        try:
-                            value, unit = df_mtda[col].iloc[0].split('||')
-                            metadata['extra_fields'][col]['value'] = value
-                            metadata['extra_fields'][col]['unit'] = unit
-                        except ValueError:
-                            st.error(f"Impossible to parse the value and its unit in the column '{col}'. \
-                                        Please check your column content and don't use '||' in the unit appellation \
-                                        but like separator.")
-                    else:
-                        metadata['extra_fields'][col]['value'] = df_mtda[col].iloc[0]
-            data = {'date': base_mtda['date'], 'title': base_mtda['title'], 'body': base_mtda['commentary'],
-                    'rating': base_mtda['rating'], 'metadata': json.dumps(metadata), 'tags': "|".join(base_mtda['tags'])}
-            writer.writerow(data)
-        else:
-            for idx, row in df_mtda.iterrows():
-                for col in df_mtda.columns:
-                    if col in metadata['extra_fields']:
-                        if metadata['extra_fields'][col]['type'] == 'number':
-                            try:
-                                value, unit = row[col].split('||')
-                                metadata['extra_fields'][col]['value'] = value
-                                metadata['extra_fields'][col]['unit'] = unit
-                            except ValueError:
-                                st.error(f"Impossible to parse the value and its unit in the column '{col}'. \
-                                Please check your column content and don't use '||' in the unit appellation but like \
-                                separator.")
-                        else:
-                            metadata['extra_fields'][col]['value'] = row[col]
-
-                try:
-                    filename = row['new_Filename']
-                except KeyError:
-                    filename = row['Filename']
-
-                metadata['extra_fields']["Filename"] = {"type": "text",
-                                                        "value": filename,
-                                                        "position": 1000}
-
-                data = {'date': base_mtda['date'], 'title': row['new_title'], 'body': base_mtda['commentary'],
-                        'rating': base_mtda['rating'], 'metadata': json.dumps(metadata), 'tags': "|".join(base_mtda['tags'])}
-                writer.writerow(data)
-        csv_filename = csv_file.name
-    return csv_filename
-
-
-def files_management(uploaded_files: Dict[str, bytes], df_mtda: DataFrame, grouped: bool) -> Dict[
-    str, Dict[str, bytes]]:
+    Directory of the exports of all the sessions, cleaned from the exports left behind for more than MAX_EXPORT_AGE
+    (not with manage_temp_dir, which would remove archives being written or waiting to be downloaded).
+    :return: str, path tmp/templates/exports/
+    """
+    directory = os.path.join(manage_temp_dir(), 'exports')
+    os.makedirs(directory, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - last_modified(path) <= MAX_EXPORT_AGE:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # removed meanwhile by its session
+            continue
+    return directory
+
+
+def create_export_file(name: str = 'experiences.zip') -> str:
+    """
+    Creates the path of a new export file on disk, in its own directory of tmp dir exports/ (see remove_export).
+    :param name: str, filename
+    :return: str, path of the file to write
+    """
+    directory = os.path.join(exports_dir(), uuid.uuid4().hex)
+    os.makedirs(directory)
+    return os.path.join(directory, name)
+
+
+def remove_export(export_path: str):
+    """
+    Removes an export file created by create_export_file, with its directory.
+    :param export_path: str, path of the file
+    """
+    shutil.rmtree(os.path.dirname(export_path), ignore_errors=True)
+
+
+def write_chunks(zip_file: zipfile.ZipFile, arcname: str, chunks: Iterable[str]) -> int:
+    """
+    Writes text chunks directly in a member of the zip archive, without intermediate file.
+    :param zip_file: ZipFile, archive opened in writing mode
+    :param arcname: str, name of the member
+    :param chunks: Iterable[str], content of the member
+    :return: int, bytes of the content (uncompressed)
+    """
+    size = 0
+    with zip_file.open(arcname, 'w', force_zip64=True) as member:
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            member.write(data)
+            size += len(data)
+    return size
+
+
+def files_management(uploaded_files: Mapping[str, Source], df_mtda: DataFrame, grouped: bool) -> Dict[
+    str, Dict[str, Source]]:
     """
     Manages the renaming and grouping of uploaded files based on metadata provided in a DataFrame.
 
     Args:
-        uploaded_files (Dict[str, bytes]): A dictionary containing the uploaded files.
-            The keys are the original filenames, and the values are the file data.
+        uploaded_files (Mapping[str, Source]): A mapping containing the uploaded files (e.g. utils.uploads.UploadStore).
+            The keys are the original filenames, and the values are the file data or handles on it (UploadHandle),
+            which are only passed along: the content is streamed later by zip_experience.
         df_mtda (pd.DataFrame): A DataFrame containing metadata for the files.
             The DataFrame must have the columns 'Filename', 'new_Filename', and 'new_title'.
         grouped (bool): A boolean indicating whether the files should be grouped together in a single dictionary.
 
     Returns:
-        Dict[str, Dict[str, bytes]]: A dictionary with the new filenames and titles,
+        Dict[str, Dict[str, Source]]: A dictionary with the new filenames and titles,
         containing the uploaded files data as specified by the metadata. The structure of the returned
         dictionary depends on the `grouped` parameter:
             - If `grouped` is True, returns a dictionary with a single key 'data' containing all files.
@@ -185,48 +197,60 @@ def files_management(uploaded_files: Dict[str, bytes], df_mtda: DataFrame, group
         #     'title2': {'new_file2.txt': b'filedata2'}
         # }
     """
-    new_dict = {}
-    # Keep Filename
-    if 'new_Filename' not in df_mtda.columns.tolist():
-        if grouped:
-            new_dict['data'] = uploaded_files
-        else:
-            for idx, row in df_mtda.iterrows():
-                if row['new_title'] not in new_dict:
-                    new_dict[row['new_title']] = {}
-                new_dict[row['new_title']][row['Filename']] = uploaded_files[row['Filename']]
-        return new_dict
-    # New Filename
-    else:
-        if grouped:
-            new_dict['data'] = {}
-            for key, new_filename in zip(df_mtda['Filename'], df_mtda['new_Filename']):
-                if key in uploaded_files:
-                    new_dict['data'][new_filename] = uploaded_files[key]
+    with trace('renaming', rows=len(df_mtda), grouped=grouped):
+        new_dict = {}
+        # Keep Filename
+        if 'new_Filename' not in df_mtda.columns.tolist():
+            if grouped:
+                new_dict['data'] = uploaded_files
+            else:
+                for idx, row in df_mtda.iterrows():
+                    if row['new_title'] not in new_dict:
+                        new_dict[row['new_title']] = {}
+                    new_dict[row['new_title']][row['Filename']] = uploaded_files[row['Filename']]
+            return new_dict
+        # New Filename
         else:
-            for idx, row in df_mtda.iterrows():
-                if row['new_title'] not in new_dict:
-                    new_dict[row['new_title']] = {}
-                new_dict[row['new_title']][row['new_Filename']] = uploaded_files[row['Filename']]
-        return new_dict
+            if grouped:
+                new_dict['data'] = {}
+                for key, new_filename in zip(df_mtda['Filename'], df_mtda['new_Filename']):
+                    if key in uploaded_files:
+                        new_dict['data'][new_filename] = uploaded_files[key]
+            else:
+                for idx, row in df_mtda.iterrows():
+                    if row['new_title'] not in new_dict:
+                        new_dict[row['new_title']] = {}
+                    new_dict[row['new_title']][row['new_Filename']] = uploaded_files[row['Filename']]
+            return new_dict
 
 
-def zip_experience(csv_filename: str, uploaded_files: Dict[str, Dict[str, bytes]],
-                   logs_process: bytes, grouped: bool) -> BytesIO:
+def zip_experience(csv_chunks: Iterable[str], uploaded_files: Mapping[str, Mapping[str, Source]],
+                   logs_process: Iterable[str], grouped: bool, output: Union[str, BinaryIO] = None,
+                   compression: str = 'deflate', compresslevel: int = None, workers: int = None,
+                   progress: Callable[[int, int, int], None] = None) -> BinaryIO:
     """
     Creates a zip archive containing a CSV file and additional uploaded files.
 
     Args:
-        csv_filename (str): The path to the CSV file to be included in the zip archive.
+        csv_chunks (Iterable[str]): The CSV content (experiences.csv), streamed by chunks in the zip archive.
         uploaded_files (Dict): A dictionary containing the files to be added to the zip archive.
-            The dictionary should be in the format {folder_name: {file_name: file_data}}.
-        logs_process (bytes): Edited dataframe cached to retain all modified information before transformation
-            and zipping.
+            The dictionary should be in the format {folder_name: {file_name: file_data}}, file data being bytes or
+            handles (UploadHandle) streamed by chunks in the archive.
+        logs_process (Iterable[str]): CSV of the edited dataframe to retain all modified information before
+            transformation and zipping, streamed by chunks in the zip archive.
         grouped (bool): A boolean indicating whether the files should be grouped together in a single dictionary.
                         If the files are grouped, then we want to obtain a DATAFILE.txt grouping all the project names.
+        output (str | BinaryIO, optional): Path or binary file object where the archive is written member by member
+            (disk export mode, see `create_export_file`). Defaults to an in-memory BytesIO.
+        compression (str): Compression algorithm of the members, one of 'deflate', 'bzip2', 'lzma' or 'stored'.
+            Already compressed files (JPEG, TIFF-LZW, zip, ...) are always stored.
+        compresslevel (int, optional): Compression level (deflate 0-9, bzip2 1-9, ignored by lzma).
+        workers (int, optional): Number of threads compressing the uploaded files. Defaults to the number of cores.
+        progress (Callable[[int, int, int], None], optional): Called with (files written, total files, compressed
+            bytes written) after each file.
 
     Returns:
-        BytesIO: A BytesIO object containing the zip archive.
+        BinaryIO: The zip archive, opened for reading from the start (BytesIO by default).
 
     Example:
         uploaded_files = {
@@ -239,20 +263,36 @@ def zip_experience(csv_filename: str, uploaded_files: Dict[str, Dict[str, bytes]
                 'doc2.txt': b'filedata4'
             }
         }
-        zip_buffer = zip_experience('experiences.csv', uploaded_files, logs_process)
+        zip_buffer = zip_experience(iter_csv(base_mtda, df_mtda, template_metadata, False), uploaded_files,
+                                    iter_dataframe_csv(df_mtda), False)
     """
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED) as zip_file:
-        zip_file.write(csv_filename, arcname='experiences.csv')
-        zip_file.writestr('logs_process.csv', logs_process)
-        for folder_name, files in uploaded_files.items():
-            file_names = []
-            for file_name, file_data in files.items():
-                file_path = os.path.join(folder_name, file_name)
-                zip_file.writestr(file_path, file_data)
-                file_names.append(file_name)
-            if grouped:
-                zip_file.writestr(os.path.join(folder_name, 'DATAFILE.txt'), "\n".join(file_names))
+    if output is None:
+        zip_buffer = BytesIO()
+    elif isinstance(output, str):
+        zip_buffer = open(output, 'w+b')
+    else:
+        zip_buffer = output
+    compress_type = COMPRESSIONS[compression]
+    with PrecompressedZipFile(zip_buffer, 'w', compress_type, compresslevel=compresslevel) as zip_file:
+        # CSV serialized while it is written (compression included)
+        with trace('csv generation', grouped=grouped) as span:
+            span.bytes = write_chunks(zip_file, 'experiences.csv', csv_chunks)
+            span.bytes += write_chunks(zip_file, 'logs_process.csv', logs_process)
+        members = [(os.path.join(folder_name, file_name), file_data)
+                   for folder_name, files in uploaded_files.items() for file_name, file_data in files.items()]
+        with trace('zipping', files=len(members), compression=compression) as span:
+            written = 0
+            for done, (zinfo, compressed) in enumerate(iter_compressed(members, compress_type, compresslevel,
+                                                                       workers), 1):
+                with compressed:
+                    zip_file.write_precompressed(zinfo, compressed)
+                written += zinfo.compress_size
+                span.bytes += zinfo.file_size
+                if progress is not None:
+                    progress(done, len(members), written)
+            span.attributes['compressed_bytes'] = written
+        if grouped:
+            for folder_name, files in uploaded_files.items():
+                zip_file.writestr(os.path.join(folder_name, 'DATAFILE.txt'), "\n".join(files))
     zip_buffer.seek(0)
-    os.unlink(csv_filename)
     return zip_buffer
@@ -0,0 +1,263 @@
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List
+
+import pandas as pd
+from pandas import DataFrame
+
+from utils.tracing import trace
+
+
+class AhoCorasick:
+    """
+    Aho–Corasick automaton: finds all the patterns occurring in a text in a single pass over the text.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        """
+        :param patterns: iterable of str, patterns to search
+        """
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[str]] = [[]]
+        for pattern in dict.fromkeys(patterns):
+            if pattern:
+                self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for char in pattern:
+            if char not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+        self.output[node].append(pattern)
+
+    def _build(self):
+        """Failure links, by breadth-first traversal"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str) -> List[str]:
+        """
+        :param text: str
+        :return: list of the patterns found in the text (once each, in order of first occurrence)
+        """
+        found = {}
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for pattern in self.output[node]:
+                found.setdefault(pattern, None)
+        return list(found)
+
+
+@dataclass
+class MappingReport:
+    """
+    Result of the mapping between the rows of the metadata table and the uploaded files.
+
+    Attributes:
+        matches (Dict[Hashable, str]): Filename mapped to each row (by index label).
+        unmatched_files (List[str]): Files matching no row.
+        unmatched_rows (List[Hashable]): Rows matching no file.
+        ambiguous_files (Dict[str, List[Hashable]]): Files matching several rows equally well.
+        ambiguous_rows (Dict[Hashable, List[str]]): Rows matching several files (the first one is mapped).
+    """
+    matches: Dict[Hashable, str] = field(default_factory=dict)
+    unmatched_files: List[str] = field(default_factory=list)
+    unmatched_rows: List[Hashable] = field(default_factory=list)
+    ambiguous_files: Dict[str, List[Hashable]] = field(default_factory=dict)
+    ambiguous_rows: Dict[Hashable, List[str]] = field(default_factory=dict)
+
+    def issues(self) -> DataFrame:
+        """
+        Summary of the mapping issues, one line by file or row.
+        :return: DataFrame with columns 'issue', 'file', 'rows'
+        """
+        lines = [('Ambiguous file', name, rows) for name, rows in self.ambiguous_files.items()]
+        lines += [('Several files for one row', ', '.join(names), [row]) for row, names in self.ambiguous_rows.items()]
+        lines += [('Unmatched file', name, []) for name in self.unmatched_files]
+        return pd.DataFrame(lines, columns=['issue', 'file', 'rows'])
+
+
+class FilenameMatcher:
+    """
+    Maps files to the rows of the metadata table: a file belongs to a row if both its 'IdentifierAnalysis' and its
+    'Object/Sample' values are contained in the filename.
+
+    The identifiers are indexed once in an Aho–Corasick automaton, so every filename is scanned once whatever the
+    number of rows, instead of testing every row against every file.
+    """
+
+    def __init__(self, df: DataFrame):
+        """
+        :param df: DataFrame, metadata table with the columns 'IdentifierAnalysis' and 'Object/Sample'
+        """
+        self.rows: Dict[str, List[tuple]] = {}
+        complete = df['IdentifierAnalysis'].notna() & df['Object/Sample'].notna()
+        for row, identifier, sample in zip(df.index[complete],
+                                           df.loc[complete, 'IdentifierAnalysis'].astype(str),
+                                           df.loc[complete, 'Object/Sample'].astype(str)):
+            self.rows.setdefault(identifier, []).append((row, sample))
+        self.automaton = AhoCorasick(self.rows)
+        self.all_rows = list(df.index)
+
+    def candidates(self, filename: str) -> List[Hashable]:
+        """
+        Rows matching a file, the most specific first (longest identifier and sample).
+        :param filename: str
+        :return: list of rows
+        """
+        candidates = []
+        for identifier in self.automaton.find(filename):
+            for row, sample in self.rows[identifier]:
+                if sample in filename:
+                    candidates.append((len(identifier) + len(sample), row))
+        if not candidates:
+            return []
+        # e.g. XRF10 is preferred to XRF1 for 'XRF10_sample.txt'
+        best = max(score for score, _ in candidates)
+        return [row for score, row in candidates if score == best]
+
+    def match(self, filenames: Iterable[str]) -> MappingReport:
+        """
+        Maps the files to the rows.
+        :param filenames: iterable of str, uploaded filenames (in upload order)
+        :return: MappingReport
+        """
+        report = MappingReport()
+        files_by_row: Dict[Hashable, List[str]] = {}
+        for filename in filenames:
+            rows = self.candidates(filename)
+            if not rows:
+                report.unmatched_files.append(filename)
+                continue
+            if len(rows) > 1:
+                report.ambiguous_files[filename] = rows
+            for row in rows:
+                files_by_row.setdefault(row, []).append(filename)
+
+        for row, names in files_by_row.items():
+            report.matches[row] = names[0]
+            if len(names) > 1:
+                report.ambiguous_rows[row] = names
+        report.unmatched_rows = [row for row in self.all_rows if row not in files_by_row]
+        return report
+
+
+@lru_cache(maxsize=64)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """
+    Compiles a filename pattern once. Raises re.error if the pattern is invalid or has no named group.
+    :param pattern: str, regular expression with named groups
+    :return: compiled pattern
+    """
+    regex = re.compile(pattern)
+    if not regex.groupindex:
+        raise re.error("The pattern needs named groups, e.g. (?P<IdentifierAnalysis>...)")
+    return regex
+
+
+def group_column(group: str, columns: Iterable[str]) -> str:
+    """Column of the table corresponding to a named group ('_' standing for '/', e.g. Object_Sample)"""
+    columns = list(columns)
+    if group in columns:
+        return group
+    return group.replace('_', '/') if group.replace('_', '/') in columns else group
+
+
+class PatternMatcher:
+    """
+    Maps files to the rows of the metadata table with a filename pattern: the named groups extracted from all the
+    filenames at once (vectorized) are joined with the columns of the same name in the table.
+    """
+
+    def __init__(self, pattern: str):
+        """
+        :param pattern: str, regular expression with named groups (see models.technical.DEFAULT_FILENAME_PATTERN)
+        """
+        self.regex = compile_pattern(pattern)
+
+    def extract(self, filenames: Iterable[str]) -> DataFrame:
+        """
+        Extracts the fields of the filenames.
+        :param filenames: iterable of str
+        :return: DataFrame with a 'Filename' column and a column by named group (NaN if the file does not follow
+                 the pattern)
+        """
+        names = pd.Series(list(filenames), dtype=object, name='Filename')
+        fields = names.str.extract(self.regex)
+        fields.insert(0, 'Filename', names)
+        return fields
+
+    def match(self, df: DataFrame, filenames: Iterable[str]) -> MappingReport:
+        """
+        Maps the files to the rows by joining the extracted fields with the table.
+        :param df: DataFrame, metadata table
+        :param filenames: iterable of str, uploaded filenames (in upload order)
+        :return: MappingReport (files not following the pattern are unmatched)
+        """
+        fields = self.extract(filenames)
+        fields.columns = ['Filename'] + [group_column(group, df.columns) for group in fields.columns[1:]]
+        keys = [column for column in fields.columns[1:] if column in df.columns]
+        report = MappingReport()
+        if not keys:
+            report.unmatched_files = fields['Filename'].tolist()
+            report.unmatched_rows = list(df.index)
+            return report
+
+        parsed = fields.dropna(subset=keys)
+        table = df[keys].dropna()
+        table = table.astype(str).rename_axis('_row').reset_index()
+        joined = parsed[['Filename', *keys]].astype(str).merge(table, on=keys, how='inner', sort=False)
+
+        files_by_row = joined.groupby('_row', sort=False)['Filename'].agg(list)
+        rows_by_file = joined.groupby('Filename', sort=False)['_row'].agg(list)
+        report.matches = {row: names[0] for row, names in files_by_row.items()}
+        report.ambiguous_rows = {row: names for row, names in files_by_row.items() if len(names) > 1}
+        report.ambiguous_files = {name: rows for name, rows in rows_by_file.items() if len(rows) > 1}
+        report.unmatched_files = fields.loc[~fields['Filename'].isin(rows_by_file.index), 'Filename'].tolist()
+        report.unmatched_rows = df.index[~df.index.isin(files_by_row.index)].tolist()
+        return report
+
+
+def match_files(df: DataFrame, filenames: Iterable[str], pattern: str = None) -> MappingReport:
+    """
+    Maps the files to the rows of the metadata table: with the filename pattern first, then by containment of the
+    identifiers (FilenameMatcher) for the files and rows left.
+    :param df: DataFrame, metadata table
+    :param filenames: iterable of str, uploaded filenames (in upload order)
+    :param pattern: str, optional filename pattern
+    :return: MappingReport
+    """
+    filenames = list(filenames)
+    with trace('mapping', rows=len(df), files=len(filenames), pattern=pattern is not None) as span:
+        span.bytes = sum(len(name) for name in filenames)
+        if pattern is None:
+            return FilenameMatcher(df).match(filenames)
+
+        report = PatternMatcher(pattern).match(df, filenames)
+        if report.unmatched_files and report.unmatched_rows:
+            fallback = FilenameMatcher(df.loc[report.unmatched_rows]).match(report.unmatched_files)
+            report.matches.update(fallback.matches)
+            report.ambiguous_rows.update(fallback.ambiguous_rows)
+            report.ambiguous_files.update(fallback.ambiguous_files)
+            report.unmatched_files = fallback.unmatched_files
+            report.unmatched_rows = fallback.unmatched_rows
+        return report
@@ -38,3 +38,6 @@ def menu():
             st.page_link("pages/4-metadata_management.py", label="• Complete Experiment(s)")
     st.sidebar.divider()
     st.session_state['temporary_container'] = st.sidebar.container()
+    # message of the page which redirected here
+    if st.session_state.get('redirect_message'):
+        st.warning(st.session_state.pop('redirect_message'))
@@ -1,21 +1,62 @@
+import copy
 import csv
 import json
+import logging
+import os
 import pandas as pd
-import pickle
 import streamlit as st
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Dict, List
-from zipfile import ZipFile, ZIP_DEFLATED
-from zipfile import Path as ZPath
+from zipfile import ZipFile
+
+from utils import elablite
+from utils.cache import PARSED_SIZE_FACTOR, TEMPLATES_CACHE, json_cost
+from utils.tracing import collect, current_collector
+
+logger = logging.getLogger(__name__)
+
+# background parsing of the uploaded and selected templates (see prefetch)
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='elablite-prefetch')
+
+
+def prefetch(file_path: str, entry_id: str = None) -> Future:
+    """
+    Parses a template or preset in the background, e.g. right after its upload or selection, while the next page
+    starts. The next page reads it from the templates cache, or waits for the parsing in progress instead of parsing
+    it again. Errors are not reported here but by the page reading the file.
+    :param file_path: str, path of the file
+    :param entry_id: str, optional identifier of the experiment to read in multi-experiments files. ONLY ELN
+    :return: Future, True if the file was parsed without error
+    """
+    return PREFETCH_EXECUTOR.submit(_prefetch, file_path, entry_id, current_collector())
+
+
+def _prefetch(file_path: str, entry_id: str = None, collector=None) -> bool:
+    """Parses what the metadata pages read first: metadata template, and preset sections and table (ElabLite)"""
+    try:
+        with collect(collector):
+            reader = TemplatesReader(file_path, entry_id=entry_id)
+            reader.read_metadata()
+            if isinstance(reader.file, ElabLiteTemplatesReader):
+                reader.file.read_section('metadata_base')
+                reader.file.read_section('form_data')
+                reader.file.read_dataframe(copy_=False)
+        return True
+    except Exception:
+        logger.debug("Prefetch of %s failed", file_path, exc_info=True)
+        return False
 
 
 class TemplatesReader:
     """Generic class to read templates"""
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, entry_id: str = None):
         """
         :param file_path: str, path of your file
+        :param entry_id: str, optional identifier of the experiment to read in multi-experiments files. ONLY ELN
         """
         self.file_path = file_path
+        self.entry_id = entry_id
         self.file = self.read()
 
     def read(self):
@@ -29,7 +70,7 @@ class TemplatesReader:
         elif file_format == 'csv':
             reader = CSVTemplatesReader(self.file_path)
         elif file_format == 'eln':
-            reader = ELNTemplatesReader(self.file_path)
+            reader = ELNTemplatesReader(self.file_path, entry_id=self.entry_id)
         elif file_format == 'elablite':
             reader = ElabLiteTemplatesReader(self.file_path)
         else:
@@ -72,6 +113,10 @@ class TemplatesReader:
         """Read dataframe. ONLY ELABLITE"""
         return self.file.read_dataframe()
 
+    def read_entries(self) -> Dict[str, str]:
+        """Read experiments available in the file {identifier: name}. ONLY ELN"""
+        return self.file.read_entries() if hasattr(self.file, 'read_entries') else {}
+
 
 class JSONTemplatesReader:
 
@@ -84,18 +129,30 @@ class JSONTemplatesReader:
 
     def parse(self) -> Dict:
         """
-        Parses the JSON file and loads the content.
+        Parses the JSON file and loads the content. Unchanged files are served from the templates cache.
         :return: dict, Parsed JSON content
         """
-        with open(self.file_path, 'r') as file:
-            return json.load(file)
+        return TEMPLATES_CACHE.get(self.file_path, self.load, kind='json')
+
+    @staticmethod
+    def load(file_path: str) -> Dict:
+        """
+        Loads the JSON file and decodes its metadata once.
+        :param file_path: str, Path to the JSON template file.
+        :return: dict, Parsed JSON content
+        """
+        with open(file_path, 'r') as file:
+            template = json.load(file)
+        if isinstance(template.get('metadata'), str):
+            template['metadata'] = json.loads(template['metadata'])
+        return template
 
     def read_metadata(self) -> Dict:
         """
-        Reads the metadata from the JSON file.
+        Reads the metadata from the JSON file. The dictionary is shared between sessions, copy it before editing.
         :return: dict, Metadata extracted from the JSON content.
         """
-        return json.loads(self.template['metadata'])
+        return self.template['metadata']
 
     def read_preset(self):
         return None, None
@@ -142,37 +199,138 @@ class CSVTemplatesReader:
 
 class ELNTemplatesReader:
     METADATA_FILE = 'ro-crate-metadata.json'
+    ELABFTW_EXPORT_FILE = 'export-elabftw.json'
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, entry_id: str = None):
         """
         Initializes the ELNTemplatesReader object.
         :param file_path: str, Path to the ELN template file.
+        :param entry_id: str, optional @id of the experiment whose template is read. Defaults to the first one.
         """
         self.file_path = file_path
+        self.entry_id = entry_id
         self.template = self.parse()
 
-    def parse(self):
+    def parse(self) -> Dict:
         """
-        Parses the ELN file, extracts, and displays metadata.
-        :return:
+        Parses the RO-Crate metadata of the ELN file. Unchanged files are served from the templates cache.
+        :return: dict, {'base': folder of the crate in the archive, 'root': @id of the root dataset,
+                        'graph': nodes of the @graph by @id, 'size': size of the RO-Crate metadata}
         """
         try:
-            with ZipFile(self.file_path, "r", compression=ZIP_DEFLATED) as elnFile:
-                p = ZPath(elnFile)
-                dirName = sorted(p.iterdir())[0]
-                metadataJsonFile = dirName.joinpath(self.METADATA_FILE)
-                metadataContent = json.loads(metadataJsonFile.read_bytes())
-                st.info(metadataContent)
+            # charged for the metadata member only, not for the data of the archive
+            return TEMPLATES_CACHE.get(self.file_path, self.load, kind='eln',
+                                       cost=lambda index: index['size'] * PARSED_SIZE_FACTOR)
         except Exception as e:
-            st.error(f"An error occurred: {e}")
-        st.warning('ELN format not yet available')
+            st.error(f"Error parsing ELN file: {e}")
+            raise IOError("The file is invalid or corrupted.") from e
 
-    def read_metadata(self) -> Dict:
+    @classmethod
+    def load(cls, file_path: str) -> Dict:
         """
-        Reads the metadata from the ELN file.
-        :return:
+        Loads the RO-Crate metadata. The member is located with the central directory of the archive, so data members
+        are neither listed nor decompressed.
+        :param file_path: str, Path to the ELN template file.
+        :return: dict, index of the crate
+        """
+        with ZipFile(file_path, "r") as eln_file:
+            candidates = [name for name in eln_file.namelist()
+                          if name == cls.METADATA_FILE or name.endswith('/' + cls.METADATA_FILE)]
+            if not candidates:
+                raise IOError(f"No {cls.METADATA_FILE} in the archive")
+            metadata_name = min(candidates, key=lambda name: name.count('/'))
+            metadata_size = eln_file.getinfo(metadata_name).file_size
+            with eln_file.open(metadata_name) as metadata_file:
+                metadata_content = json.load(metadata_file)
+
+        graph = {node['@id']: node for node in metadata_content.get('@graph', []) if '@id' in node}
+        descriptor = graph.get(cls.METADATA_FILE, {})
+        return {'base': metadata_name[:-len(cls.METADATA_FILE)],
+                'root': descriptor.get('about', {}).get('@id', './'),
+                'graph': graph,
+                'size': metadata_size}
+
+    @staticmethod
+    def _as_list(value) -> List:
+        """JSON-LD values may be a single item or a list"""
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def iter_entries(self):
+        """
+        Walks the @graph and yields the experiments (datasets) of the crate, in the order of the export.
+        :return: generator of dict, dataset nodes
+        """
+        graph = self.template['graph']
+        for part in self._as_list(graph.get(self.template['root'], {}).get('hasPart')):
+            node = graph.get(part.get('@id')) if isinstance(part, dict) else None
+            if node is not None and 'Dataset' in self._as_list(node.get('@type')):
+                yield node
+
+    def read_entries(self) -> Dict[str, str]:
+        """
+        Reads the experiments available in the ELN file.
+        :return: dict, {@id: name}
+        """
+        return {node['@id']: node.get('name', node['@id']) for node in self.iter_entries()}
+
+    def read_entry_metadata(self, node: Dict) -> Dict:
+        """
+        Extracts the extra fields template of an experiment, only decompressing its elabFTW export if any.
+        :param node: dict, dataset node of the experiment
+        :return: dict, metadata of the experiment with 'extra_fields' key, empty if none
+        """
+        graph = self.template['graph']
+        for part in self._as_list(node.get('hasPart')):
+            part_id = part.get('@id', '') if isinstance(part, dict) else ''
+            if part_id.endswith(self.ELABFTW_EXPORT_FILE):
+                member = self.template['base'] + part_id.removeprefix('./')
+                with ZipFile(self.file_path, "r") as eln_file:
+                    with eln_file.open(member) as export_file:
+                        export = json.load(export_file)
+                if isinstance(export, list):
+                    export = export[0] if export else {}
+                metadata = export.get('metadata') or {}
+                if isinstance(metadata, str):
+                    metadata = json.loads(metadata)
+                if metadata.get('extra_fields'):
+                    return metadata
+
+        # Fallback on the properties described in the crate
+        extra_fields = {}
+        for position, reference in enumerate(self._as_list(node.get('variableMeasured'))):
+            prop = graph.get(reference.get('@id'), reference) if isinstance(reference, dict) else {}
+            name = prop.get('propertyID') or prop.get('name')
+            if not name:
+                continue
+            extra_fields[name] = {'type': 'number' if 'unitText' in prop else 'text',
+                                  'value': prop.get('value', ''),
+                                  'position': position}
+            if 'unitText' in prop:
+                extra_fields[name]['unit'] = prop['unitText']
+                extra_fields[name]['units'] = [prop['unitText']]
+        return {'extra_fields': extra_fields} if extra_fields else {}
+
+    def read_metadata(self) -> Dict:
         """
-        st.warning('ELN format not yet available')
+        Reads the metadata of the selected experiment, or of the first experiment having extra fields. The dictionary
+        is shared between sessions, copy it before editing.
+        :return: dict, metadata of the experiment
+        """
+        return TEMPLATES_CACHE.get(self.file_path, self._load_entry_metadata, kind=f'eln:{self.entry_id}',
+                                   cost=json_cost)
+
+    def _load_entry_metadata(self, file_path: str) -> Dict:
+        """Find the experiment to read and extract its template"""
+        for node in self.iter_entries():
+            if self.entry_id is None or node['@id'] == self.entry_id:
+                metadata = self.read_entry_metadata(node)
+                if metadata or self.entry_id is not None:
+                    return metadata
+        if self.entry_id is not None:
+            raise KeyError(f"Experiment {self.entry_id} not found in {file_path}")
+        return {}
 
     def read_preset(self):
         return None, None
@@ -185,46 +343,90 @@ class ElabLiteTemplatesReader:
 
     def __init__(self, file_path: str):
         """
-        Initializes the ElabLiteTemplatesReader object. MIME/TYPE : application/json
+        Initializes the ElabLiteTemplatesReader object. MIME/TYPE : application/zip (v2), application/octet-stream (v1)
         :param file_path: str, Path to the ElabLite template file.
         """
         self.file_path = file_path
         self.template = self.parse()
 
-    def parse(self):
+    def parse(self) -> Dict:
         """
-        Parses the ElabLite file, extracts, and displays metadata.
-        :return:
+        Parses the header of the ElabLite file. Sections are loaded on demand. Version 1 files (pickle) are loaded
+        entirely. Unchanged files are served from the templates cache.
+        :return: dict, header of the file
         """
         try:
-            with open(self.file_path, 'rb') as file:
-                data = pickle.load(file)
-                if data['@context'] != 'http://example.org/elablite/v1.0/':
-                    raise IOError("The file is invalid or corrupted.")
-            return data
+            return TEMPLATES_CACHE.get(self.file_path, self.load, kind='elablite', cost=self.header_cost)
         except Exception as e:
             st.error(f"Error parsing ElabLite file: {e}")
             raise IOError("The file is invalid or corrupted.") from e
 
+    @staticmethod
+    def load(file_path: str) -> Dict:
+        """
+        Loads the header of the ElabLite file, or the whole content of a version 1 file.
+        :param file_path: str, Path to the ElabLite template file.
+        :return: dict, header of the save
+        """
+        if elablite.is_v1(file_path):
+            return {'format_version': 1, 'data': elablite.load_v1(file_path), 'size': os.path.getsize(file_path)}
+        return elablite.read_header(file_path)
+
+    @staticmethod
+    def header_cost(template: Dict) -> int:
+        """
+        Memory cost of the loaded header: the header alone, the sections and the table being cached separately, or the
+        whole content of a version 1 file.
+        :param template: dict, loaded by load()
+        :return: int, bytes
+        """
+        if template['format_version'] == 1:
+            return template['size'] * PARSED_SIZE_FACTOR
+        return json_cost(template)
+
+    @staticmethod
+    def table_cost(dataframe: pd.DataFrame) -> int:
+        """Memory cost of the loaded table (memory-mapped columns included)"""
+        return 0 if dataframe is None else int(dataframe.memory_usage(deep=True).sum())
+
+    def read_section(self, name: str):
+        """
+        Reads a section of the ElabLite file. The content is shared between sessions, copy it before editing.
+        :param name: str, name of the section (metadata_base, form_data, template_metadata)
+        :return: content of the section
+        """
+        if self.template['format_version'] == 1:
+            return self.template['data'][name]
+        return TEMPLATES_CACHE.get(self.file_path, lambda path: elablite.read_section(path, name),
+                                   kind=f'elablite:{name}', cost=json_cost)
+
     def read_metadata(self) -> Dict:
         """
-        Reads the metadata from the ElabLite file.
+        Reads the metadata from the ElabLite file. The dictionary is shared between sessions, copy it before editing.
         :return:
         """
-        return self.template['template_metadata']
+        return self.read_section('template_metadata')
 
     def read_preset(self) -> tuple[Dict, Dict]:
         """
-        Read preset save in Elablite file.
+        Read preset save in Elablite file. Copies are returned as sessions edit them.
         metadata_base : generic information (date, author, title, etc ...)
         form_data : experience metadata
         :return: tuple(Dict['metadata_base'], Dict['form_data'])
         """
-        return self.template['metadata_base'], self.template['form_data']
+        return copy.deepcopy(self.read_section('metadata_base')), copy.deepcopy(self.read_section('form_data'))
 
-    def read_dataframe(self) -> pd.DataFrame:
+    def read_dataframe(self, copy_: bool = True) -> pd.DataFrame:
         """
-        Reads the dataframe from the ElabLite file.
+        Reads the dataframe from the ElabLite file. The table is only loaded when requested, numeric columns are
+        memory-mapped.
+        :param copy_: bool, return an editable copy (sessions edit it). Otherwise the shared read-only table.
         :return: Dataframe
         """
-        return self.template['dataframe_metadata']
+        if self.template['format_version'] == 1:
+            dataframe = self.template['data']['dataframe_metadata']
+        else:
+            dataframe = TEMPLATES_CACHE.get(self.file_path,
+                                            lambda path: elablite.read_table(path, self.template),
+                                            kind='elablite:table', cost=self.table_cost)
+        return dataframe.copy() if dataframe is not None and copy_ else dataframe
@@ -0,0 +1,370 @@
+"""
+Export pipeline without the Streamlit runtime: preset (or template and metadata table) -> mapping of the raw files
+-> new filenames and titles -> validation -> experiences CSV and zip archive. Used by the command line (cli.py), the
+export service (utils.service) and the background exports of page 4.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Tuple, Union
+
+import pandas as pd
+from pandas import DataFrame
+
+from models.technical import DEFAULT_FILENAME_PATTERN
+from models.validator import validate_dataframe
+from utils.archive import Source
+from utils.export import deduplicate, find_collisions, generate_filenames, generate_titles, iter_csv, \
+    iter_dataframe_csv
+from utils.manager import files_management, zip_experience
+from utils.mapping import MappingReport, match_files
+from utils.parser import TemplatesReader
+from utils.tracing import collect, current_collector
+from utils.units import typed_table
+
+logger = logging.getLogger(__name__)
+
+# progress of a job: (stage, done, total, bytes written in the archive)
+Progress = Callable[[str, int, int, int], None]
+STAGES = ('loading', 'mapping', 'naming', 'validating', 'renaming', 'serializing', 'zipping')
+
+
+@dataclass(frozen=True)
+class LocalFile:
+    """
+    Raw file of a directory, read by chunks when written in the archive (see utils.archive.open_source).
+
+    Attributes:
+        name (str): Filename.
+        path (str): Path of the file.
+    """
+    name: str
+    path: str
+
+    def open(self) -> BinaryIO:
+        return open(self.path, 'rb')
+
+
+@dataclass
+class Job:
+    """
+    Export of an experiment: a preset (.elablite), or a template with a metadata table (CSV) and base metadata.
+
+    Attributes:
+        files (str | Dict[str, str]): Directory of the raw files, or paths of the raw files by filename.
+        output (str): Path of the zip archive written.
+        preset (str, optional): Path of the .elablite preset.
+        template (str, optional): Path of the template (json, eln), with `table` and `metadata_base`.
+        table (str, optional): Path of the metadata table (CSV), one row by analysis.
+        metadata_base (Dict, optional): Base metadata of a template job (date, title, technical, ...).
+        pattern (str, optional): Filename pattern, defaults to DEFAULT_FILENAME_PATTERN.
+        columns (List[str]): Columns included in the new filenames (in order), files are not renamed if empty.
+        grouped (bool): All the analyses in one experience.
+        auto_suffix (bool): Suffix the duplicated names instead of failing.
+        skip_unmatched (bool): Drop the rows without file instead of failing.
+        force (bool): Export a table with invalid cells.
+        prepared (bool): The table of the preset is already mapped and named (columns 'Filename', 'new_title' and
+            optionally 'new_Filename', e.g. saved by the Streamlit pages), only the archive is written.
+        compression (str): Compression algorithm of the archive (see utils.archive.COMPRESSIONS).
+        compresslevel (int, optional): Compression level.
+        workers (int, optional): Threads compressing the files of the job.
+    """
+    files: Union[str, Dict[str, str]]
+    output: str
+    preset: str = None
+    template: str = None
+    table: str = None
+    metadata_base: Dict = None
+    pattern: str = None
+    columns: List[str] = field(default_factory=list)
+    grouped: bool = False
+    auto_suffix: bool = True
+    skip_unmatched: bool = False
+    force: bool = False
+    prepared: bool = False
+    compression: str = 'deflate'
+    compresslevel: int = None
+    workers: int = None
+
+    @property
+    def name(self) -> str:
+        """Name of the job in the logs"""
+        return os.path.basename(self.preset or self.table or self.output)
+
+
+@dataclass
+class JobResult:
+    """
+    Outcome of a job.
+
+    Attributes:
+        name (str): Name of the job.
+        output (str): Path of the archive, None if the job failed.
+        rows (int): Analyses exported.
+        files (int): Raw files in the archive.
+        warnings (List[str]): Issues which didn't stop the export.
+        error (str, optional): Reason of the failure.
+        seconds (float): Duration of the job.
+    """
+    name: str
+    output: str = None
+    rows: int = 0
+    files: int = 0
+    warnings: List[str] = field(default_factory=list)
+    error: str = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def list_files(directory: Union[str, Dict[str, str]]) -> Dict[str, LocalFile]:
+    """
+    Raw files of a directory (not recursive, hidden files ignored), by filename.
+    :param directory: str, or dict of the paths of the files by filename
+    :return: dict, LocalFile by filename, sorted by name
+    """
+    if isinstance(directory, dict):
+        return {name: LocalFile(name, path) for name, path in sorted(directory.items())}
+    with os.scandir(directory) as entries:
+        files = {entry.name: LocalFile(entry.name, entry.path) for entry in entries
+                 if entry.is_file() and not entry.name.startswith('.')}
+    return dict(sorted(files.items()))
+
+
+def load_job(job: Job) -> Tuple[Dict, Dict, DataFrame]:
+    """
+    Reads the metadata of a job.
+    :param job: Job
+    :return: tuple(base metadata, template metadata, typed metadata table)
+    """
+    if job.preset is not None:
+        reader = TemplatesReader(job.preset)
+        metadata_base, _ = reader.read_preset()
+        template_metadata = reader.read_metadata()
+        df = reader.read_dataframe()
+        if metadata_base is None or df is None:
+            raise ValueError(f"{job.preset} is not a preset with a metadata table")
+    else:
+        if job.template is None or job.table is None or job.metadata_base is None:
+            raise ValueError("A job needs a preset, or a template with a metadata table and base metadata")
+        template_metadata = TemplatesReader(job.template).read_metadata()
+        metadata_base = job.metadata_base
+        df = pd.read_csv(job.table, dtype=object)
+    if not job.prepared:
+        # files are mapped again
+        df = df.drop(columns='Filename', errors='ignore')
+    return metadata_base, template_metadata, typed_table(df, template_metadata)
+
+
+def map_files(df: DataFrame, filenames: Iterable[str], pattern: str,
+              skip_unmatched: bool = False) -> Tuple[DataFrame, MappingReport]:
+    """
+    Maps the raw files to the rows of the table, in the 'Filename' column.
+    :param df: DataFrame, metadata table
+    :param filenames: iterable of str
+    :param pattern: str, filename pattern (see utils.mapping.match_files)
+    :param skip_unmatched: bool, drop the rows without file instead of raising ValueError
+    :return: tuple(table with the 'Filename' column, MappingReport)
+    """
+    report = match_files(df, filenames, pattern)
+    df = df.copy(deep=False)
+    df['Filename'] = pd.Series(report.matches, dtype=object).reindex(df.index)
+    if report.unmatched_rows:
+        if not skip_unmatched:
+            raise ValueError(f"{len(report.unmatched_rows)} row(s) without file, e.g. row "
+                             f"{report.unmatched_rows[0]}")
+        df = df.drop(index=report.unmatched_rows)
+    return df, report
+
+
+def name_experiences(df: DataFrame, metadata_base: Dict, columns: List[str], grouped: bool,
+                     auto_suffix: bool = True) -> DataFrame:
+    """
+    Titles of the experiences and new filenames, checked for collisions.
+    :param df: DataFrame, metadata table with the 'Filename' column (modified in place)
+    :param metadata_base: dict, base metadata (title, date, technical, project_shortname)
+    :param columns: list, columns included in the new filenames, files are not renamed if empty
+    :param grouped: bool, all the analyses in one experience (titles are not checked)
+    :param auto_suffix: bool, suffix the duplicated names instead of raising ValueError
+    :return: DataFrame
+    """
+    df['new_title'] = generate_titles(df, metadata_base['title'])
+    if columns:
+        df['new_Filename'] = generate_filenames(df, columns, date=metadata_base['date'].strftime('%Y%m%d'),
+                                                code=metadata_base['technical'].code,
+                                                shortname=metadata_base.get('project_shortname'))
+    names = ['new_Filename' if columns else 'Filename'] + ([] if grouped else ['new_title'])
+    for column in names:
+        collisions = find_collisions(df[column])
+        if not collisions.any():
+            continue
+        if not auto_suffix or column == 'Filename':
+            raise ValueError(f"{int(collisions.sum())} rows share the same '{column}'")
+        df[column] = deduplicate(df[column], extension=column == 'new_Filename')
+    return df
+
+
+def write_archive(df: DataFrame, metadata_base: Dict, template_metadata: Dict, files: Mapping[str, Source],
+                  grouped: bool, output: str, compression: str = 'deflate', compresslevel: int = None,
+                  workers: int = None, progress: Progress = None) -> Tuple[int, List[Tuple[int, str]]]:
+    """
+    Writes the zip archive of a metadata table already mapped and named: experiences CSV, logs and renamed files.
+    :param df: DataFrame, metadata table with the columns 'Filename', 'new_title' and optionally 'new_Filename'
+    :param metadata_base: dict, base metadata
+    :param template_metadata: dict, metadata template
+    :param files: mapping of the raw files by filename (LocalFile, UploadHandle)
+    :param grouped: bool, all the analyses in one experience
+    :param output: str, path of the archive
+    :param compression: str, compression algorithm (see utils.archive.COMPRESSIONS)
+    :param compresslevel: int, optional, compression level
+    :param workers: int, optional, threads compressing the files
+    :param progress: callable(stage, done, total, bytes), optional, called for the renaming, after each chunk of rows
+                     serialized and after each file written
+    :return: tuple(files written, (row, column) whose value and unit can't be parsed)
+    """
+    progress = progress or (lambda stage, done, total, size: None)
+    progress('renaming', 0, len(df), 0)
+    grouped_files = files_management(uploaded_files=files, df_mtda=df, grouped=grouped)
+    errors = []
+    csv_chunks = iter_csv(metadata_base, df, template_metadata, grouped, errors=errors,
+                          progress=lambda done, total: progress('serializing', done, total, 0))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    zip_experience(csv_chunks=csv_chunks, uploaded_files=grouped_files, logs_process=iter_dataframe_csv(df),
+                   grouped=grouped, output=output, compression=compression, compresslevel=compresslevel,
+                   workers=workers, progress=lambda done, total, size: progress('zipping', done, total, size)).close()
+    return sum(len(names) for names in grouped_files.values()), errors
+
+
+def run_job(job: Job, progress: Progress = None) -> JobResult:
+    """
+    Runs a job, the errors are reported in the result.
+    :param job: Job
+    :param progress: callable(stage, done, total, bytes), optional, called at each stage (see STAGES) and while the
+                     archive is written
+    :return: JobResult
+    """
+    start = time.perf_counter()
+    result = JobResult(name=job.name)
+    progress = progress or (lambda stage, done, total, size: None)
+    try:
+        progress('loading', 0, 0, 0)
+        metadata_base, template_metadata, df = load_job(job)
+        files = list_files(job.files)
+        if not job.prepared:
+            progress('mapping', 0, len(files), 0)
+            pattern = job.pattern or DEFAULT_FILENAME_PATTERN
+            df, mapping = map_files(df, files, pattern, skip_unmatched=job.skip_unmatched)
+            if mapping.unmatched_files:
+                result.warnings.append(f"{len(mapping.unmatched_files)} file(s) mapped to no row")
+            if mapping.ambiguous_rows:
+                result.warnings.append(f"{len(mapping.ambiguous_rows)} row(s) matching several files")
+            progress('naming', 0, len(df), 0)
+            df = name_experiences(df, metadata_base, job.columns, job.grouped, job.auto_suffix)
+
+        progress('validating', 0, len(df), 0)
+        report = validate_dataframe(df, template_metadata)
+        if not report.empty:
+            message = (f"{len(report)} invalid cell(s) in the column(s) "
+                       f"{', '.join(repr(col) for col in report['column'].unique())}")
+            if not job.force:
+                raise ValueError(message)
+            result.warnings.append(message)
+
+        result.files, errors = write_archive(df, metadata_base, template_metadata, files, job.grouped, job.output,
+                                             job.compression, job.compresslevel, job.workers, progress)
+        if errors:
+            result.warnings.append(f"value and unit not parsed in {len(errors)} cell(s)")
+        result.output = job.output
+        result.rows = len(df)
+    except Exception as e:
+        logger.debug("Job %s failed", job.name, exc_info=True)
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def run_jobs(jobs: List[Job], processes: int = None) -> Iterator[JobResult]:
+    """
+    Runs jobs in parallel in a process pool (in this process if there is a single process or job).
+    :param jobs: list of Job
+    :param processes: int, number of processes, defaults to the number of cores
+    :return: generator of JobResult, in order of completion
+    """
+    processes = min(processes or os.cpu_count() or 1, max(len(jobs), 1))
+    if processes == 1:
+        yield from map(run_job, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class BackgroundExport(threading.Thread):
+    """
+    Export of the metadata table of page 4, already mapped, named and validated, written in a background thread: the
+    page polls `status()` while the archive is written instead of being frozen until the end.
+    """
+
+    def __init__(self, df: DataFrame, metadata_base: Dict, template_metadata: Dict, files: Mapping[str, Source],
+                 grouped: bool, output: str, compression: str = 'deflate', compresslevel: int = None):
+        """
+        :param df: DataFrame, metadata table with the columns 'Filename', 'new_title' and optionally 'new_Filename'
+        :param metadata_base: dict, base metadata
+        :param template_metadata: dict, metadata template
+        :param files: mapping of the uploaded files by filename (UploadStore)
+        :param grouped: bool, all the analyses in one experience
+        :param output: str, path of the archive
+        :param compression: str, compression algorithm (see utils.archive.COMPRESSIONS)
+        :param compresslevel: int, optional, compression level
+        """
+        super().__init__(name='elablite-export', daemon=True)
+        self.df = df
+        self.metadata_base = metadata_base
+        self.template_metadata = template_metadata
+        # the files of the export, not the uploads added or removed meanwhile
+        self.files = dict(files)
+        self.grouped = grouped
+        self.output = output
+        self.compression = compression
+        self.compresslevel = compresslevel
+        # (row, column) whose value and unit can't be parsed
+        self.errors: List[Tuple[int, str]] = []
+        # timings recorded for the session starting the export
+        self.collector = current_collector()
+        self._lock = threading.Lock()
+        self._state = {'status': 'queued', 'stage': None, 'done': 0, 'total': 0, 'bytes': 0, 'error': None}
+
+    def _progress(self, stage: str, done: int, total: int, size: int):
+        with self._lock:
+            self._state.update(stage=stage, done=done, total=total, bytes=size or self._state['bytes'])
+
+    def status(self) -> Dict:
+        """
+        Status of the export, as the jobs of the export service.
+        :return: dict, 'status' ('queued', 'running', 'done' or 'failed'), 'stage', 'done', 'total', 'bytes', 'error'
+        """
+        with self._lock:
+            return dict(self._state)
+
+    def run(self):
+        with self._lock:
+            self._state['status'] = 'running'
+        try:
+            with collect(self.collector):
+                _, self.errors = write_archive(self.df, self.metadata_base, self.template_metadata, self.files,
+                                               self.grouped, self.output, self.compression, self.compresslevel,
+                                               progress=self._progress)
+            status, error = 'done', None
+        except Exception as e:
+            logger.debug("Export %s failed", self.output, exc_info=True)
+            if os.path.exists(self.output):
+                os.remove(self.output)
+            status, error = 'failed', f"{type(e).__name__}: {e}"
+        with self._lock:
+            self._state.update(status=status, error=error)
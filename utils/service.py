@@ -0,0 +1,427 @@
+"""
+Local export service: the archives are generated by a bounded pool of processes, outside the Streamlit script thread,
+so a large export neither blocks the session of its user nor the exports of the other users.
+
+    python -m utils.service --port 8502 --processes 4
+
+API (JSON bodies, encoded as the .elablite sections for dates and techniques):
+    POST   /jobs               submit a job, fields of utils.pipeline.Job except 'output' -> 202 {"id": ...}
+    GET    /jobs/<id>          status ('queued', 'running', 'done', 'failed') and progress of the job
+    GET    /jobs/<id>/archive  zip archive of a finished job
+    DELETE /jobs/<id>          forget the job and remove its archive
+
+The jobs read local paths (presets, raw files): the service listens on 127.0.0.1 only, and every request carries
+the token of the service process ("Authorization: Bearer <token>"), so other local users can't submit jobs. The token
+is ELABLITE_SERVICE_TOKEN if set, else generated at startup and written in a file readable by the user of the service
+only (see token_path), where the clients of the same user read it. The pages submit their exports to the service when
+the environment variable ELABLITE_SERVICE_URL is set (e.g. http://127.0.0.1:8502).
+"""
+import argparse
+import hmac
+import logging
+import multiprocessing
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import gettempdir, mkstemp
+from typing import Dict
+from urllib import request as urlrequest
+from urllib.parse import urlsplit
+
+from utils import elablite
+from utils.manager import manage_temp_dir
+from utils.pipeline import Job, JobResult, run_job
+
+logger = logging.getLogger(__name__)
+
+SERVICE_URL = os.environ.get("ELABLITE_SERVICE_URL")
+# token shared by the service and its clients, generated by the service if not set
+SERVICE_TOKEN = os.environ.get("ELABLITE_SERVICE_TOKEN")
+# jobs read local paths, the service is never exposed beyond the host
+HOST = "127.0.0.1"
+DEFAULT_PORT = 8502
+# jobs queued or running at once, above which submissions are refused
+MAX_PENDING = int(os.environ.get("ELABLITE_SERVICE_MAX_JOBS", 16))
+# finished jobs and their archives are removed after this delay
+JOB_TTL = 3600
+# minimal delay between two progress messages of a job
+PROGRESS_INTERVAL = 0.2
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 10
+JOB_PATH = re.compile(r'^/jobs/([0-9a-f]{32})(/archive)?$')
+
+# progress queue of the worker processes
+_progress_queue = None
+
+
+def token_path(port: int) -> str:
+    """
+    File of the token of the service listening on a port.
+    :param port: int
+    :return: str, path in the tmp dir
+    """
+    return os.path.join(gettempdir(), f"elablite-service-{port}.token")
+
+
+def write_token(port: int) -> str:
+    """
+    Token of the service process, written in its file with the permissions of the user only (0600).
+    :param port: int, port of the service
+    :return: str, token
+    """
+    token = SERVICE_TOKEN or secrets.token_urlsafe(32)
+    # new file (mkstemp: 0600, never an existing one), then moved over the token of a previous run
+    fd, tmp_path = mkstemp(prefix='.elablite-service-', dir=gettempdir())
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(token)
+        os.replace(tmp_path, token_path(port))
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    return token
+
+
+def read_token(service_url: str) -> str:
+    """
+    Token of the service, ELABLITE_SERVICE_TOKEN or the token file of its port.
+    :param service_url: str, e.g. http://127.0.0.1:8502
+    :return: str, None if the service hasn't written any token
+    """
+    if SERVICE_TOKEN:
+        return SERVICE_TOKEN
+    try:
+        with open(token_path(urlsplit(service_url).port or 80)) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _init_worker(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def _run(job_id: str, job: Job) -> JobResult:
+    """Runs a job in a worker process, its progress being sent to the service"""
+    last = {'stage': None, 'time': 0.0}
+
+    def progress(stage: str, done: int, total: int, size: int):
+        now = time.monotonic()
+        if stage != last['stage'] or done == total or now - last['time'] >= PROGRESS_INTERVAL:
+            last.update(stage=stage, time=now)
+            _progress_queue.put((job_id, stage, done, total, size))
+
+    return run_job(job, progress)
+
+
+class ServiceBusy(Exception):
+    """Too many jobs queued"""
+
+
+@dataclass
+class JobState:
+    """
+    State of a job of the service.
+
+    Attributes:
+        id (str): Identifier of the job.
+        name (str): Name of the job.
+        output (str): Path of the archive.
+        status (str): 'queued', 'running', 'done' or 'failed'.
+        stage (str): Current stage (see utils.pipeline.STAGES).
+        done (int): Progress of the stage.
+        total (int): Size of the stage (0 if unknown).
+        bytes (int): Compressed bytes written in the archive.
+        submitted (float): Timestamp of the submission.
+        finished (float): Timestamp of the end of the job.
+        result (JobResult): Outcome of the job, once finished.
+    """
+    id: str
+    name: str
+    output: str
+    status: str = 'queued'
+    stage: str = None
+    done: int = 0
+    total: int = 0
+    bytes: int = 0
+    submitted: float = field(default_factory=time.time)
+    finished: float = None
+    result: JobResult = None
+
+    def to_dict(self) -> Dict:
+        content = {'id': self.id, 'name': self.name, 'status': self.status, 'stage': self.stage,
+                   'done': self.done, 'total': self.total, 'bytes': self.bytes, 'submitted': self.submitted,
+                   'finished': self.finished}
+        if self.result is not None:
+            content.update(rows=self.result.rows, files=self.result.files, warnings=self.result.warnings,
+                           error=self.result.error, seconds=self.result.seconds)
+        return content
+
+
+class ExportService:
+    """Jobs of the service, run in a bounded process pool"""
+
+    def __init__(self, directory: str = None, processes: int = None, max_pending: int = MAX_PENDING):
+        """
+        :param directory: str, directory of the archives (defaults to tmp dir service/)
+        :param processes: int, worker processes (defaults to the number of cores)
+        :param max_pending: int, jobs queued or running at once
+        """
+        self.directory = directory or manage_temp_dir(child='service')
+        self.max_pending = max_pending
+        self.jobs: Dict[str, JobState] = {}
+        self.lock = threading.Lock()
+        self.queue = multiprocessing.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(self.queue,))
+        self.listener = threading.Thread(target=self._listen, name='elablite-progress', daemon=True)
+        self.listener.start()
+
+    def submit(self, fields: Dict) -> JobState:
+        """
+        Queues a job.
+        :param fields: dict, fields of utils.pipeline.Job except 'output'
+        :return: JobState
+        """
+        self.cleanup()
+        with self.lock:
+            pending = sum(state.status in ('queued', 'running') for state in self.jobs.values())
+            if pending >= self.max_pending:
+                raise ServiceBusy(f"{pending} jobs pending, retry later")
+            job_id = uuid.uuid4().hex
+            fields = {key: value for key, value in fields.items() if key != 'output'}
+            try:
+                job = Job(output=os.path.join(self.directory, f"{job_id}.zip"), **fields)
+            except TypeError as e:
+                raise ValueError(f"Invalid job: {e}") from e
+            state = JobState(id=job_id, name=job.name, output=job.output)
+            self.jobs[job_id] = state
+        future = self.executor.submit(_run, job_id, job)
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        logger.info("Job %s submitted (%s)", job_id, job.name)
+        return state
+
+    def _finish(self, job_id: str, future: Future):
+        with self.lock:
+            state = self.jobs.get(job_id)
+            if state is None:
+                return
+            try:
+                state.result = future.result()
+            except Exception as e:
+                state.result = JobResult(name=state.name, error=f"{type(e).__name__}: {e}")
+            state.status = 'done' if state.result.ok else 'failed'
+            state.finished = time.time()
+        logger.info("Job %s %s", job_id, state.status)
+
+    def _listen(self):
+        """Progress sent by the workers"""
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            job_id, stage, done, total, size = message
+            with self.lock:
+                state = self.jobs.get(job_id)
+                # the last messages can arrive after the end of the job
+                if state is not None and state.status in ('queued', 'running'):
+                    state.status, state.stage, state.done, state.total = 'running', stage, done, total
+                    state.bytes = size or state.bytes
+
+    def status(self, job_id: str) -> JobState:
+        """
+        :param job_id: str
+        :return: JobState, raise KeyError if the job is unknown
+        """
+        with self.lock:
+            return self.jobs[job_id]
+
+    def remove(self, job_id: str):
+        """Forgets a job and removes its archive"""
+        with self.lock:
+            state = self.jobs.pop(job_id)
+        if os.path.exists(state.output):
+            os.remove(state.output)
+
+    def cleanup(self):
+        """Removes the jobs finished for longer than JOB_TTL"""
+        now = time.time()
+        with self.lock:
+            expired = [job_id for job_id, state in self.jobs.items()
+                       if state.finished is not None and now - state.finished > JOB_TTL]
+        for job_id in expired:
+            self.remove(job_id)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.queue.put(None)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP API of the export service (see the module documentation)"""
+    server_version = "ElabLite"
+
+    @property
+    def service(self) -> ExportService:
+        return self.server.service
+
+    def _send_json(self, status: HTTPStatus, content: Dict):
+        body = elablite.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        """Checks the token of the request, sends a 401 error if it doesn't match"""
+        expected = f"Bearer {self.server.token}".encode('utf-8')
+        if hmac.compare_digest(self.headers.get("Authorization", "").encode('utf-8', 'replace'), expected):
+            return True
+        self._send_json(HTTPStatus.UNAUTHORIZED, {'error': "Invalid token"})
+        return False
+
+    def _job(self):
+        """Job of the path, or None if an error was sent"""
+        match = JOB_PATH.match(self.path)
+        if match is None:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': "Unknown path"})
+            return None, False
+        try:
+            return self.service.status(match.group(1)), bool(match.group(2))
+        except KeyError:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': "Unknown job"})
+            return None, False
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != '/jobs':
+            return self._send_json(HTTPStatus.NOT_FOUND, {'error': "Unknown path"})
+        if self.headers.get_content_type() != "application/json":
+            return self._send_json(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, {'error': "The job must be sent as JSON"})
+        try:
+            fields = elablite.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(fields, dict):
+                raise ValueError("The job must be a JSON object")
+            state = self.service.submit(fields)
+        except ServiceBusy as e:
+            return self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(e)})
+        except ValueError as e:
+            return self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+        self._send_json(HTTPStatus.ACCEPTED, state.to_dict())
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == '/health':
+            return self._send_json(HTTPStatus.OK, {'jobs': len(self.service.jobs)})
+        state, archive = self._job()
+        if state is None:
+            return
+        if not archive:
+            return self._send_json(HTTPStatus.OK, state.to_dict())
+        if state.status != 'done':
+            return self._send_json(HTTPStatus.CONFLICT, {'error': f"The job is {state.status}"})
+        with open(state.output, 'rb') as archive_file:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(os.fstat(archive_file.fileno()).st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{state.id}.zip"')
+            self.end_headers()
+            shutil.copyfileobj(archive_file, self.wfile, CHUNK_SIZE)
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        state, _ = self._job()
+        if state is not None:
+            self.service.remove(state.id)
+            self._send_json(HTTPStatus.OK, {'id': state.id})
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(port: int = DEFAULT_PORT, processes: int = None, directory: str = None):
+    """
+    Runs the export service on 127.0.0.1 until interrupted.
+    :param port: int
+    :param processes: int, worker processes
+    :param directory: str, directory of the archives
+    """
+    server = ThreadingHTTPServer((HOST, port), ServiceHandler)
+    server.token = write_token(port)
+    server.service = ExportService(directory=directory, processes=processes)
+    logger.info("ElabLite export service on http://%s:%d (token in %s)", HOST, port, token_path(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+        os.remove(token_path(port))
+
+
+### CLIENT ###
+
+def _headers(service_url: str) -> Dict:
+    """Headers of the requests, with the token of the service"""
+    return {"Content-Type": "application/json", "Authorization": f"Bearer {read_token(service_url) or ''}"}
+
+
+def _request(method: str, service_url: str, path: str, content: Dict = None) -> Dict:
+    data = None if content is None else elablite.dumps(content)
+    req = urlrequest.Request(f"{service_url.rstrip('/')}{path}", data=data, method=method,
+                             headers=_headers(service_url))
+    with urlrequest.urlopen(req, timeout=TIMEOUT) as response:
+        return elablite.loads(response.read())
+
+
+def submit_job(service_url: str, **fields) -> Dict:
+    """
+    Submits a job to the export service.
+    :param service_url: str, e.g. http://127.0.0.1:8502
+    :param fields: fields of utils.pipeline.Job except 'output'
+    :return: dict, status of the job (with its 'id'). Raise urllib.error.URLError if the service is unavailable
+    """
+    return _request("POST", service_url, "/jobs", fields)
+
+
+def job_status(service_url: str, job_id: str) -> Dict:
+    """
+    :return: dict, status and progress of a job
+    """
+    return _request("GET", service_url, f"/jobs/{job_id}")
+
+
+def download_archive(service_url: str, job_id: str, path: str) -> str:
+    """
+    Downloads the archive of a finished job by chunks, then forgets the job.
+    :param path: str, path of the archive written
+    :return: str, path
+    """
+    req = urlrequest.Request(f"{service_url.rstrip('/')}/jobs/{job_id}/archive", headers=_headers(service_url))
+    with urlrequest.urlopen(req, timeout=TIMEOUT) as response, open(path, 'wb') as file:
+        shutil.copyfileobj(response, file, CHUNK_SIZE)
+    _request("DELETE", service_url, f"/jobs/{job_id}")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ElabLite export service")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--processes", type=int, help="Worker processes (default: number of cores)")
+    parser.add_argument("--directory", help="Directory of the archives (default: tmp dir)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    serve(args.port, args.processes, args.directory)
@@ -0,0 +1,117 @@
+"""
+Lightweight tracing of the slow stages (template parsing, form rendering, filename mapping, CSV generation, file
+renaming and zipping): wall time, CPU time of the thread and bytes processed.
+
+Every span is emitted as a structured log line (logger 'elablite.trace', JSON record), at DEBUG level by default and
+at INFO level in debug mode (ELABLITE_DEBUG=1), where the spans of a session are also listed in the sidebar.
+"""
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterator, Optional
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+logger = logging.getLogger('elablite.trace')
+
+DEBUG = os.environ.get("ELABLITE_DEBUG", "").lower() in ('1', 'true', 'yes')
+# spans of a session kept for the sidebar
+MAX_TRACES = 50
+
+# spans recorded outside the script thread (background export, prefetch) for a session
+_collector: ContextVar[Optional[Deque[Dict]]] = ContextVar('elablite_trace_collector', default=None)
+
+
+@dataclass
+class Span:
+    """
+    Measure of a stage, filled by the traced code.
+
+    Attributes:
+        name (str): Stage (e.g. 'parsing', 'zipping').
+        attributes (Dict): Context of the stage (file, rows, files, ...).
+        bytes (int): Bytes processed by the stage.
+        wall (float): Wall time in seconds.
+        cpu (float): CPU time of the thread running the stage in seconds (the other sessions of the server are not
+            counted, neither are the compression workers: compare the wall time for the zipping).
+    """
+    name: str
+    attributes: Dict = field(default_factory=dict)
+    bytes: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+
+    def to_dict(self) -> Dict:
+        return {'stage': self.name, 'wall_ms': round(self.wall * 1000, 3), 'cpu_ms': round(self.cpu * 1000, 3),
+                'bytes': self.bytes, **self.attributes}
+
+
+def current_collector() -> Optional[Deque[Dict]]:
+    """
+    Spans of the current session in debug mode: the collector set by `collect`, else the traces of the Streamlit
+    session of the script thread.
+    :return: deque of span records, None outside a session or without debug mode
+    """
+    collector = _collector.get()
+    if collector is None and DEBUG and get_script_run_ctx(suppress_warning=True) is not None:
+        if 'traces' not in st.session_state:
+            st.session_state['traces'] = deque(maxlen=MAX_TRACES)
+        collector = st.session_state['traces']
+    return collector
+
+
+@contextmanager
+def collect(collector: Optional[Deque[Dict]]) -> Iterator[None]:
+    """
+    Records the spans of a block in a collector, e.g. in a background thread working for a session.
+    :param collector: deque of span records (see current_collector), None to only log them
+    """
+    token = _collector.set(collector)
+    try:
+        yield
+    finally:
+        _collector.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[Span]:
+    """
+    Measures a block and emits its span when it ends, even on error.
+
+    Example:
+        with trace('parsing', file=name) as span:
+            template = load(path)
+            span.bytes = size
+
+    :param name: str, stage
+    :param attributes: context of the stage, logged with the measures
+    :return: Span, whose bytes and attributes can be filled in the block
+    """
+    span = Span(name, attributes)
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield span
+    finally:
+        span.wall = time.perf_counter() - wall
+        span.cpu = time.thread_time() - cpu
+        record = span.to_dict()
+        logger.log(logging.INFO if DEBUG else logging.DEBUG, "trace %s", json.dumps(record, default=str))
+        collector = current_collector()
+        if collector is not None:
+            collector.append(record)
+
+
+def show_traces():
+    """Spans of the session, most recent first, in the sidebar container of the menu (debug mode only)"""
+    traces = st.session_state.get('traces') if DEBUG else None
+    if not traces or 'temporary_container' not in st.session_state:
+        return
+    with st.session_state['temporary_container'].expander("Timings", expanded=False):
+        st.dataframe(pd.DataFrame(list(traces)[::-1]), hide_index=True, use_container_width=True)
@@ -0,0 +1,171 @@
+import re
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+# number fields of the forms store 'value||unit' strings
+UNIT_SEPARATOR = '||'
+# in the metadata table, a number field is a float64 column and a categorical unit column
+UNIT_COLUMN = '{} (unit)'
+
+
+def unit_column(name: str) -> str:
+    """Unit column of a number field"""
+    return UNIT_COLUMN.format(name)
+
+
+def split_value_unit(series: Series) -> Tuple[Series, Series, Series]:
+    """
+    Splits a column of 'value||unit' strings.
+    :param series: Series, column of a number field
+    :return: tuple(values, units, invalid mask)
+    """
+    strings = series.astype(str)
+    invalid = strings.str.count(re.escape(UNIT_SEPARATOR)) != 1
+    parts = strings.str.split(UNIT_SEPARATOR, n=1, expand=True, regex=False)
+    if parts.shape[1] < 2:
+        parts[1] = None
+    return parts[0], parts[1], invalid
+
+
+def number_text(series: Series) -> Series:
+    """
+    Text of a column of numbers as typed in the forms: integral values without decimals (40.0 -> '40').
+    :param series: Series of numbers
+    :return: Series of str, None if missing
+    """
+    numbers = pd.to_numeric(series, errors='coerce').astype('float64')
+    # integers exactly represented by a float64
+    integral = (numbers % 1 == 0) & (numbers.abs() < 2 ** 53)
+    text = numbers.astype(object).map(str)
+    text = text.where(~integral, numbers.where(integral, 0).astype('int64').astype(str))
+    return text.astype(object).where(numbers.notna(), None)
+
+
+def split_number(value) -> Tuple[float, str]:
+    """
+    Value and unit of a number field of the form.
+    :param value: 'value||unit' string, number or None
+    :return: tuple(float, NaN if missing or not a number, unit or None)
+    """
+    unit = None
+    if isinstance(value, str) and UNIT_SEPARATOR in value:
+        value, unit = value.split(UNIT_SEPARATOR, 1)
+    try:
+        return float(value), unit or None
+    except (TypeError, ValueError):
+        return np.nan, unit or None
+
+
+def number_fields(template_metadata: Dict) -> Dict[str, List[str]]:
+    """
+    Number fields of a template.
+    :param template_metadata: dict, metadata template
+    :return: dict, units of each number field (default unit first, empty if the field has no unit)
+    """
+    numbers = {}
+    for name, field_data in (template_metadata or {}).get('extra_fields', {}).items():
+        if field_data.get('type') == 'number':
+            units = [field_data['unit']] if field_data.get('unit') else []
+            numbers[name] = list(dict.fromkeys(units + list(field_data.get('units') or [])))
+    return numbers
+
+
+def select_fields(template_metadata: Dict) -> Dict[str, List]:
+    """
+    Single value select and radio fields of a template, stored as categorical columns (a code by row).
+    :param template_metadata: dict, metadata template
+    :return: dict, options of each field
+    """
+    selects = {}
+    for name, field_data in (template_metadata or {}).get('extra_fields', {}).items():
+        if field_data.get('type') in ('select', 'radio') and not field_data.get('allow_multi_values'):
+            selects[name] = list(dict.fromkeys(field_data.get('options') or []))
+    return selects
+
+
+def form_columns(form_data: Dict, numbers: Dict[str, List[str]]) -> Dict:
+    """
+    Values of the form by column of the metadata table: number fields are split in a value and a unit.
+    :param form_data: dict, values of the metadata form by field
+    :param numbers: dict, units of the number fields (see number_fields)
+    :return: dict, value by column
+    """
+    columns = {}
+    for name, value in form_data.items():
+        if name not in numbers:
+            columns[name] = value
+            continue
+        columns[name], unit = split_number(value)
+        if numbers[name]:
+            columns[unit_column(name)] = unit if unit is not None else numbers[name][0]
+    return columns
+
+
+def category_dtype(categories: Sequence, values: Series = None) -> pd.CategoricalDtype:
+    """Categories of a column: units or options of the field, then the other values found in the column"""
+    categories = list(categories)
+    if values is not None:
+        known = set(categories)
+        categories += [value for value in values.dropna().unique() if value not in known]
+    return pd.CategoricalDtype(categories=categories)
+
+
+def typed_numbers(df: DataFrame, numbers: Dict[str, List[str]]) -> DataFrame:
+    """
+    Converts the number fields of a metadata table to a float64 column and a categorical unit column (placed after
+    the values). Legacy 'value||unit' columns are split; a column with a cell which is not a number is left as is
+    (reported by the validation before export).
+    :param df: DataFrame, metadata table (not modified)
+    :param numbers: dict, units of the number fields (see number_fields)
+    :return: DataFrame
+    """
+    df = df.copy(deep=False)
+    for name, units in numbers.items():
+        if name not in df.columns:
+            continue
+        column = df[name]
+        if not pd.api.types.is_float_dtype(column.dtype):
+            filled = column.notna() & (column.astype(str).str.strip() != '')
+            values, column_units, _ = split_value_unit(column.where(filled, ''))
+            values = pd.to_numeric(values.where(filled), errors='coerce')
+            if (values.isna() & filled).any():
+                continue
+            df[name] = values.astype('float64')
+            if units and unit_column(name) not in df.columns:
+                df.insert(df.columns.get_loc(name) + 1, unit_column(name), column_units.where(filled))
+        if units and unit_column(name) in df.columns:
+            unit_values = df[unit_column(name)]
+            df[unit_column(name)] = unit_values.astype(object).astype(category_dtype(units, unit_values.astype(object)))
+    return df
+
+
+def typed_selects(df: DataFrame, selects: Dict[str, List]) -> DataFrame:
+    """
+    Converts the select fields of a metadata table to categorical columns, the options being the first categories.
+    :param df: DataFrame, metadata table (not modified)
+    :param selects: dict, options of the select fields (see select_fields)
+    :return: DataFrame
+    """
+    df = df.copy(deep=False)
+    for name, options in selects.items():
+        if name not in df.columns or isinstance(df[name].dtype, pd.CategoricalDtype):
+            continue
+        values = df[name].astype(object)
+        if values.map(lambda value: isinstance(value, (list, dict, set))).any():
+            continue
+        df[name] = values.astype(category_dtype(options, values))
+    return df
+
+
+def typed_table(df: DataFrame, template_metadata: Dict) -> DataFrame:
+    """
+    Types the columns of a metadata table from the template: number fields as float64 values and categorical units,
+    select fields as categorical columns. The memory used by these columns is a code by row.
+    :param df: DataFrame, metadata table (not modified)
+    :param template_metadata: dict, metadata template
+    :return: DataFrame
+    """
+    return typed_selects(typed_numbers(df, number_fields(template_metadata)), select_fields(template_metadata))
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import shutil
+import time
+import uuid
+import weakref
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import BinaryIO, Dict, Hashable, Iterator, List, Tuple
+
+from utils.manager import manage_temp_dir
+
+# Files above this size are written on disk instead of being kept in memory
+SPILL_THRESHOLD = int(os.environ.get("ELABLITE_UPLOAD_SPILL_MB", 8)) * 1024 ** 2
+# Upload directories of sessions older than this are removed
+MAX_SESSION_AGE = 24 * 3600
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class UploadHandle:
+    """
+    Lightweight handle on an uploaded file, stored in memory (small files) or on disk.
+
+    Attributes:
+        name (str): Original filename.
+        size (int): Size of the file in bytes.
+        digest (str): SHA-256 of the content.
+        path (str, optional): Path of the file on disk, if spilled.
+        data (bytes, optional): Content of the file, if kept in memory.
+    """
+    name: str
+    size: int
+    digest: str
+    path: str = None
+    data: bytes = field(default=None, repr=False)
+
+    def open(self) -> BinaryIO:
+        """Binary file object reading the content"""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return BytesIO(self.data)
+
+    def read(self) -> bytes:
+        """Whole content of the file (avoid with large files)"""
+        with self.open() as file:
+            return file.read()
+
+
+class UploadStore(Mapping):
+    """
+    Per-session store of the uploaded files, by filename. Files above a size threshold are spilled to a session
+    directory in tmp dir uploads/, so the memory used by a session stays bounded whatever the size of the dataset.
+    The directory is removed with the store (end of the session).
+    """
+
+    def __init__(self, threshold: int = SPILL_THRESHOLD):
+        """
+        :param threshold: int, size in bytes above which files are written on disk
+        """
+        self.threshold = threshold
+        self.directory = os.path.join(self.uploads_dir(), uuid.uuid4().hex)
+        self._handles: Dict[str, UploadHandle] = {}
+        # uploader file id -> filename, files already ingested
+        self._ingested: Dict[Hashable, str] = {}
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    @staticmethod
+    def uploads_dir() -> str:
+        """
+        Upload directory of all the sessions, cleaned from the directories of old sessions (not with manage_temp_dir,
+        which would remove directories of active sessions).
+        :return: str, path tmp/templates/uploads/
+        """
+        uploads_dir = os.path.join(manage_temp_dir(), 'uploads')
+        os.makedirs(uploads_dir, exist_ok=True)
+        now = time.time()
+        for session_dir in os.listdir(uploads_dir):
+            path = os.path.join(uploads_dir, session_dir)
+            if now - os.path.getmtime(path) > MAX_SESSION_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+        return uploads_dir
+
+    def add(self, name: str, file: BinaryIO) -> UploadHandle:
+        """
+        Adds a file to the store, copied by chunks.
+        :param name: str, filename
+        :param file: binary file object (e.g. streamlit UploadedFile)
+        :return: UploadHandle
+        """
+        self.remove(name)
+        if file.seekable():
+            file.seek(0)
+        digest = hashlib.sha256()
+        buffer = BytesIO()
+        path = None
+        target = buffer
+        size = 0
+        try:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                if path is None and size > self.threshold:
+                    # spill on disk
+                    os.makedirs(self.directory, exist_ok=True)
+                    path = os.path.join(self.directory, uuid.uuid4().hex)
+                    target = open(path, 'wb')
+                    target.write(buffer.getbuffer())
+                    buffer = None
+                    target.write(chunk)
+                else:
+                    target.write(chunk)
+        finally:
+            if path is not None:
+                target.close()
+
+        handle = UploadHandle(name=name, size=size, digest=digest.hexdigest(), path=path,
+                              data=buffer.getvalue() if path is None else None)
+        self._handles[name] = handle
+        return handle
+
+    def sync(self, uploaded_files: List[BinaryIO]) -> Tuple[List[UploadHandle], List[str]]:
+        """
+        Synchronizes the store with the files of an uploader. Each file is read exactly once (keyed by the uploader
+        file id), so reruns only do work for newly added files. Files removed from the uploader are removed.
+        :param uploaded_files: list of streamlit UploadedFile (empty if the uploader was emptied)
+        :return: tuple(handles of the new files, names of the removed files)
+        """
+        # the same filename uploaded again replaces the previous file: only the last upload of a name is kept
+        by_name = {file.name: file for file in uploaded_files}
+        current = {self.file_key(file): file for file in by_name.values()}
+
+        removed = []
+        for key in [key for key in self._ingested if key not in current]:
+            name = self._ingested.pop(key)
+            if name not in by_name:
+                self.remove(name)
+                removed.append(name)
+
+        new = []
+        for key, file in current.items():
+            if key not in self._ingested:
+                new.append(self.add(file.name, file))
+                self._ingested[key] = file.name
+        return new, removed
+
+    @staticmethod
+    def file_key(file) -> Hashable:
+        """Identifier of an uploaded file: uploader file id, or name and size"""
+        file_id = getattr(file, 'file_id', None)
+        return file_id if file_id is not None else (file.name, file.size)
+
+    def spill(self) -> Dict[str, str]:
+        """
+        Writes on disk the files kept in memory, so every file can be read by another process (export service).
+        :return: dict, path of each file by filename
+        """
+        for name, handle in list(self._handles.items()):
+            if handle.path is None:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, uuid.uuid4().hex)
+                with open(path, 'wb') as file:
+                    file.write(handle.data)
+                self._handles[name] = UploadHandle(name=name, size=handle.size, digest=handle.digest, path=path)
+        return {name: handle.path for name, handle in self._handles.items()}
+
+    def remove(self, name: str):
+        """Removes a file from the store"""
+        handle = self._handles.pop(name, None)
+        if handle is not None and handle.path is not None and os.path.exists(handle.path):
+            os.remove(handle.path)
+
+    def clear(self):
+        """Removes all the files of the store"""
+        for name in list(self._handles):
+            self.remove(name)
+
+    def __getitem__(self, name: str) -> UploadHandle:
+        return self._handles[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._handles)
+
+    def __len__(self) -> int:
+        return len(self._handles)